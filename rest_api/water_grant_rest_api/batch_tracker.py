@@ -0,0 +1,149 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import asyncio
+from collections import OrderedDict
+import logging
+import time
+
+from water_grant_rest_api.cache import LRUCache
+from water_grant_rest_api.errors import ApiBadRequest
+from water_grant_rest_api.errors import ApiInternalError
+from water_grant_rest_api.errors import ApiServiceUnavailable
+
+
+FINAL_STATUSES = ('COMMITTED', 'INVALID')
+LOGGER = logging.getLogger(__name__)
+
+
+class BatchStatusTracker(object):
+    """Follows the batches submitted without waiting for their commit.
+
+    A single loop asks the validator for the status of every pending batch
+    at once, every interval seconds, instead of one status request per
+    client. Final statuses are kept for ttl seconds, so clients can read
+    them after the batch leaves the pending set. Batches the validator
+    still does not know after ttl seconds are dropped.
+    """
+    def __init__(self, fetch_statuses, interval=0.5, max_tracked=10000,
+                 ttl=600, chunk_size=500):
+        self._fetch_statuses = fetch_statuses
+        self._interval = interval
+        self._ttl = ttl
+        self._chunk_size = chunk_size
+        self._max_tracked = max_tracked
+        self._pending = OrderedDict()
+        self._resolved = LRUCache(max_tracked, ttl)
+        self._waiters = {}
+        self.polls = 0
+        self.dropped = 0
+
+    def track(self, batch_id):
+        if len(self._pending) >= self._max_tracked:
+            self._pending.popitem(last=False)
+            self.dropped += 1
+        self._pending[batch_id] = {
+            'submitted_at': time.monotonic(),
+            'status': {
+                'batch_id': batch_id,
+                'status': 'PENDING',
+                'invalid_transactions': [],
+            },
+        }
+
+    async def status(self, batch_id, wait=0):
+        """Returns the last known status of batch_id, waiting up to wait
+        seconds for it to become final. None if it is not tracked
+        """
+        status = self._resolved.get(batch_id)
+        if status is not None:
+            return status
+        pending = self._pending.get(batch_id)
+        if pending is None:
+            return None
+        if wait > 0:
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.setdefault(batch_id, []).append(waiter)
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(waiter), wait)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                waiters = self._waiters.get(batch_id)
+                if waiters is not None and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._waiters[batch_id]
+        return self._status_of(batch_id)
+
+    def _status_of(self, batch_id):
+        pending = self._pending.get(batch_id)
+        if pending is not None:
+            return pending['status']
+        return self._resolved.get(batch_id)
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll()
+            except (ApiBadRequest, ApiInternalError,
+                    ApiServiceUnavailable) as err:
+                LOGGER.warning('Unable to poll batch statuses: %s', err)
+            await asyncio.sleep(self._interval)
+
+    async def poll(self):
+        """Updates the status of every pending batch
+        """
+        batch_ids = list(self._pending)
+        for start in range(0, len(batch_ids), self._chunk_size):
+            chunk = batch_ids[start:start + self._chunk_size]
+            statuses = await self._fetch_statuses(chunk)
+            self.polls += 1
+            for batch_id, status in statuses.items():
+                self._update(batch_id, status)
+
+        expired_before = time.monotonic() - self._ttl
+        for batch_id, pending in list(self._pending.items()):
+            if pending['submitted_at'] < expired_before:
+                del self._pending[batch_id]
+                self.dropped += 1
+                self._notify(batch_id, pending['status'])
+
+    def _update(self, batch_id, status):
+        pending = self._pending.get(batch_id)
+        if pending is None:
+            return
+        if status['status'] not in FINAL_STATUSES:
+            pending['status'] = status
+            return
+        del self._pending[batch_id]
+        self._resolved.put(batch_id, status)
+        self._notify(batch_id, status)
+
+    def _notify(self, batch_id, status):
+        for waiter in self._waiters.pop(batch_id, []):
+            if not waiter.done():
+                waiter.set_result(status)
+
+    def snapshot(self):
+        return {
+            'pending': len(self._pending),
+            'waiting_clients': sum(
+                len(waiters) for waiters in self._waiters.values()),
+            'polls': self.polls,
+            'dropped': self.dropped,
+            'resolved': self._resolved.snapshot(),
+        }
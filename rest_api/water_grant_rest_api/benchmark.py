@@ -0,0 +1,248 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Seeds the subscriber tables with synthetic sensors and times the REST API
+Database fetches against them, and the encoding of the GET /sensors body
+with each available JSON serializer. Seeded rows are prefixed with
+SEED_PREFIX and removed again when the benchmark finishes.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from psycopg2.extras import RealDictCursor
+
+from water_grant_rest_api.database import Database
+from water_grant_rest_api.database import LATEST_BLOCK_NUM
+from water_grant_rest_api.database import SENSOR_LIST_FIELDS
+from water_grant_rest_api.database import _sensor_child_queries
+from water_grant_rest_api.serialization import available_serializers
+from water_grant_rest_api.serialization import dumps
+from water_grant_rest_api.serialization import set_serializer
+
+
+SEED_PREFIX = 'benchmark-'
+MAX_BLOCK_NUMBER = 2 ** 63 - 1
+
+SEED_STMTS = """
+INSERT INTO blocks (block_num, block_id)
+SELECT 0, '{prefix}block'
+WHERE NOT EXISTS (SELECT 1 FROM blocks);
+
+INSERT INTO users (public_key, name, created_at, quota,
+                   start_block_num, end_block_num)
+VALUES ('{prefix}user', 'benchmark', 0, 0, 0, {max_block});
+
+INSERT INTO sensors (sensor_id, created_at, start_block_num, end_block_num)
+SELECT '{prefix}' || i, 0, 0, {max_block}
+FROM generate_series(1, {sensors}) AS i;
+
+INSERT INTO sensor_locations (sensor_id, latitude, longitude, timestamp,
+                              start_block_num, end_block_num)
+SELECT '{prefix}' || i, i, -i, 0, 0, {max_block}
+FROM generate_series(1, {sensors}) AS i;
+
+INSERT INTO sensor_owners (sensor_id, user_public_key, timestamp,
+                           start_block_num, end_block_num)
+SELECT '{prefix}' || i, '{prefix}user', 0, 0, {max_block}
+FROM generate_series(1, {sensors}) AS i;
+
+INSERT INTO measurements (sensor_id, measurement, timestamp,
+                          start_block_num, end_block_num)
+SELECT '{prefix}' || i, m, 1500000000 + m * 3600, 0,
+       CASE WHEN m = {measurements} THEN {max_block} ELSE 0 END
+FROM generate_series(1, {sensors}) AS i,
+     generate_series(1, {measurements}) AS m;
+"""
+
+CLEANUP_STMTS = """
+DELETE FROM usage_monthly WHERE sensor_id LIKE '{prefix}%';
+DELETE FROM measurements WHERE sensor_id LIKE '{prefix}%';
+DELETE FROM sensor_owners WHERE sensor_id LIKE '{prefix}%';
+DELETE FROM sensor_locations WHERE sensor_id LIKE '{prefix}%';
+DELETE FROM sensors WHERE sensor_id LIKE '{prefix}%';
+DELETE FROM users WHERE public_key = '{prefix}user';
+DELETE FROM blocks WHERE block_id = '{prefix}block';
+"""
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks REST API database fetches on seeded data')
+    parser.add_argument('--db-name', default='water-grant')
+    parser.add_argument('--db-host', default='postgres')
+    parser.add_argument('--db-port', default='5432')
+    parser.add_argument('--db-user', default='sawtooth')
+    parser.add_argument('--db-password', default='sawtooth')
+    parser.add_argument(
+        '-s', '--sensors',
+        help='Number of sensors to seed',
+        type=int,
+        default=10000)
+    parser.add_argument(
+        '-m', '--measurements',
+        help='Measurements seeded per sensor',
+        type=int,
+        default=10)
+    parser.add_argument(
+        '-r', '--repeat',
+        help='Times each fetch is run, the best time is reported',
+        type=int,
+        default=3)
+    return parser.parse_args(args)
+
+
+async def fetch_all_sensor_resources_per_sensor(database):
+    """The per-sensor listing GET /sensors used before, issuing three
+    queries for every sensor. Kept as the baseline of the benchmark.
+    """
+    # pylint: disable=protected-access
+    async with database._read_cursor(cursor_factory=RealDictCursor) \
+            as cursor:
+        await cursor.execute("""
+        SELECT sensor_id FROM sensors
+        WHERE ({0}) >= start_block_num
+        AND ({0}) < end_block_num;
+        """.format(LATEST_BLOCK_NUM))
+        sensors = await cursor.fetchall()
+
+        for sensor in sensors:
+            for table, columns, key in (
+                    ('sensor_locations', 'latitude, longitude, timestamp',
+                     'locations'),
+                    ('sensor_owners', 'user_public_key, timestamp', 'owners'),
+                    ('measurements', 'measurement, timestamp',
+                     'measurements')):
+                await cursor.execute("""
+                SELECT {0} FROM {1}
+                WHERE sensor_id='{2}'
+                AND ({3}) >= start_block_num
+                AND ({3}) < end_block_num;
+                """.format(columns, table, sensor['sensor_id'],
+                           LATEST_BLOCK_NUM))
+                sensor[key] = await cursor.fetchall()
+
+        return sensors
+
+
+async def fetch_all_sensor_resources_dict_rows(database):
+    """The set-based listing of fetch_all_sensor_resources as it read its
+    rows before, through a RealDictCursor. Kept as the baseline of the
+    tuple rows.
+    """
+    # pylint: disable=protected-access
+    child_queries = _sensor_child_queries(False, None, None)
+    async with database._read_cursor(cursor_factory=RealDictCursor) \
+            as cursor:
+        await cursor.execute(LATEST_BLOCK_NUM)
+        params = {'block_num': (await cursor.fetchone())['max']}
+        await cursor.execute("""
+        SELECT sensor_id FROM sensors
+        WHERE %(block_num)s >= start_block_num
+        AND %(block_num)s < end_block_num
+        ORDER BY sensor_id;
+        """, params)
+        sensors = await cursor.fetchall()
+
+        sensors_by_id = {}
+        for sensor in sensors:
+            for key in SENSOR_LIST_FIELDS[1:]:
+                sensor[key] = []
+            sensors_by_id[sensor['sensor_id']] = sensor
+        for key in SENSOR_LIST_FIELDS[1:]:
+            await cursor.execute(child_queries[key], params)
+            for row in await cursor.fetchall():
+                sensor = sensors_by_id.get(row.pop('sensor_id'))
+                if sensor is not None:
+                    sensor[key].append(row)
+
+        return sensors
+
+
+async def _time(label, repeat, func, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = await func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:<24} {:>8} rows  best of {}: {:>8.3f}s'.format(
+        label, len(result), repeat, best))
+    return result
+
+
+def _time_encoding(label, repeat, encode, resource):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = encode(resource)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('{:<24} {:>8} KiB  best of {}: {:>8.3f}s'.format(
+        label, len(body) // 1024, repeat, best))
+
+
+def _aiohttp_dumps(resource):
+    # What aiohttp's json_response did before the serializers
+    return json.dumps(resource).encode()
+
+
+async def run(opts, database):
+    # pylint: disable=protected-access
+    format_args = {
+        'prefix': SEED_PREFIX,
+        'max_block': MAX_BLOCK_NUMBER,
+        'sensors': opts.sensors,
+        'measurements': opts.measurements,
+    }
+
+    await database.connect()
+    try:
+        async with database._cursor() as cursor:
+            await cursor.execute(SEED_STMTS.format(**format_args))
+
+        await _time('per-sensor queries', opts.repeat,
+                    fetch_all_sensor_resources_per_sensor, database)
+        await _time('set-based dict rows', opts.repeat,
+                    fetch_all_sensor_resources_dict_rows, database)
+        sensors = await _time('set-based tuple rows', opts.repeat,
+                              database.fetch_all_sensor_resources)
+
+        _time_encoding('aiohttp json_response', opts.repeat,
+                       _aiohttp_dumps, sensors)
+        for name in available_serializers():
+            set_serializer(name)
+            _time_encoding('{} serializer'.format(name), opts.repeat,
+                           dumps, sensors)
+    finally:
+        async with database._cursor() as cursor:
+            await cursor.execute(CLEANUP_STMTS.format(**format_args))
+        database.disconnect()
+
+
+def main():
+    opts = parse_args(sys.argv[1:])
+    loop = asyncio.get_event_loop()
+    database = Database(
+        opts.db_host,
+        opts.db_port,
+        opts.db_name,
+        opts.db_user,
+        opts.db_password,
+        loop)
+    loop.run_until_complete(run(opts, database))
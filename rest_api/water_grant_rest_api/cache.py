@@ -0,0 +1,204 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import asyncio
+from collections import namedtuple
+from collections import OrderedDict
+import json
+import logging
+import time
+
+import psycopg2
+
+
+CHANGES_CHANNEL = 'water_grant_changes'
+LOGGER = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """Mapping bounded to max_size entries, evicting the least recently
+    used, whose entries expire ttl seconds after being stored
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key):
+        """Removes key, returning whether it was cached
+        """
+        return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        self._entries.clear()
+
+    def snapshot(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else None,
+            'evictions': self.evictions,
+        }
+
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'etag', 'last_modified'])
+
+
+class ResponseCache(object):
+    """LRUCache of serialized responses, keyed by resource (e.g.
+    'sensor:<sensor_id>').
+
+    Entries stay valid while the chain does not change. When the latest
+    block advances, only the keys the subscriber notified as changed by the
+    new blocks are dropped, or every entry if a block between the two was
+    not notified. A response is only stored if nothing was invalidated
+    while it was being fetched, so a slow read can not cache stale data.
+    """
+    def __init__(self, max_size=10000, ttl=60):
+        self._entries = LRUCache(max_size, ttl)
+        self._notified = {}
+        self.block_num = None
+        self.generation = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def put(self, key, body, etag, generation, last_modified=None):
+        """Stores a response fetched while the cache was at generation
+        """
+        if generation == self.generation:
+            self._entries.put(key, CacheEntry(body, etag, last_modified))
+
+    def invalidate(self, keys):
+        self.generation += 1
+        for key in keys:
+            if self._entries.pop(key):
+                self.invalidations += 1
+
+    def clear(self):
+        self.generation += 1
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    def changes_notified(self, block_num, keys, fork=False):
+        """Records the keys changed by block_num, None if unknown. A fork
+        rewrites blocks already seen, so it drops every entry right away
+        """
+        if fork:
+            self._notified.clear()
+            self.clear()
+            return
+        if self.block_num is None or block_num > self.block_num:
+            self._notified[block_num] = keys
+
+    def block_advanced(self, block_num):
+        """Invalidates what changed between the current block and block_num
+        """
+        if block_num is None or block_num == self.block_num:
+            return
+        if self.block_num is None or block_num < self.block_num:
+            self.clear()
+        else:
+            changed = set()
+            for num in range(self.block_num + 1, block_num + 1):
+                keys = self._notified.get(num)
+                if keys is None:
+                    changed = None
+                    break
+                changed.update(keys)
+            if changed is None:
+                self.clear()
+            else:
+                self.invalidate(changed)
+
+        self.block_num = block_num
+        self._notified = {
+            num: keys for num, keys in self._notified.items()
+            if num > block_num}
+
+    def snapshot(self):
+        snapshot = self._entries.snapshot()
+        snapshot['block_num'] = self.block_num
+        snapshot['invalidations'] = self.invalidations
+        return snapshot
+
+
+async def watch_blocks(cache, database, interval):
+    """Polls the latest block of the read database, advancing the cache
+    """
+    while True:
+        try:
+            cache.block_advanced(await database.fetch_latest_block_num())
+        except psycopg2.Error as err:
+            LOGGER.warning('Unable to poll the latest block: %s', err)
+            cache.clear()
+        await asyncio.sleep(interval)
+
+
+async def listen_for_changes(cache, database, retry_interval=5):
+    """Feeds the change notifications the subscriber sends on every block
+    into the cache, reconnecting if the listening connection drops
+    """
+    while True:
+        try:
+            await database.listen(
+                CHANGES_CHANNEL,
+                lambda payload: _changes_notified(cache, payload))
+        except psycopg2.Error as err:
+            LOGGER.warning('Lost the change notifications: %s', err)
+        # Changes may have been missed while not listening
+        cache.clear()
+        await asyncio.sleep(retry_interval)
+
+
+def _changes_notified(cache, payload):
+    try:
+        changes = json.loads(payload)
+        cache.changes_notified(
+            changes['block_num'], changes['keys'], changes.get('fork', False))
+    except (ValueError, KeyError, TypeError):
+        LOGGER.warning('Ignoring malformed change notification: %s', payload)
@@ -0,0 +1,118 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import asyncio
+import logging
+
+from water_grant_rest_api.errors import ApiBadRequest
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SubmitCoalescer(object):
+    """Collects the batches sent within window seconds, up to max_size, and
+    submits them in one ClientBatchSubmitRequest, followed by one status
+    request for those whose sender waits for the commit.
+
+    Each update stays in its own batch, so the validator still accepts or
+    rejects it on its own and every sender gets the outcome of its own
+    transaction. If the validator rejects the request as a whole, its
+    batches are submitted one by one to find the invalid ones.
+    """
+    def __init__(self, loop, submit_batches, wait_for_commits, window=0.005,
+                 max_size=100):
+        self._loop = loop
+        self._submit_batches = submit_batches
+        self._wait_for_commits = wait_for_commits
+        self._window = window
+        self._max_size = max_size
+        self._queue = []
+        self._timer = None
+        self.requests = 0
+        self.batches = 0
+
+    async def send(self, batch, wait):
+        """Queues batch for the next submit request, returning its id once
+        it was submitted, or committed if wait is set
+        """
+        future = self._loop.create_future()
+        self._queue.append((batch, wait, future))
+        if len(self._queue) >= self._max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self._window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        queued, self._queue = self._queue, []
+        if queued:
+            self.requests += 1
+            self.batches += len(queued)
+            asyncio.ensure_future(self._submit(queued), loop=self._loop)
+
+    async def _submit(self, queued):
+        try:
+            await self._submit_batches([batch for batch, _, _ in queued])
+        except ApiBadRequest:
+            if len(queued) == 1:
+                _resolve(queued, error=ApiBadRequest('Batch inválido.'))
+                return
+            LOGGER.warning(
+                'Rejected coalesced submit of %s batches, '
+                'submitting them one by one', len(queued))
+            await asyncio.gather(
+                *[self._submit([entry]) for entry in queued])
+            return
+        except Exception as err:  # pylint: disable=broad-except
+            _resolve(queued, error=err)
+            return
+
+        waiting = [entry for entry in queued if entry[1]]
+        _resolve([entry for entry in queued if not entry[1]])
+        if not waiting:
+            return
+        try:
+            errors = await self._wait_for_commits(
+                [batch.header_signature for batch, _, _ in waiting])
+        except Exception as err:  # pylint: disable=broad-except
+            _resolve(waiting, error=err)
+            return
+        for entry in waiting:
+            _resolve([entry], error=errors.get(entry[0].header_signature))
+
+    def snapshot(self):
+        return {
+            'window_ms': self._window * 1000,
+            'max_size': self._max_size,
+            'queued': len(self._queue),
+            'requests': self.requests,
+            'batches': self.batches,
+            'batches_per_request':
+                self.batches / self.requests if self.requests else None,
+        }
+
+
+def _resolve(entries, error=None):
+    for batch, _, future in entries:
+        if future.done():
+            continue
+        if error is None:
+            future.set_result(batch.header_signature)
+        else:
+            future.set_exception(error)
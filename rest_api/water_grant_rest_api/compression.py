@@ -0,0 +1,129 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Compresses response bodies with the best encoding the client accepts,
+brotli if it is installed, or else gzip.
+"""
+
+import gzip
+
+from aiohttp.web import middleware
+from aiohttp.web import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def available_encodings():
+    """The encodings responses can be compressed with, in preference order
+    """
+    return (['br'] if brotli is not None else []) + ['gzip']
+
+
+def negotiate_encoding(accept_encoding, encodings=None):
+    """Returns the first of encodings the Accept-Encoding header value
+    accepts, None if it accepts none of them
+    """
+    accepted = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in encodings or available_encodings():
+        quality = accepted.get(encoding, accepted.get('*', 0.0))
+        if quality > 0:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def encoded_etag(etag, encoding):
+    """The ETag of the body encoded with encoding, since a strong ETag
+    identifies the exact bytes sent
+    """
+    return '{}-{}"'.format(etag[:-1], encoding)
+
+
+def strip_encoding(etag):
+    """The ETag of the identity body an ETag sent by a client refers to
+    """
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    for encoding in ('br', 'gzip'):
+        suffix = '-{}"'.format(encoding)
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+def compression_middleware(min_size, cache=None):
+    """Compresses JSON responses of at least min_size bytes. Bodies with an
+    ETag are compressed once per URL and encoding and kept in the optional
+    LRUCache, as the ETag identifies them. Streamed responses compress
+    themselves.
+    """
+    @middleware
+    async def compress_response(request, handler):
+        response = await handler(request)
+        if not isinstance(response, Response):
+            return response
+        body = response.body
+        if response.status != 200 or not isinstance(body, bytes) \
+                or len(body) < min_size \
+                or 'Content-Encoding' in response.headers:
+            return response
+
+        response.headers['Vary'] = 'Accept-Encoding'
+        encoding = negotiate_encoding(
+            request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+
+        etag = response.headers.get('ETag')
+        compressed = None
+        # ETags are only unique per URL, pages of a list share theirs
+        key = (request.path_qs, etag, encoding)
+        if etag is not None and cache is not None:
+            compressed = cache.get(key)
+        if compressed is None:
+            compressed = compress(body, encoding)
+            if etag is not None and cache is not None:
+                cache.put(key, compressed)
+
+        response.body = compressed
+        response.headers['Content-Encoding'] = encoding
+        if etag is not None:
+            response.headers['ETag'] = encoded_etag(etag, encoding)
+        return response
+
+    return compress_response
@@ -24,20 +24,79 @@ from psycopg2.extras import RealDictCursor
 LATEST_BLOCK_NUM = """
 SELECT max(block_num) FROM blocks
 """
+USER_LIST_FIELDS = ('public_key', 'name', 'created_at')
+SENSOR_LIST_FIELDS = ('sensor_id', 'locations', 'owners', 'measurements')
+MEASUREMENT_BUCKETS = {'hour': 3600, 'day': 86400}
+STREAM_BATCH_SIZE = 500
 LOGGER = logging.getLogger(__name__)
 
 
+class _PooledCursor(object):
+    """Acquires a connection from a pool for the duration of one cursor.
+    Connections that fail with a connection error are closed before being
+    released, so the pool replaces them instead of handing them out again.
+    """
+    def __init__(self, pool, acquire_timeout, cursor_kwargs):
+        self._pool = pool
+        self._acquire_timeout = acquire_timeout
+        self._cursor_kwargs = cursor_kwargs
+        self._conn = None
+        self._cursor = None
+
+    async def __aenter__(self):
+        try:
+            self._conn = await asyncio.wait_for(
+                self._pool.acquire(), self._acquire_timeout)
+        except asyncio.TimeoutError:
+            raise psycopg2.OperationalError(
+                'Timed out acquiring a database connection')
+        try:
+            self._cursor = await self._conn.cursor(**self._cursor_kwargs)
+        except Exception:
+            await self._release(broken=True)
+            raise
+        return self._cursor
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        self._cursor.close()
+        broken = exc_type is not None and issubclass(
+            exc_type, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        await self._release(broken)
+
+    async def _release(self, broken):
+        if broken:
+            LOGGER.warning('Discarding broken database connection')
+            self._conn.close()
+        await self._pool.release(self._conn)
+
+
 class Database(object):
-    """Manages connection to the postgres database and makes async queries
+    """Manages a pool of connections to the postgres database and makes
+    async queries, each on a connection acquired for that query
     """
-    def __init__(self, host, port, name, user, password, loop):
+    def __init__(self, host, port, name, user, password, loop,
+                 read_host=None, read_port=None, pool_min_size=1,
+                 pool_max_size=10, acquire_timeout=10, pool_recycle=-1):
         self._dsn = 'dbname={} user={} password={} host={} port={}'.format(
             name, user, password, host, port)
+        # Chain resources written by the subscriber may be read from a
+        # streaming replica. The auth table is written by this API, so it
+        # always goes to the primary.
+        self._read_dsn = None
+        if read_host is not None:
+            self._read_dsn = \
+                'dbname={} user={} password={} host={} port={}'.format(
+                    name, user, password, read_host, read_port or port)
         self._loop = loop
-        self._conn = None
+        self._pool_min_size = pool_min_size
+        self._pool_max_size = pool_max_size
+        self._acquire_timeout = acquire_timeout
+        self._pool_recycle = pool_recycle
+        self._pool = None
+        self._read_pool = None
 
     async def connect(self, retries=5, initial_delay=1, backoff=2):
-        """Initializes a connection to the database
+        """Initializes the connection pools to the database
 
         Args:
             retries (int): Number of times to retry the connection
@@ -49,8 +108,7 @@ class Database(object):
         delay = initial_delay
         for attempt in range(retries):
             try:
-                self._conn = await aiopg.connect(
-                    dsn=self._dsn, loop=self._loop, echo=True)
+                await self._create_pools()
                 print('Successfully connected to database')
                 return
 
@@ -62,14 +120,153 @@ class Database(object):
                 await asyncio.sleep(delay)
                 delay *= backoff
 
-        self._conn = await aiopg.connect(
-            dsn=self._dsn, loop=self._loop, echo=True)
+        await self._create_pools()
         print('Successfully connected to database')
 
+    async def _create_pools(self):
+        self._pool = await self._create_pool(self._dsn)
+        if self._read_dsn is None:
+            self._read_pool = self._pool
+        else:
+            self._read_pool = await self._create_pool(self._read_dsn)
+
+    async def _create_pool(self, dsn):
+        return await aiopg.create_pool(
+            dsn=dsn,
+            loop=self._loop,
+            minsize=self._pool_min_size,
+            maxsize=self._pool_max_size,
+            pool_recycle=self._pool_recycle)
+
     def disconnect(self):
-        """Closes connection to the database
+        """Closes the connection pools to the database
         """
-        self._conn.close()
+        if self._pool is not None:
+            self._pool.close()
+        if self._read_pool is not None and self._read_pool is not self._pool:
+            self._read_pool.close()
+
+    def _cursor(self, **kwargs):
+        """Cursor on a connection to the primary database
+        """
+        return _PooledCursor(self._pool, self._acquire_timeout, kwargs)
+
+    def _read_cursor(self, **kwargs):
+        """Cursor on a connection to the database chain resources are
+        read from
+        """
+        return _PooledCursor(self._read_pool, self._acquire_timeout, kwargs)
+
+    async def check_health(self):
+        """Runs a trivial query on each pool, raising if either fails
+        """
+        for cursor_factory in (self._cursor, self._read_cursor):
+            async with cursor_factory() as cursor:
+                await cursor.execute('SELECT 1')
+
+    async def is_ready(self, timeout=1):
+        """Whether the read database answers a query within timeout
+        """
+        if self._read_pool is None:
+            return False
+        try:
+            await asyncio.wait_for(self.fetch_latest_block_num(), timeout)
+        except (psycopg2.Error, asyncio.TimeoutError):
+            return False
+        return True
+
+    async def fetch_latest_block_num(self):
+        async with self._read_cursor() as cursor:
+            await cursor.execute(LATEST_BLOCK_NUM)
+            block_num = (await cursor.fetchone())[0]
+            return block_num
+
+    async def fetch_latest_block(self):
+        """Fetches the number and id of the latest block, as the version of
+        resources that may change with any block. None before the first
+        """
+        fetch = """
+        SELECT block_num, block_id FROM blocks
+        ORDER BY block_num DESC
+        LIMIT 1;
+        """
+        async with self._read_cursor() as cursor:
+            await cursor.execute(fetch)
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        return {'block_num': row[0], 'block_id': row[1], 'timestamp': None}
+
+    async def fetch_sensor_version(self, sensor_id):
+        """Fetches the number and id of the last block that changed the
+        rows of a sensor, with the latest timestamp among them. A fork
+        that drops the changing block changes its id, or leaves an older
+        block as the last change, so the version still identifies the rows.
+        None if the sensor does not exist
+        """
+        fetch = """
+        SELECT blocks.block_num, blocks.block_id, changes.timestamp
+        FROM (
+            SELECT MAX(start_block_num) AS block_num,
+                   MAX(timestamp) AS timestamp
+            FROM (
+                SELECT start_block_num, created_at AS timestamp
+                FROM sensors WHERE sensor_id = %(sensor_id)s
+                UNION ALL
+                SELECT start_block_num, timestamp
+                FROM sensor_locations WHERE sensor_id = %(sensor_id)s
+                UNION ALL
+                SELECT start_block_num, timestamp
+                FROM sensor_owners WHERE sensor_id = %(sensor_id)s
+                UNION ALL
+                SELECT start_block_num, timestamp
+                FROM measurements WHERE sensor_id = %(sensor_id)s
+            ) AS sensor_rows
+        ) AS changes
+        JOIN blocks ON blocks.block_num = changes.block_num;
+        """
+        async with self._read_cursor() as cursor:
+            await cursor.execute(fetch, {'sensor_id': sensor_id})
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        return {'block_num': row[0], 'block_id': row[1], 'timestamp': row[2]}
+
+    async def wait_for_block(self, block_num, timeout, interval=0.1):
+        """Waits until the database read from has ingested block_num
+
+        Args:
+            block_num (int): Block the reads must reflect
+            timeout (float): Seconds to wait before giving up
+            interval (float): Seconds between checks
+
+        Returns:
+            bool: Whether the block was reached within the timeout
+        """
+        deadline = self._loop.time() + timeout
+        while True:
+            latest = await self.fetch_latest_block_num()
+            if latest is not None and latest >= block_num:
+                return True
+            if self._loop.time() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+
+    async def listen(self, channel, callback):
+        """LISTENs to channel on a dedicated connection to the primary
+        database, calling callback with the payload of every notification.
+        Only returns by raising, once the connection fails
+        """
+        conn = await aiopg.connect(dsn=self._dsn, loop=self._loop)
+        try:
+            cursor = await conn.cursor()
+            await cursor.execute('LISTEN "{}"'.format(channel))
+            cursor.close()
+            while True:
+                notification = await conn.notifies.get()
+                callback(notification.payload)
+        finally:
+            conn.close()
 
 
     async def create_auth_entry(self,
@@ -94,10 +291,8 @@ class Database(object):
             hashed_password.hex(),
             is_admin)
 
-        async with self._conn.cursor() as cursor:
+        async with self._cursor() as cursor:
             await cursor.execute(insert)
-
-        self._conn.commit()
     
     
     async def delete_auth_entry(self,
@@ -106,11 +301,9 @@ class Database(object):
         DELETE FROM auth WHERE public_key = '{0}'
         """.format(public_key)
 
-        async with self._conn.cursor() as cursor:
+        async with self._cursor() as cursor:
             await cursor.execute(remove)
 
-        self._conn.commit()
-
 
     async def fetch_admin_resource(self, public_key):
         fetch = """
@@ -121,7 +314,7 @@ class Database(object):
         AND ({1}) < end_block_num;
         """.format(public_key, LATEST_BLOCK_NUM)
 
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        async with self._read_cursor(cursor_factory=RealDictCursor) as cursor:
             await cursor.execute(fetch)
             return await cursor.fetchone()
         
@@ -132,7 +325,7 @@ class Database(object):
         AND ({0}) < end_block_num;
         """.format(LATEST_BLOCK_NUM)
 
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        async with self._read_cursor(cursor_factory=RealDictCursor) as cursor:
             await cursor.execute(fetch)
             return await cursor.fetchall()
 
@@ -147,176 +340,558 @@ class Database(object):
         AND ({1}) < end_block_num;
         """.format(public_key, LATEST_BLOCK_NUM)
 
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        async with self._read_cursor(cursor_factory=RealDictCursor) as cursor:
             await cursor.execute(fetch)
             return await cursor.fetchone()
         
 
-    async def fetch_user_quota_resource(self, public_key):
+    async def fetch_user_quota_usage_resource(self, public_key):
+        """Sums, for every sensor of the user, the usage of the most recent
+        month with readings, served from the user_usage snapshot the
+        subscriber keeps up to date
+        """
         fetch = """
-        SELECT quota FROM users
-        WHERE public_key='{0}'
-        """.format(public_key)
+        SELECT COALESCE(
+            (SELECT total FROM user_usage WHERE user_public_key = %s),
+            0) AS sum
+        """
 
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            await cursor.execute(fetch)
-            return await cursor.fetchone()    
-        
+        async with self._read_cursor(cursor_factory=RealDictCursor) as cursor:
+            await cursor.execute(fetch, (public_key,))
+            return await cursor.fetchone()
 
-    async def fetch_user_quota_usage_resource(self, public_key):
+    async def fetch_user_registration_resource(self, public_key):
+        """Fetches the quota and current usage of a user in one lookup, to
+        check a sensor registration against. None if the user is unknown
+        """
         fetch = """
-        SELECT COALESCE(SUM(measurements.measurement), 0) AS sum
-        FROM (
-            SELECT sensor_id, DATE_TRUNC('month', MAX(to_timestamp("timestamp"))) as max_month
-            FROM public.measurements
-            WHERE sensor_id IN (
-                SELECT sensor_id
-                FROM public.sensor_owners
-                WHERE user_public_key='{0}'
-            )
-            GROUP BY sensor_id
-        ) AS last_measurements_month
-        JOIN public.measurements ON measurements.sensor_id = last_measurements_month.sensor_id
-        AND DATE_TRUNC('month', to_timestamp(measurements."timestamp")) = last_measurements_month.max_month
-
-        """.format(public_key)
+        SELECT users.quota, COALESCE(user_usage.total, 0) AS usage
+        FROM users
+        LEFT JOIN user_usage
+        ON user_usage.user_public_key = users.public_key
+        WHERE users.public_key = %s
+        """
 
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            await cursor.execute(fetch)
+        async with self._read_cursor(cursor_factory=RealDictCursor) as cursor:
+            await cursor.execute(fetch, (public_key,))
             return await cursor.fetchone()
-        
 
-    async def fetch_all_user_resources(self):
+    async def fetch_user_usage_history_resource(self, public_key):
         fetch = """
-        SELECT public_key, name, created_at FROM users
-        WHERE ({0}) >= start_block_num
-        AND ({0}) < end_block_num;
-        """.format(LATEST_BLOCK_NUM)
+        SELECT to_char(month, 'YYYY-MM') AS month,
+               SUM(total) AS total,
+               MAX(last_measurement_ts) AS last_measurement_ts
+        FROM usage_monthly
+        WHERE user_public_key = %s
+        GROUP BY month
+        ORDER BY month
+        """
 
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            await cursor.execute(fetch)
-            return await cursor.fetchall()
+        async with self._read_cursor() as cursor:
+            await cursor.execute(fetch, (public_key,))
+            return _rows_as_dicts(cursor, await cursor.fetchall())
+
+
+    async def fetch_all_user_resources(self, limit=None, after=None,
+                                       fields=None):
+        """Fetches the current users ordered by public key
+
+        Args:
+            limit (int): Maximum number of users to return, all if None
+            after (str): Only return users with a greater public key
+            fields (list of str): USER_LIST_FIELDS to select, all if None
+        """
+        columns = _user_columns(fields)
+        conditions = ['({0}) >= start_block_num'.format(LATEST_BLOCK_NUM),
+                      '({0}) < end_block_num'.format(LATEST_BLOCK_NUM)]
+        if after is not None:
+            conditions.append('public_key > %(after)s')
 
-    # É usado username_or_public_key, porque algumas funções chamam
-    # fetch_auth_resource usando um dos dois, pode ser corrigido 
-    # criando outro fetch_auth
-    async def fetch_auth_resource(self, username_or_public_key):
         fetch = """
-        SELECT * FROM auth WHERE username='{}' OR public_key='{}'
-        """.format(username_or_public_key, username_or_public_key)
+        SELECT {0} FROM users
+        WHERE {1}
+        ORDER BY public_key
+        {2};
+        """.format(
+            columns,
+            ' AND '.join(conditions),
+            'LIMIT %(limit)s' if limit is not None else '')
 
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            await cursor.execute(fetch)
+        async with self._read_cursor() as cursor:
+            await cursor.execute(fetch, {'after': after, 'limit': limit})
+            return _rows_as_dicts(cursor, await cursor.fetchall())
+
+    async def fetch_auth_by_username(self, username):
+        fetch = """
+        SELECT * FROM auth WHERE username = %s
+        """
+
+        async with self._cursor(cursor_factory=RealDictCursor) as cursor:
+            await cursor.execute(fetch, (username,))
             return await cursor.fetchone()
 
-    async def fetch_sensor_resource(self, sensor_id):
+    async def fetch_auth_by_public_key(self, public_key):
+        fetch = """
+        SELECT * FROM auth WHERE public_key = %s
+        """
+
+        async with self._cursor(cursor_factory=RealDictCursor) as cursor:
+            await cursor.execute(fetch, (public_key,))
+            return await cursor.fetchone()
+
+    async def fetch_sensor_resource(self, sensor_id, measurements_since=None,
+                                    measurements_limit=None):
+        """Fetches a sensor with its locations, owners and measurement
+        history
+
+        Args:
+            sensor_id (str): The sensor to fetch
+            measurements_since (int): Only return measurements taken at or
+                after this Unix UTC timestamp
+            measurements_limit (int): Only return the most recent
+                measurements, up to this number
+        """
         fetch_sensor = """
         SELECT sensor_id FROM sensors
-        WHERE sensor_id='{0}'
-        AND ({1}) >= start_block_num
-        AND ({1}) < end_block_num;
-        """.format(sensor_id, LATEST_BLOCK_NUM)
+        WHERE sensor_id = %(sensor_id)s
+        AND ({0}) >= start_block_num
+        AND ({0}) < end_block_num;
+        """.format(LATEST_BLOCK_NUM)
 
         fetch_sensor_locations = """
         SELECT latitude, longitude, timestamp FROM sensor_locations
-        WHERE sensor_id='{0}'
-        AND ({1}) >= start_block_num
-        AND ({1}) < end_block_num;
-        """.format(sensor_id, LATEST_BLOCK_NUM)
+        WHERE sensor_id = %(sensor_id)s
+        AND ({0}) >= start_block_num
+        AND ({0}) < end_block_num;
+        """.format(LATEST_BLOCK_NUM)
 
         fetch_sensor_owners = """
         SELECT user_public_key, timestamp FROM sensor_owners
-        WHERE sensor_id='{0}'
-        AND ({1}) >= start_block_num
-        AND ({1}) < end_block_num;
-        """.format(sensor_id, LATEST_BLOCK_NUM)
-        
-        fetch_sensor_measurement = """
-        SELECT measurement, timestamp FROM measurements
-        WHERE sensor_id='{0}'
-        """.format(sensor_id, LATEST_BLOCK_NUM)
+        WHERE sensor_id = %(sensor_id)s
+        AND ({0}) >= start_block_num
+        AND ({0}) < end_block_num;
+        """.format(LATEST_BLOCK_NUM)
 
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            try:
-                await cursor.execute(fetch_sensor)
-                sensor = await cursor.fetchone()
+        fetch_sensor_measurement = _measurements_query(
+            ['sensor_id = %(sensor_id)s'],
+            measurements_since,
+            measurements_limit)
+        params = {
+            'sensor_id': sensor_id,
+            'measurements_since': measurements_since,
+            'measurements_limit': measurements_limit,
+        }
+
+        async with self._read_cursor() as cursor:
+            await cursor.execute(fetch_sensor, params)
+            row = await cursor.fetchone()
+            if row is None:
+                return None
+            sensor = {'sensor_id': row[0]}
 
-                await cursor.execute(fetch_sensor_locations)
-                sensor['locations'] = await cursor.fetchall()
+            await cursor.execute(fetch_sensor_locations, params)
+            sensor['locations'] = _rows_as_dicts(
+                cursor, await cursor.fetchall())
 
-                await cursor.execute(fetch_sensor_owners)
-                sensor['owners'] = await cursor.fetchall()
-                
-                await cursor.execute(fetch_sensor_measurement)
-                sensor['measurements'] = await cursor.fetchall()
+            await cursor.execute(fetch_sensor_owners, params)
+            sensor['owners'] = _rows_as_dicts(
+                cursor, await cursor.fetchall())
 
-                return sensor
-            except TypeError:
+            await cursor.execute(fetch_sensor_measurement, params)
+            # Skips the sensor_id column the query starts with
+            sensor['measurements'] = _rows_as_dicts(
+                cursor, await cursor.fetchall(), skip=1)
+
+            return sensor
+
+    async def fetch_sensor_measurements_resource(self, sensor_id, start=None,
+                                                 end=None, bucket=None):
+        """Fetches the measurement history of a sensor within a time window,
+        either raw or downsampled into buckets
+
+        Args:
+            sensor_id (str): The sensor to fetch measurements of
+            start (int): Unix UTC timestamp the window starts at, inclusive
+            end (int): Unix UTC timestamp the window ends at, exclusive
+            bucket (str): One of MEASUREMENT_BUCKETS to aggregate the
+                measurements into, raw measurements if None
+
+        Returns:
+            list: The measurements ordered by timestamp, or None if the
+                sensor does not exist
+        """
+        fetch_sensor = """
+        SELECT sensor_id FROM sensors
+        WHERE sensor_id = %(sensor_id)s
+        AND %(block_num)s >= start_block_num
+        AND %(block_num)s < end_block_num;
+        """
+
+        conditions = ['sensor_id = %(sensor_id)s',
+                      'start_block_num <= %(block_num)s']
+        if start is not None:
+            conditions.append('timestamp >= %(start)s')
+        if end is not None:
+            conditions.append('timestamp < %(end)s')
+
+        if bucket is None:
+            fetch_measurements = """
+            SELECT measurement, timestamp FROM measurements
+            WHERE {0}
+            ORDER BY timestamp, id;
+            """.format(' AND '.join(conditions))
+        else:
+            fetch_measurements = """
+            SELECT timestamp / %(bucket_seconds)s * %(bucket_seconds)s
+                       AS timestamp,
+                   COUNT(*) AS count,
+                   MIN(measurement) AS min,
+                   MAX(measurement) AS max,
+                   AVG(measurement) AS avg,
+                   SUM(measurement) AS sum
+            FROM measurements
+            WHERE {0}
+            GROUP BY 1
+            ORDER BY 1;
+            """.format(' AND '.join(conditions))
+
+        params = {
+            'sensor_id': sensor_id,
+            'start': start,
+            'end': end,
+            'bucket_seconds': MEASUREMENT_BUCKETS.get(bucket),
+        }
+
+        async with self._read_cursor() as cursor:
+            await cursor.execute(LATEST_BLOCK_NUM)
+            params['block_num'] = (await cursor.fetchone())[0]
+            if params['block_num'] is None:
                 return None
-            
-    
-    async def fetch_sensors_by_owner(self, user_public_key):
+
+            await cursor.execute(fetch_sensor, params)
+            if await cursor.fetchone() is None:
+                return None
+
+            await cursor.execute(fetch_measurements, params)
+            return _rows_as_dicts(cursor, await cursor.fetchall())
+
+    async def fetch_new_measurements(self, sensor_ids, after_block_num,
+                                     block_num):
+        """Fetches the measurements of sensor_ids written by the blocks after
+        after_block_num, up to block_num, ordered by id. Each comes with the
+        current owner of its sensor, once per owner
+
+        Returns:
+            list: Rows of id, sensor_id, user_public_key, measurement,
+                timestamp and block_num
+        """
+        fetch = """
+        SELECT measurements.id,
+               measurements.sensor_id,
+               owners.user_public_key,
+               measurements.measurement,
+               measurements.timestamp,
+               measurements.start_block_num AS block_num
+        FROM measurements
+        LEFT JOIN sensor_owners AS owners
+        ON owners.sensor_id = measurements.sensor_id
+        AND %(block_num)s >= owners.start_block_num
+        AND %(block_num)s < owners.end_block_num
+        WHERE measurements.sensor_id = ANY(%(sensor_ids)s)
+        AND measurements.start_block_num > %(after_block_num)s
+        AND measurements.start_block_num <= %(block_num)s
+        ORDER BY measurements.id;
+        """
+        params = {
+            'sensor_ids': sensor_ids,
+            'after_block_num': after_block_num,
+            'block_num': block_num,
+        }
+        async with self._read_cursor() as cursor:
+            await cursor.execute(fetch, params)
+            return _rows_as_dicts(cursor, await cursor.fetchall())
+
+    async def fetch_measurements_after(self, after_id, sensor_id=None,
+                                       user_public_key=None, limit=1000):
+        """Fetches up to limit measurements with an id greater than after_id,
+        of a sensor or of the sensors a user currently owns, ordered by id,
+        in the rows of fetch_new_measurements
+        """
+        if sensor_id is not None:
+            condition = 'measurements.sensor_id = %(sensor_id)s'
+        else:
+            condition = """measurements.sensor_id IN (
+                SELECT sensor_id FROM sensor_owners
+                WHERE user_public_key = %(user_public_key)s
+                AND %(block_num)s >= start_block_num
+                AND %(block_num)s < end_block_num)"""
+
+        fetch = """
+        SELECT measurements.id,
+               measurements.sensor_id,
+               NULL AS user_public_key,
+               measurements.measurement,
+               measurements.timestamp,
+               measurements.start_block_num AS block_num
+        FROM measurements
+        WHERE {0}
+        AND measurements.id > %(after_id)s
+        AND measurements.start_block_num <= %(block_num)s
+        ORDER BY measurements.id
+        LIMIT %(limit)s;
+        """.format(condition)
+        params = {
+            'sensor_id': sensor_id,
+            'user_public_key': user_public_key,
+            'after_id': after_id,
+            'limit': limit,
+        }
+        async with self._read_cursor() as cursor:
+            await cursor.execute(LATEST_BLOCK_NUM)
+            params['block_num'] = (await cursor.fetchone())[0]
+            if params['block_num'] is None:
+                return []
+            await cursor.execute(fetch, params)
+            return _rows_as_dicts(cursor, await cursor.fetchall())
+
+    async def fetch_owned_sensor_ids(self, user_public_keys):
+        """Fetches the ids of the sensors currently owned by any of
+        user_public_keys
+        """
+        fetch = """
+        SELECT DISTINCT sensor_id FROM sensor_owners
+        WHERE user_public_key = ANY(%(user_public_keys)s)
+        AND ({0}) >= start_block_num
+        AND ({0}) < end_block_num;
+        """.format(LATEST_BLOCK_NUM)
+        async with self._read_cursor() as cursor:
+            await cursor.execute(
+                fetch, {'user_public_keys': user_public_keys})
+            return [row[0] for row in await cursor.fetchall()]
+
+    async def fetch_sensors_by_owner(self, user_public_key, limit=None,
+                                     after=None):
+        conditions = [
+            "user_public_key = %(user_public_key)s",
+            '({0}) >= start_block_num'.format(LATEST_BLOCK_NUM),
+            '({0}) < end_block_num'.format(LATEST_BLOCK_NUM)]
+        if after is not None:
+            conditions.append('sensor_id > %(after)s')
+
         fetch_sensors = """
         SELECT sensor_id FROM sensor_owners
-        WHERE user_public_key='{0}'
-        AND ({1}) >= start_block_num
-        AND ({1}) < end_block_num;
-        """.format(user_public_key, LATEST_BLOCK_NUM)
-
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        WHERE {0}
+        ORDER BY sensor_id
+        {1};
+        """.format(
+            ' AND '.join(conditions),
+            'LIMIT %(limit)s' if limit is not None else '')
+        params = {
+            'user_public_key': user_public_key,
+            'after': after,
+            'limit': limit,
+        }
+
+        async with self._read_cursor() as cursor:
             try:
-                await cursor.execute(fetch_sensors)
-                return await cursor.fetchall()
+                await cursor.execute(fetch_sensors, params)
+                return _rows_as_dicts(cursor, await cursor.fetchall())
             except TypeError:
                 return []
-            
 
-    async def fetch_all_sensor_resources(self):
+    async def fetch_all_sensor_resources(self, limit=None, after=None,
+                                         fields=None, measurements_since=None,
+                                         measurements_limit=None):
+        """Fetches current sensors ordered by sensor_id, with their
+        locations, owners and measurements, using a fixed number of queries
+        all pinned to the same latest block
+
+        Args:
+            limit (int): Maximum number of sensors to return, all if None
+            after (str): Only return sensors with a greater sensor_id
+            fields (list of str): SENSOR_LIST_FIELDS to include, all if None
+            measurements_since (int): Only include measurements taken at or
+                after this Unix UTC timestamp
+            measurements_limit (int): Only include the most recent
+                measurements of each sensor, up to this number
+        """
+        conditions = ['%(block_num)s >= start_block_num',
+                      '%(block_num)s < end_block_num']
+        if after is not None:
+            conditions.append('sensor_id > %(after)s')
+
         fetch_sensors = """
         SELECT sensor_id FROM sensors
-        WHERE ({0}) >= start_block_num
-        AND ({0}) < end_block_num;
-        """.format(LATEST_BLOCK_NUM)
-
-        async with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            try:
-                await cursor.execute(fetch_sensors)
-                sensors = await cursor.fetchall()
-
-                for sensor in sensors:
-                    fetch_sensor_locations = """
-                    SELECT latitude, longitude, timestamp
-                    FROM sensor_locations
-                    WHERE sensor_id='{0}'
-                    AND ({1}) >= start_block_num
-                    AND ({1}) < end_block_num;
-                    """.format(sensor['sensor_id'], LATEST_BLOCK_NUM)
-
-                    fetch_sensor_owners = """
-                    SELECT user_public_key, timestamp
-                    FROM sensor_owners
-                    WHERE sensor_id='{0}'
-                    AND ({1}) >= start_block_num
-                    AND ({1}) < end_block_num;
-                    """.format(sensor['sensor_id'], LATEST_BLOCK_NUM)
-                    
-                    fetch_sensor_measurement = """
-                    SELECT measurement, timestamp
-                    FROM measurements
-                    WHERE sensor_id='{0}'
-                    AND ({1}) >= start_block_num
-                    AND ({1}) < end_block_num;
-                    """.format(sensor['sensor_id'], LATEST_BLOCK_NUM)
-
-                    await cursor.execute(fetch_sensor_locations)
-                    sensor['locations'] = await cursor.fetchall()
-
-                    await cursor.execute(fetch_sensor_owners)
-                    sensor['owners'] = await cursor.fetchall()
-                    
-                    await cursor.execute(fetch_sensor_measurement)
-                    sensor['measurements'] = await cursor.fetchall()
+        WHERE {0}
+        ORDER BY sensor_id
+        {1};
+        """.format(
+            ' AND '.join(conditions),
+            'LIMIT %(limit)s' if limit is not None else '')
+
+        # A page only needs the child rows of its own sensors
+        child_queries = _sensor_child_queries(
+            limit is not None, measurements_since, measurements_limit)
+
+        params = {
+            'after': after,
+            'limit': limit,
+            'measurements_since': measurements_since,
+            'measurements_limit': measurements_limit,
+        }
+
+        async with self._read_cursor() as cursor:
+            await cursor.execute(LATEST_BLOCK_NUM)
+            params['block_num'] = (await cursor.fetchone())[0]
+            if params['block_num'] is None:
+                return []
 
+            await cursor.execute(fetch_sensors, params)
+            sensors = [
+                {'sensor_id': row[0]} for row in await cursor.fetchall()]
+            if not sensors:
                 return sensors
-            except TypeError:
-                return []
+            params['sensor_ids'] = [sensor['sensor_id'] for sensor in sensors]
+            await _attach_sensor_children(
+                cursor, sensors, fields, child_queries, params)
+
+            return sensors
+
+    async def stream_all_sensor_resources(self, fields=None,
+                                          measurements_since=None,
+                                          measurements_limit=None,
+                                          batch_size=STREAM_BATCH_SIZE):
+        """Yields every current sensor, like fetch_all_sensor_resources, in
+        lists of up to batch_size sensors. Each list is read by its own
+        keyset query, so no connection is held while the caller writes a
+        list out to a client, however slowly the client reads.
+        """
+        after = None
+        while True:
+            sensors = await self.fetch_all_sensor_resources(
+                limit=batch_size,
+                after=after,
+                fields=fields,
+                measurements_since=measurements_since,
+                measurements_limit=measurements_limit)
+            if sensors:
+                yield sensors
+            if len(sensors) < batch_size:
+                return
+            after = sensors[-1]['sensor_id']
+
+    async def stream_all_user_resources(self, fields=None,
+                                        batch_size=STREAM_BATCH_SIZE):
+        """Yields every current user, like fetch_all_user_resources, in
+        lists of up to batch_size users, each read by its own keyset query
+        """
+        after = None
+        while True:
+            users = await self.fetch_all_user_resources(
+                limit=batch_size, after=after, fields=fields)
+            if users:
+                yield users
+            if len(users) < batch_size:
+                return
+            after = users[-1]['public_key']
+
+
+def _user_columns(fields):
+    return ', '.join(
+        field for field in USER_LIST_FIELDS
+        if fields is None or field in fields or field == 'public_key')
+
+
+def _sensor_child_queries(by_sensor_ids, measurements_since,
+                          measurements_limit):
+    """Builds the queries for the locations, owners and measurements of the
+    current sensors, or only of the sensors in %(sensor_ids)s
+    """
+    conditions = ['%(block_num)s >= start_block_num',
+                  '%(block_num)s < end_block_num']
+    if by_sensor_ids:
+        conditions.append('sensor_id = ANY(%(sensor_ids)s)')
+
+    return {
+        'locations': """
+        SELECT sensor_id, latitude, longitude, timestamp
+        FROM sensor_locations
+        WHERE {0}
+        ORDER BY sensor_id, id;
+        """.format(' AND '.join(conditions)),
+        'owners': """
+        SELECT sensor_id, user_public_key, timestamp
+        FROM sensor_owners
+        WHERE {0}
+        ORDER BY sensor_id, id;
+        """.format(' AND '.join(conditions)),
+        'measurements': _measurements_query(
+            conditions, measurements_since, measurements_limit),
+    }
+
+
+async def _attach_sensor_children(cursor, sensors, fields, child_queries,
+                                  params):
+    """Runs the requested child_queries and groups their rows into the
+    sensors they belong to
+    """
+    keys = [key for key in SENSOR_LIST_FIELDS[1:]
+            if fields is None or key in fields]
+    sensors_by_id = {}
+    for sensor in sensors:
+        for key in keys:
+            sensor[key] = []
+        sensors_by_id[sensor['sensor_id']] = sensor
+
+    for key in keys:
+        await cursor.execute(child_queries[key], params)
+        # Every child query selects the sensor_id first
+        names = _column_names(cursor)[1:]
+        for row in await cursor.fetchall():
+            sensor = sensors_by_id.get(row[0])
+            if sensor is not None:
+                sensor[key].append(dict(zip(names, row[1:])))
+
+
+def _measurements_query(conditions, measurements_since, measurements_limit):
+    """Builds the query for the measurements matching conditions, optionally
+    restricted to a start timestamp and to the most recent rows per sensor
+    """
+    conditions = list(conditions)
+    if measurements_since is not None:
+        conditions.append('timestamp >= %(measurements_since)s')
+
+    if measurements_limit is None:
+        return """
+        SELECT sensor_id, measurement, timestamp
+        FROM measurements
+        WHERE {0}
+        ORDER BY sensor_id, id;
+        """.format(' AND '.join(conditions))
+
+    return """
+    SELECT sensor_id, measurement, timestamp
+    FROM (
+        SELECT id, sensor_id, measurement, timestamp,
+               ROW_NUMBER() OVER (
+                   PARTITION BY sensor_id ORDER BY timestamp DESC, id DESC
+               ) AS recency
+        FROM measurements
+        WHERE {0}
+    ) AS recent
+    WHERE recency <= %(measurements_limit)s
+    ORDER BY sensor_id, id;
+    """.format(' AND '.join(conditions))
+
+
+def _column_names(cursor):
+    return [column[0] for column in cursor.description]
+
+
+def _rows_as_dicts(cursor, rows, skip=0):
+    """Turns the plain tuple rows of the last query of cursor into dicts
+    keyed by column name, leaving out the first skip columns. Cheaper than
+    a RealDictCursor, which builds every row item by item.
+    """
+    names = _column_names(cursor)[skip:]
+    return [dict(zip(names, row[skip:])) for row in rows]
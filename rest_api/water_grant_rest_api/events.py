@@ -0,0 +1,323 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import asyncio
+import json
+import logging
+
+import psycopg2
+
+from water_grant_rest_api.cache import CHANGES_CHANNEL
+from water_grant_rest_api.errors import ApiServiceUnavailable
+from water_grant_rest_api.serialization import dumps
+
+
+MAX_PENDING_EVENTS = 256
+REPLAY_LIMIT = 1000
+KEEPALIVE_EVENT = b': keepalive\n\n'
+LOGGER = logging.getLogger(__name__)
+
+
+def encode_measurement_event(row):
+    """Encodes a measurement row of the hub's queries as a server-sent
+    event, whose id lets a reconnecting client resume after it
+    """
+    return b''.join((
+        'id: {}\nevent: measurement\ndata: '.format(row['id']).encode(),
+        dumps({
+            'sensor_id': row['sensor_id'],
+            'measurement': row['measurement'],
+            'timestamp': row['timestamp'],
+            'block_num': row['block_num'],
+        }),
+        b'\n\n'))
+
+
+class EventStream(object):
+    """The events waiting to be written to one client. Events already
+    encoded by the hub are only referenced here, and a client too slow to
+    take max_pending of them is closed, to resume with Last-Event-ID.
+    """
+    __slots__ = ('topic', 'last_id', 'closed', '_pending', '_held',
+                 '_max_pending', '_wakeup')
+
+    def __init__(self, topic, max_pending=MAX_PENDING_EVENTS):
+        self.topic = topic
+        self.last_id = 0
+        self.closed = False
+        self._pending = []
+        self._held = None
+        self._max_pending = max_pending
+        self._wakeup = asyncio.Event()
+
+    def push(self, event, event_id=None):
+        """Queues an encoded event, skipping those with an id already
+        queued. Returns False if the stream was closed for falling behind
+        """
+        if self.closed:
+            return False
+        if self._held is not None:
+            self._held.append((event, event_id))
+            return True
+        if event_id is not None:
+            if event_id <= self.last_id:
+                return True
+            self.last_id = event_id
+        if len(self._pending) >= self._max_pending:
+            self.close()
+            return False
+        self._pending.append(event)
+        self._wakeup.set()
+        return True
+
+    def hold(self):
+        """Keeps live events aside while older ones are replayed
+        """
+        self._held = []
+
+    def release(self, replayed=()):
+        """Queues the replayed events, then the live ones kept aside while
+        they were read, which may repeat some of them
+        """
+        held, self._held = self._held or [], None
+        for event, event_id in list(replayed) + held:
+            self.push(event, event_id)
+
+    def close(self):
+        self.closed = True
+        self._wakeup.set()
+
+    async def next_events(self):
+        """Waits for events, returning all those queued at once, including
+        those queued before the stream was closed
+        """
+        await self._wakeup.wait()
+        self._wakeup.clear()
+        events, self._pending = self._pending, []
+        return events
+
+
+class SensorEventHub(object):
+    """Pushes the new measurements of sensors to the clients following them,
+    on 'sensor:<sensor_id>' or 'owner:<user_public_key>' topics.
+
+    The hub listens to the change notifications the subscriber sends with
+    every committed block, and for all clients at once reads the
+    measurements those blocks added to the sensors followed, with one query
+    per round of notifications. Each measurement is encoded once and the
+    same bytes are queued for every client following it, so an open stream
+    costs a list and an event until something is written to it.
+    """
+    def __init__(self, database, max_streams=10000, keepalive=15,
+                 retry_interval=5):
+        self._database = database
+        self._max_streams = max_streams
+        self._keepalive = keepalive
+        self._retry_interval = retry_interval
+        self._topics = {}
+        self._block_num = None
+        self._notified_block_num = None
+        self._changed_sensors = set()
+        self._unknown_changes = True
+        self._wakeup = asyncio.Event()
+        self.streams = 0
+        self.published = 0
+        self.overflowed = 0
+
+    def subscribe(self, topic):
+        if self.streams >= self._max_streams:
+            raise ApiServiceUnavailable(
+                'limite de streams de eventos atingido.')
+        stream = EventStream(topic)
+        self._topics.setdefault(topic, set()).add(stream)
+        self.streams += 1
+        return stream
+
+    def unsubscribe(self, stream):
+        streams = self._topics.get(stream.topic)
+        if streams is None or stream not in streams:
+            return
+        streams.remove(stream)
+        if not streams:
+            del self._topics[stream.topic]
+        self.streams -= 1
+
+    def close_all(self):
+        for streams in self._topics.values():
+            for stream in streams:
+                stream.close()
+
+    async def replay(self, stream, after_id):
+        """Queues the measurements of the stream's topic after the event id
+        a reconnecting client last received, before the live ones
+        """
+        kind, _, key = stream.topic.partition(':')
+        stream.hold()
+        replayed = []
+        try:
+            rows = await self._database.fetch_measurements_after(
+                after_id,
+                sensor_id=key if kind == 'sensor' else None,
+                user_public_key=key if kind == 'owner' else None,
+                limit=REPLAY_LIMIT)
+            replayed = [
+                (encode_measurement_event(row), row['id']) for row in rows]
+        finally:
+            stream.release(replayed)
+
+    async def run(self):
+        block_num = await self._database.fetch_latest_block_num()
+        # Before the first block, every measurement is new
+        self._block_num = block_num if block_num is not None else -1
+        await asyncio.gather(
+            self._listen(), self._publish_changes(), self._send_keepalives())
+
+    async def _listen(self):
+        while True:
+            try:
+                await self._database.listen(CHANGES_CHANNEL, self._notified)
+            except psycopg2.Error as err:
+                LOGGER.warning('Lost the change notifications: %s', err)
+            # Blocks may have been missed while not listening
+            self._unknown_changes = True
+            self._wakeup.set()
+            await asyncio.sleep(self._retry_interval)
+
+    def _notified(self, payload):
+        try:
+            changes = json.loads(payload)
+            block_num = changes['block_num']
+            keys = changes['keys']
+            fork = changes.get('fork', False)
+        except (ValueError, KeyError, TypeError):
+            LOGGER.warning(
+                'Ignoring malformed change notification: %s', payload)
+            return
+
+        if fork and self._block_num is not None:
+            # Measurements of the new branch are written from block_num on
+            self._block_num = min(self._block_num, block_num - 1)
+        previous = self._notified_block_num
+        if keys is None or fork or (
+                previous is not None and block_num > previous + 1):
+            self._unknown_changes = True
+        else:
+            self._changed_sensors.update(
+                key[len('sensor:'):] for key in keys
+                if key.startswith('sensor:'))
+        self._notified_block_num = block_num
+        self._wakeup.set()
+
+    async def _publish_changes(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                caught_up = await self.publish()
+            except psycopg2.Error as err:
+                LOGGER.warning('Unable to publish sensor events: %s', err)
+                self._unknown_changes = True
+                caught_up = False
+            if not caught_up:
+                await asyncio.sleep(0.1)
+                self._wakeup.set()
+
+    async def publish(self):
+        """Pushes the measurements of the blocks since the last round to
+        the streams following their sensor or its owner. Returns whether
+        the read database had reached the latest block notified
+        """
+        changed, self._changed_sensors = self._changed_sensors, set()
+        unknown, self._unknown_changes = self._unknown_changes, False
+        if not self._topics:
+            # Nobody follows a sensor, only the position moves on
+            if self._notified_block_num is not None:
+                self._block_num = max(
+                    self._block_num, self._notified_block_num)
+            return True
+
+        block_num = await self._database.fetch_latest_block_num()
+        caught_up = block_num is not None and (
+            self._notified_block_num is None
+            or block_num >= self._notified_block_num)
+        if not caught_up:
+            # The read replica is behind, the changes are read once it is not
+            self._changed_sensors.update(changed)
+            self._unknown_changes = self._unknown_changes or unknown
+        if block_num is None or block_num <= self._block_num:
+            return caught_up
+
+        watched_sensors = set()
+        watched_owners = []
+        for topic in self._topics:
+            kind, _, key = topic.partition(':')
+            if kind == 'sensor':
+                watched_sensors.add(key)
+            else:
+                watched_owners.append(key)
+
+        if unknown:
+            sensor_ids = watched_sensors
+            if watched_owners:
+                sensor_ids = sensor_ids | set(
+                    await self._database.fetch_owned_sensor_ids(
+                        watched_owners))
+        elif watched_owners:
+            # The owners of the changed sensors are only known by querying
+            sensor_ids = changed
+        else:
+            sensor_ids = changed & watched_sensors
+
+        rows = []
+        if sensor_ids:
+            rows = await self._database.fetch_new_measurements(
+                list(sensor_ids), self._block_num, block_num)
+        self._block_num = block_num
+
+        encoded = {}
+        for row in rows:
+            event = encoded.get(row['id'])
+            if event is None:
+                event = encode_measurement_event(row)
+                encoded[row['id']] = event
+                self.published += 1
+            self._push('sensor:' + row['sensor_id'], event, row['id'])
+            if row['user_public_key'] is not None:
+                self._push('owner:' + row['user_public_key'], event, row['id'])
+        return caught_up
+
+    def _push(self, topic, event, event_id):
+        for stream in list(self._topics.get(topic, ())):
+            if not stream.push(event, event_id):
+                self.overflowed += 1
+                self.unsubscribe(stream)
+
+    async def _send_keepalives(self):
+        # Keeps proxies from closing streams of sensors that rarely report
+        while True:
+            await asyncio.sleep(self._keepalive)
+            for streams in list(self._topics.values()):
+                for stream in list(streams):
+                    stream.push(KEEPALIVE_EVENT)
+
+    def snapshot(self):
+        return {
+            'streams': self.streams,
+            'max_streams': self._max_streams,
+            'topics': len(self._topics),
+            'block_num': self._block_num,
+            'published': self.published,
+            'overflowed': self.overflowed,
+        }
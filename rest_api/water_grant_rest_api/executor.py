@@ -0,0 +1,101 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+
+POOL_KINDS = ('thread', 'process')
+
+
+class CryptoExecutor(object):
+    """Runs CPU-bound crypto (bcrypt, AES, secp256k1 signing) in a worker
+    pool, so it does not stall the event loop, recording how long each
+    call waited for a free worker.
+
+    bcrypt and AES calls go to a thread or process pool. Signing always
+    runs in threads, because signers are cached in this process and hold a
+    native secp256k1 context that can not be sent to another process. The
+    crypto libraries release the GIL while they work, so threads run them
+    in parallel.
+    """
+    def __init__(self, loop, workers=None, kind='thread', window=1000):
+        self._loop = loop
+        self._kind = kind
+        self._workers = workers or os.cpu_count()
+        if kind == 'process':
+            self._pool = ProcessPoolExecutor(self._workers)
+            self._signing_pool = ThreadPoolExecutor(self._workers)
+        else:
+            self._pool = ThreadPoolExecutor(self._workers)
+            self._signing_pool = self._pool
+        self._queue_times = deque(maxlen=window)
+        self.pending = 0
+        self.completed = 0
+
+    async def run(self, func, *args):
+        """Runs func(*args) in the pool. func and args must be picklable
+        when it is a process pool
+        """
+        return await self._submit(self._pool, func, args)
+
+    async def run_signing(self, func, *args):
+        """Runs func(*args), which signs with in-process signers, in threads
+        """
+        return await self._submit(self._signing_pool, func, args)
+
+    async def _submit(self, pool, func, args):
+        self.pending += 1
+        submitted_at = time.time()
+        try:
+            started_at, result = await self._loop.run_in_executor(
+                pool, _timed_call, func, args)
+        finally:
+            self.pending -= 1
+        self._queue_times.append(started_at - submitted_at)
+        self.completed += 1
+        return result
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+        if self._signing_pool is not self._pool:
+            self._signing_pool.shutdown(wait=False)
+
+    def snapshot(self):
+        queue_times = sorted(self._queue_times)
+
+        def queue_ms(fraction):
+            if not queue_times:
+                return None
+            index = min(len(queue_times) - 1,
+                        int(round(fraction * (len(queue_times) - 1))))
+            return queue_times[index] * 1000
+
+        return {
+            'kind': self._kind,
+            'workers': self._workers,
+            'pending': self.pending,
+            'completed': self.completed,
+            'queue_ms_p50': queue_ms(0.5),
+            'queue_ms_p99': queue_ms(0.99),
+            'queue_ms_max': queue_ms(1),
+        }
+
+
+def _timed_call(func, args):
+    return time.time(), func(*args)
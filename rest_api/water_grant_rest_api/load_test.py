@@ -0,0 +1,152 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Drives GET requests against a running Water Grant REST API at increasing
+concurrency levels and reports throughput and latency percentiles for each.
+With --login-concurrency the reads run during a storm of logins, showing how
+much the bcrypt checks of /authentication delay them.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+
+import aiohttp
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Load tests the Water Grant REST API')
+    parser.add_argument(
+        '-U', '--url',
+        help='Base url of the REST API',
+        default='http://water-grant-rest-api:8000')
+    parser.add_argument(
+        '-p', '--path',
+        help='Path to request, may be given several times',
+        action='append')
+    parser.add_argument(
+        '-c', '--concurrency',
+        help='Comma separated concurrency levels to run',
+        default='1,4,16,64')
+    parser.add_argument(
+        '--login-concurrency',
+        help='Clients posting /authentication in a loop while the reads '
+             'are measured, to load the crypto pool',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--login-username',
+        help='Username the login clients authenticate as',
+        default='admin')
+    parser.add_argument(
+        '--login-password',
+        help='Password the login clients authenticate with',
+        default='admin')
+    parser.add_argument(
+        '-d', '--duration',
+        help='Seconds to run each concurrency level',
+        type=float,
+        default=10)
+    return parser.parse_args(args)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def _worker(session, urls, deadline, latencies, errors):
+    index = 0
+    while time.perf_counter() < deadline:
+        url = urls[index % len(urls)]
+        index += 1
+        start = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                if response.status >= 400:
+                    errors.append(response.status)
+                    continue
+        except aiohttp.ClientError as err:
+            errors.append(err)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+async def _login_worker(session, url, credentials, deadline):
+    while time.perf_counter() < deadline:
+        try:
+            async with session.post(url, json=credentials) as response:
+                await response.read()
+        except aiohttp.ClientError:
+            pass
+
+
+async def run_level(url, paths, concurrency, duration, login_concurrency=0,
+                    credentials=None):
+    """Runs one concurrency level and returns (requests/s, latencies, errors)
+    of the reads. login_concurrency clients authenticate with credentials
+    meanwhile, their requests are not measured.
+    """
+    urls = [url.rstrip('/') + path for path in paths]
+    login_url = url.rstrip('/') + '/authentication'
+    latencies = []
+    errors = []
+    connector = aiohttp.TCPConnector(limit=concurrency + login_concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        deadline = time.perf_counter() + duration
+        await asyncio.gather(*(
+            [_worker(session, urls, deadline, latencies, errors)
+             for _ in range(concurrency)]
+            + [_login_worker(session, login_url, credentials, deadline)
+               for _ in range(login_concurrency)]))
+    return len(latencies) / duration, latencies, errors
+
+
+def report(concurrency, throughput, latencies, errors):
+    print('{:>6} {:>10.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7}'.format(
+        concurrency,
+        throughput,
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        max(latencies or [float('nan')]) * 1000,
+        len(errors)))
+
+
+def main():
+    opts = parse_args(sys.argv[1:])
+    paths = opts.path or ['/sensors']
+    loop = asyncio.get_event_loop()
+
+    print('{:>6} {:>10} {:>9} {:>9} {:>9} {:>7}'.format(
+        'conc', 'req/s', 'p50 ms', 'p99 ms', 'max ms', 'errors'))
+    for concurrency in [int(c) for c in opts.concurrency.split(',')]:
+        throughput, latencies, errors = loop.run_until_complete(
+            run_level(
+                opts.url,
+                paths,
+                concurrency,
+                opts.duration,
+                login_concurrency=opts.login_concurrency,
+                credentials={
+                    'username': opts.login_username,
+                    'password': opts.login_password,
+                }))
+        report(concurrency, throughput, latencies, errors)
@@ -16,19 +16,20 @@
 import argparse
 import asyncio
 import logging
+import os
+import signal
+import socket
 import sys
+import time
 
-from zmq.asyncio import ZMQEventLoop
-
-from sawtooth_sdk.processor.log import init_console_logging
-
-from aiohttp import web
-
-from water_grant_rest_api.route_handler import RouteHandler
-from water_grant_rest_api.database import Database
-from water_grant_rest_api.messaging import Messenger
+from water_grant_rest_api.executor import POOL_KINDS
+from water_grant_rest_api.serialization import SERIALIZERS
+from water_grant_rest_api.serialization import set_serializer
 
 
+# How ValidatorPool spreads requests. Kept here, as validator_pool imports
+# the validator messaging and protobuf modules
+DISPATCH_POLICIES = ('round-robin', 'least-pending')
 LOGGER = logging.getLogger(__name__)
 
 
@@ -42,8 +43,19 @@ def parse_args(args):
         default='water-grant-rest-api:8000')
     parser.add_argument(
         '-C', '--connect',
-        help='specify URL to connect to a running validator',
+        help='specify URL to connect to a running validator, or a comma '
+             'separated list of URLs to spread requests over',
         default='tcp://validator:4004')
+    parser.add_argument(
+        '--validator-dispatch',
+        help='How requests are spread over the validators',
+        choices=DISPATCH_POLICIES,
+        default='round-robin')
+    parser.add_argument(
+        '--validator-health-interval',
+        help='Seconds between health checks of the validators',
+        type=float,
+        default=5)
     parser.add_argument(
         '-t', '--timeout',
         help='set time (in seconds) to wait for a validator response',
@@ -60,6 +72,142 @@ def parse_args(args):
         '--db-port',
         help='The port of the database',
         default='5432')
+    parser.add_argument(
+        '--db-read-host',
+        help='The host of a read replica to serve queries from',
+        default=None)
+    parser.add_argument(
+        '--db-read-port',
+        help='The port of the read replica (defaults to --db-port)',
+        default=None)
+    parser.add_argument(
+        '--db-pool-min-size',
+        help='Connections kept open in each database pool',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--db-pool-max-size',
+        help='Maximum connections in each database pool',
+        type=int,
+        default=10)
+    parser.add_argument(
+        '--db-acquire-timeout',
+        help='Seconds a request waits for a free database connection',
+        type=float,
+        default=10)
+    parser.add_argument(
+        '--db-pool-recycle',
+        help='Seconds after which idle connections are reopened '
+             '(-1 never recycles)',
+        type=float,
+        default=-1)
+    parser.add_argument(
+        '--consistency-timeout',
+        help='Seconds a read with min_block_num waits for the database',
+        type=float,
+        default=5)
+    parser.add_argument(
+        '--cache-size',
+        help='Responses kept in the in-process cache (0 disables it)',
+        type=int,
+        default=10000)
+    parser.add_argument(
+        '--cache-ttl',
+        help='Seconds a cached response is served at most',
+        type=float,
+        default=60)
+    parser.add_argument(
+        '--cache-poll-interval',
+        help='Seconds between checks of the latest block for the cache',
+        type=float,
+        default=0.5)
+    parser.add_argument(
+        '--auth-cache-size',
+        help='Accounts whose auth row and signing key are kept in memory '
+             '(0 disables the auth cache)',
+        type=int,
+        default=1000)
+    parser.add_argument(
+        '--auth-cache-ttl',
+        help='Seconds an account is served from the auth cache at most',
+        type=float,
+        default=300)
+    parser.add_argument(
+        '--signer-cache-size',
+        help='Transaction signers kept ready for reuse',
+        type=int,
+        default=1000)
+    parser.add_argument(
+        '--crypto-pool',
+        help='Pool bcrypt and AES run in, signing always runs in threads',
+        choices=POOL_KINDS,
+        default='thread')
+    parser.add_argument(
+        '--crypto-workers',
+        help='Workers of the crypto pool (defaults to the number of cores)',
+        type=int,
+        default=None)
+    parser.add_argument(
+        '--batch-poll-interval',
+        help='Seconds between status checks of batches submitted with '
+             'Prefer: respond-async',
+        type=float,
+        default=0.5)
+    parser.add_argument(
+        '--batch-status-ttl',
+        help='Seconds the status of an asynchronous batch is kept',
+        type=float,
+        default=600)
+    parser.add_argument(
+        '--coalesce-window-ms',
+        help='Milliseconds sensor updates are collected to be submitted '
+             'together (0 submits each on its own)',
+        type=float,
+        default=5)
+    parser.add_argument(
+        '--coalesce-max-size',
+        help='Sensor updates submitted together at most',
+        type=int,
+        default=100)
+    parser.add_argument(
+        '--max-request-size',
+        help='Largest request body accepted, in bytes, after inflating gzip',
+        type=int,
+        default=16 * 1024 * 1024)
+    parser.add_argument(
+        '--compress-min-size',
+        help='Smallest JSON response body compressed with gzip, or brotli '
+             'if installed, in bytes (0 disables compression)',
+        type=int,
+        default=1024)
+    parser.add_argument(
+        '--max-event-streams',
+        help='Server-sent event streams of sensor readings served at once '
+             '(0 disables them)',
+        type=int,
+        default=10000)
+    parser.add_argument(
+        '--event-keepalive',
+        help='Seconds between keepalive comments on idle event streams',
+        type=float,
+        default=15)
+    parser.add_argument(
+        '--json-serializer',
+        help='Encoder of the JSON responses, auto picks orjson if installed',
+        choices=SERIALIZERS,
+        default='auto')
+    parser.add_argument(
+        '--workers',
+        help='Processes serving the API on the same port with SO_REUSEPORT, '
+             'each with its own database pools and validator connections',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--startup-timeout',
+        help='Seconds to wait for a validator before binding, after which '
+             'the API starts with /readyz failing until one answers',
+        type=float,
+        default=30)
     parser.add_argument(
         '--db-user',
         help='The authorized user of the database',
@@ -77,20 +225,83 @@ def parse_args(args):
     return parser.parse_args(args)
 
 
-def start_rest_api(host, port, messenger, database):
+async def wait_until_ready(messenger, database, startup_timeout, startup):
+    """Connects the database pools and waits for a validator, recording
+    how long each took in startup
+    """
+    started_at = time.time()
+    await database.connect()
+    startup['database_s'] = time.time() - started_at
+
+    started_at = time.time()
+    if not await messenger.wait_for_validators(startup_timeout):
+        LOGGER.warning(
+            'No validator answered within %s s, starting as not ready',
+            startup_timeout)
+    startup['validators_s'] = time.time() - started_at
+
+
+def start_rest_api(host, port, messenger, database, consistency_timeout,
+                   cache=None, cache_poll_interval=0.5, auth_cache=None,
+                   executor=None, tracker=None, coalescer=None,
+                   events=None,
+                   validator_health_interval=5,
+                   max_request_size=1024 ** 2, startup_timeout=30,
+                   startup=None, reuse_port=None, compress_min_size=0,
+                   compressed_cache=None):
+    from aiohttp import web
+
+    from water_grant_rest_api.cache import listen_for_changes
+    from water_grant_rest_api.compression import compression_middleware
+    from water_grant_rest_api.cache import watch_blocks
+    from water_grant_rest_api.route_handler import RouteHandler
+
+    startup = startup if startup is not None else {}
     loop = asyncio.get_event_loop()
-    asyncio.ensure_future(database.connect())
 
-    app = web.Application(loop=loop)
+    # Only bind once the database and a validator answer, so a restarted
+    # instance does not take requests it can not serve yet
+    messenger.open_validator_connection()
+    loop.run_until_complete(
+        wait_until_ready(messenger, database, startup_timeout, startup))
+
+    asyncio.ensure_future(
+        messenger.check_validators(validator_health_interval))
+    if cache is not None:
+        asyncio.ensure_future(
+            watch_blocks(cache, database, cache_poll_interval))
+        asyncio.ensure_future(listen_for_changes(cache, database))
+    if tracker is not None:
+        messenger.set_tracker(tracker)
+        asyncio.ensure_future(tracker.run())
+    if coalescer is not None:
+        messenger.set_coalescer(coalescer)
+    if events is not None:
+        asyncio.ensure_future(events.run())
+
+    middlewares = []
+    if compress_min_size > 0:
+        middlewares.append(
+            compression_middleware(compress_min_size, compressed_cache))
+    app = web.Application(
+        loop=loop,
+        client_max_size=max_request_size,
+        middlewares=middlewares)
     # PERIGO: ARMAZENAMENTO DE CHAVE INSEGURO
     # Em uma aplicação de produção, essas chaves devem ser passadas de forma mais segura
     app['aes_key'] = 'ffffffffffffffffffffffffffffffff'
     app['secret_key'] = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890'
+    app['consistency_timeout'] = consistency_timeout
+    app['compress_min_size'] = compress_min_size
 
-    messenger.open_validator_connection()
-
-    handler = RouteHandler(loop, messenger, database)
+    handler = RouteHandler(
+        loop, messenger, database, cache, auth_cache, executor, tracker,
+        coalescer, events)
+    handler.startup = startup
+    app.router.add_get('/healthz', handler.healthz)
+    app.router.add_get('/readyz', handler.readyz)
     app.router.add_post('/sensors/{sensor_id}/update', handler.update_sensor)
+    app.router.add_post('/sensors/readings:bulk', handler.update_sensors_bulk)
     app.router.add_post('/authentication', handler.authenticate)
     app.router.add_post('/admins', handler.create_admin)
     app.router.add_post('/users', handler.create_user)
@@ -98,6 +309,8 @@ def start_rest_api(host, port, messenger, database):
     app.router.add_get('/users/{user_public_key}', handler.fetch_user)
     app.router.add_get('/users/usage/{user_public_key}',
                        handler.fetch_user_quota_usage)
+    app.router.add_get('/users/usage/{user_public_key}/history',
+                       handler.fetch_user_usage_history)
     app.router.add_post('/users/{user_public_key}/update', handler.update_user)
 
     app.router.add_post('/sensors', handler.create_sensor)
@@ -105,33 +318,176 @@ def start_rest_api(host, port, messenger, database):
     app.router.add_get('/sensors/owner/{user_public_key}',
                        handler.list_sensors_by_owner)
     app.router.add_get('/sensors/{sensor_id}', handler.fetch_sensor)
+    app.router.add_get('/sensors/{sensor_id}/measurements',
+                       handler.fetch_sensor_measurements)
+    app.router.add_get('/sensors/{sensor_id}/events',
+                       handler.stream_sensor_events)
+    app.router.add_get('/sensors/owner/{user_public_key}/events',
+                       handler.stream_owner_events)
+    app.router.add_get('/batches/{batch_id}/status',
+                       handler.fetch_batch_status)
+    app.router.add_get('/metrics', handler.fetch_metrics)
     # Transferência de sensores desativada.
     # app.router.add_post(
     #     '/sensors/{sensor_id}/transfer', handler.transfer_sensor)
 
 
+    async def stop_taking_traffic(_app):
+        handler.set_ready(False)
+        if events is not None:
+            # Event streams never end on their own
+            events.close_all()
+
+    async def take_traffic(_app):
+        handler.set_ready(True)
+        if 'started_at' in startup:
+            startup['total_s'] = time.time() - startup.pop('started_at')
+        print('Water Grant REST API ready on {}:{} after {:.2f} s'.format(
+            host, port, startup.get('total_s', 0)))
+
+    app.on_startup.append(take_traffic)
+    app.on_shutdown.append(stop_taking_traffic)
+
     print('Starting Water Grant REST API on %s:%s', host, port)
     web.run_app(
         app,
         host=host,
         port=port,
         access_log=LOGGER,
-        access_log_format='%r: %s status, %b size, in %Tf s')
+        access_log_format='%r: %s status, %b size, in %Tf s',
+        reuse_port=reuse_port)
 
 
 def main():
+    startup = {'started_at': time.time()}
+    opts = parse_args(sys.argv[1:])
+
+    try:
+        host, port = opts.bind.split(":")
+        port = int(port)
+    except ValueError:
+        print("Unable to parse binding {}: Must be in the format"
+              " host:port".format(opts.bind))
+        sys.exit(1)
+
+    try:
+        # Selected before forking, so the workers inherit it
+        print('Encoding JSON with {}'.format(
+            set_serializer(opts.json_serializer)))
+    except ValueError as err:
+        print(err)
+        sys.exit(1)
+
+    if opts.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            print('--workers needs SO_REUSEPORT, missing on this platform')
+            sys.exit(1)
+        run_workers(opts, host, port)
+    else:
+        serve(opts, host, port, startup)
+
+
+def run_workers(opts, host, port):
+    """Forks opts.workers processes serving the API, restarting those that
+    exit until SIGTERM or SIGINT, which are forwarded to them
+    """
+    if opts.crypto_workers is None:
+        # Share the cores among the workers instead of one pool thread per
+        # core in each of them
+        opts.crypto_workers = max(1, os.cpu_count() // opts.workers)
+
+    workers = {}
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                startup = {
+                    'started_at': time.time(),
+                    'worker': index,
+                    'pid': os.getpid(),
+                }
+                serve(opts, host, port, startup, reuse_port=True)
+            except SystemExit as err:
+                code = err.code if isinstance(err.code, int) else 1
+            finally:
+                os._exit(code)
+        workers[pid] = index
+
+    def stop(_signum, _frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(opts.workers):
+        spawn(index)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print('Started {} workers on {}:{}'.format(opts.workers, host, port))
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        print('Worker {} exited with status {}, restarting it'.format(
+            index, status))
+        time.sleep(1)
+        spawn(index)
+
+
+def serve(opts, host, port, startup, reuse_port=None):
+    # Imported once the arguments are parsed, so --help and invalid
+    # arguments answer at once, and timed as part of the startup
+    from zmq.asyncio import ZMQEventLoop
+
+    from sawtooth_sdk.processor.log import init_console_logging
+
+    from water_grant_rest_api.batch_tracker import BatchStatusTracker
+    from water_grant_rest_api.cache import LRUCache
+    from water_grant_rest_api.cache import ResponseCache
+    from water_grant_rest_api.coalescer import SubmitCoalescer
+    from water_grant_rest_api.database import Database
+    from water_grant_rest_api.events import SensorEventHub
+    from water_grant_rest_api.executor import CryptoExecutor
+    from water_grant_rest_api.messaging import Messenger
+    startup['imports_s'] = time.time() - startup['started_at']
+
     loop = ZMQEventLoop()
     asyncio.set_event_loop(loop)
 
+    # Bound as startup goes, cleanup only covers what was created
+    executor = None
+    messenger = None
+    database = None
     try:
-        opts = parse_args(sys.argv[1:])
         print(opts)
         init_console_logging(verbose_level=opts.verbose)
 
-        validator_url = opts.connect
-        if "tcp://" not in validator_url:
-            validator_url = "tcp://" + validator_url
-        messenger = Messenger(validator_url)
+        validator_urls = []
+        for validator_url in opts.connect.split(','):
+            validator_url = validator_url.strip()
+            if "tcp://" not in validator_url:
+                validator_url = "tcp://" + validator_url
+            validator_urls.append(validator_url)
+        executor = CryptoExecutor(
+            loop, workers=opts.crypto_workers, kind=opts.crypto_pool)
+        messenger = Messenger(
+            validator_urls,
+            opts.signer_cache_size,
+            executor=executor,
+            dispatch=opts.validator_dispatch)
 
         database = Database(
             opts.db_host,
@@ -139,20 +495,69 @@ def main():
             opts.db_name,
             opts.db_user,
             opts.db_password,
-            loop)
+            loop,
+            read_host=opts.db_read_host,
+            read_port=opts.db_read_port,
+            pool_min_size=opts.db_pool_min_size,
+            pool_max_size=opts.db_pool_max_size,
+            acquire_timeout=opts.db_acquire_timeout,
+            pool_recycle=opts.db_pool_recycle)
 
-        try:
-            host, port = opts.bind.split(":")
-            port = int(port)
-        except ValueError:
-            print("Unable to parse binding {}: Must be in the format"
-                  " host:port".format(opts.bind))
-            sys.exit(1)
+        cache = None
+        if opts.cache_size > 0:
+            cache = ResponseCache(opts.cache_size, opts.cache_ttl)
+        compressed_cache = None
+        if opts.cache_size > 0:
+            compressed_cache = LRUCache(opts.cache_size, opts.cache_ttl)
+        auth_cache = None
+        if opts.auth_cache_size > 0:
+            auth_cache = LRUCache(opts.auth_cache_size, opts.auth_cache_ttl)
+        tracker = BatchStatusTracker(
+            messenger.fetch_batch_statuses,
+            interval=opts.batch_poll_interval,
+            ttl=opts.batch_status_ttl)
+        events = None
+        if opts.max_event_streams > 0:
+            events = SensorEventHub(
+                database,
+                max_streams=opts.max_event_streams,
+                keepalive=opts.event_keepalive)
+        coalescer = None
+        if opts.coalesce_window_ms > 0:
+            coalescer = SubmitCoalescer(
+                loop,
+                messenger.submit_batches,
+                messenger.wait_for_commits,
+                window=opts.coalesce_window_ms / 1000,
+                max_size=opts.coalesce_max_size)
 
-        start_rest_api(host, port, messenger, database)
+        start_rest_api(
+            host,
+            port,
+            messenger,
+            database,
+            opts.consistency_timeout,
+            cache=cache,
+            cache_poll_interval=opts.cache_poll_interval,
+            auth_cache=auth_cache,
+            executor=executor,
+            tracker=tracker,
+            coalescer=coalescer,
+            events=events,
+            validator_health_interval=opts.validator_health_interval,
+            max_request_size=opts.max_request_size,
+            startup_timeout=opts.startup_timeout,
+            startup=startup,
+            reuse_port=reuse_port,
+            compress_min_size=opts.compress_min_size,
+            compressed_cache=compressed_cache)
     except Exception as err:  # pylint: disable=broad-except
         print(err)
         sys.exit(1)
     finally:
-        database.disconnect()
-        messenger.close_validator_connection()
+        if database is not None:
+            database.disconnect()
+        if messenger is not None:
+            messenger.close_validator_connection()
+        if executor is not None:
+            executor.shutdown()
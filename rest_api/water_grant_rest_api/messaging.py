@@ -13,7 +13,11 @@
 # limitations under the License.
 # ------------------------------------------------------------------------------
 
-from sawtooth_rest_api.messaging import Connection
+import asyncio
+import binascii
+import functools
+import hashlib
+
 from sawtooth_rest_api.protobuf import client_batch_submit_pb2
 from sawtooth_rest_api.protobuf import validator_pb2
 
@@ -21,8 +25,11 @@ from sawtooth_signing import create_context
 from sawtooth_signing import CryptoFactory
 from sawtooth_signing import secp256k1
 
+from water_grant_rest_api.cache import LRUCache
 from water_grant_rest_api.errors import ApiBadRequest
 from water_grant_rest_api.errors import ApiInternalError
+from water_grant_rest_api.errors import ApiServiceUnavailable
+from water_grant_rest_api.validator_pool import ValidatorPool
 from water_grant_rest_api.transaction_creation import \
     make_create_admin_transaction
 from water_grant_rest_api.transaction_creation import \
@@ -34,17 +41,42 @@ from water_grant_rest_api.transaction_creation import \
 # Transferência de sensores desativada.
 # from water_grant_rest_api.transaction_creation import \
 #     make_transfer_sensor_transaction
+from water_grant_rest_api.transaction_creation import \
+    make_update_sensor_batches
 from water_grant_rest_api.transaction_creation import \
     make_update_sensor_transaction
 
 
+BULK_SUBMIT_SIZE = 100
+
+
+class CachedSigner(object):
+    """Wraps a sawtooth_signing.Signer, computing its public key hex once
+    """
+    def __init__(self, signer):
+        self._signer = signer
+        self.public_key_hex = signer.get_public_key().as_hex()
+
+    def sign(self, message):
+        return self._signer.sign(message)
+
+    def get_public_key(self):
+        return self._signer.get_public_key()
+
+
 class Messenger(object):
-    def __init__(self, validator_url):
-        self._connection = Connection(validator_url)
+    def __init__(self, validator_urls, signer_cache_size=1000, executor=None,
+                 dispatch='round-robin'):
+        self._connection = ValidatorPool(validator_urls, dispatch)
+        self._executor = executor
+        self._tracker = None
+        self._coalescer = None
         self._context = create_context('secp256k1')
         self._crypto_factory = CryptoFactory(self._context)
-        self._batch_signer = self._crypto_factory.new_signer(
-            self._context.new_random_private_key())
+        self._batch_signer = CachedSigner(self._crypto_factory.new_signer(
+            self._context.new_random_private_key()))
+        # Signers never go stale, entries only leave when evicted
+        self._signers = LRUCache(signer_cache_size, float('inf'))
 
     def open_validator_connection(self):
         self._connection.open()
@@ -52,6 +84,18 @@ class Messenger(object):
     def close_validator_connection(self):
         self._connection.close()
 
+    async def check_validators(self, interval):
+        await self._connection.check_health(interval)
+
+    async def wait_for_validators(self, timeout):
+        return await self._connection.wait_ready(timeout)
+
+    def validators_ready(self):
+        return self._connection.is_ready()
+
+    def validators_snapshot(self):
+        return self._connection.snapshot()
+
     def get_new_key_pair(self):
         private_key = self._context.new_random_private_key()
         public_key = self._context.get_public_key(private_key)
@@ -61,49 +105,52 @@ class Messenger(object):
     async def send_create_admin_transaction(self,
                                             private_key,
                                             name,
-                                            timestamp):
-        transaction_signer = self._crypto_factory.new_signer(
-            secp256k1.Secp256k1PrivateKey.from_hex(private_key))
-        batch = make_create_admin_transaction(
+                                            timestamp,
+                                            wait=True):
+        transaction_signer = self.get_signer(private_key)
+        batch = await self._make_batch(
+            make_create_admin_transaction,
             transaction_signer=transaction_signer,
             batch_signer=self._batch_signer,
             name=name,
             timestamp=timestamp)
-        await self._send_and_wait_for_commit(batch)
+        return await self._send(batch, wait)
 
     async def send_create_user_transaction(self,
                                             private_key,
                                             name,
                                             timestamp,
-                                            admin_public_key):
-        transaction_signer = self._crypto_factory.new_signer(
-            secp256k1.Secp256k1PrivateKey.from_hex(private_key))
+                                            admin_public_key,
+                                            wait=True):
+        transaction_signer = self.get_signer(private_key)
         print('No messaging.py')
-        batch = make_create_user_transaction(
+        batch = await self._make_batch(
+            make_create_user_transaction,
             transaction_signer=transaction_signer,
             batch_signer=self._batch_signer,
             name=name,
             timestamp=timestamp,
             quota=0,
             admin_public_key=admin_public_key)
-        await self._send_and_wait_for_commit(batch)
+        return await self._send(batch, wait)
 
     async def send_update_user_transaction(self,
                                              private_key,
                                              quota,
                                              user_public_key,
                                              timestamp,
-                                             admin_public_key):
-        transaction_signer = self._crypto_factory.new_signer(
-            secp256k1.Secp256k1PrivateKey.from_hex(private_key))
-        batch = make_update_user_transaction(
+                                             admin_public_key,
+                                             wait=True):
+        transaction_signer = self.get_signer(private_key)
+        batch = await self._make_batch(
+            make_update_user_transaction,
             transaction_signer=transaction_signer,
             batch_signer=self._batch_signer,
             quota=quota,
             user_public_key=user_public_key,
             timestamp=timestamp,
             admin_public_key=admin_public_key)
-        await self._send_and_wait_for_commit(batch)
+        return await self._send(batch, wait)
 
     async def send_create_sensor_transaction(self,
                                              private_key,
@@ -111,11 +158,12 @@ class Messenger(object):
                                              latitude,
                                              longitude,
                                              sensor_id,
-                                             timestamp):
-        transaction_signer = self._crypto_factory.new_signer(
-            secp256k1.Secp256k1PrivateKey.from_hex(private_key))
+                                             timestamp,
+                                             wait=True):
+        transaction_signer = self.get_signer(private_key)
 
-        batch = make_create_sensor_transaction(
+        batch = await self._make_batch(
+            make_create_sensor_transaction,
             transaction_signer=transaction_signer,
             batch_signer=self._batch_signer,
             user_quota_usage_value=user_quota_usage_value,
@@ -124,36 +172,157 @@ class Messenger(object):
             measurement=0,
             sensor_id=sensor_id,
             timestamp=timestamp)
-        await self._send_and_wait_for_commit(batch)
+        return await self._send(batch, wait)
         
 
     async def send_update_sensor_transaction(self,
                                              private_key,
                                              measurement,
                                              sensor_id,
-                                             timestamp):
-        transaction_signer = self._crypto_factory.new_signer(
-            secp256k1.Secp256k1PrivateKey.from_hex(private_key))
-        batch = make_update_sensor_transaction(
+                                             timestamp,
+                                             wait=True):
+        transaction_signer = self.get_signer(private_key)
+        batch = await self._make_batch(
+            make_update_sensor_transaction,
             transaction_signer=transaction_signer,
             batch_signer=self._batch_signer,
             measurement=measurement,
             sensor_id=sensor_id,
             timestamp=timestamp)
-        await self._send_and_wait_for_commit(batch)
+        return await self._send(batch, wait, coalesce=True)
+
+    async def send_update_sensor_transactions(self,
+                                              private_key,
+                                              readings,
+                                              wait=True):
+        """Submits one batch per reading, BULK_SUBMIT_SIZE batches per
+        request, so each reading is accepted or rejected on its own
+
+        Args:
+            readings (list): dicts with sensor_id, measurement and timestamp
+
+        Returns:
+            list: (batch id, error or None) of each reading, in order
+        """
+        transaction_signer = self.get_signer(private_key)
+        batches = await self._make_batch(
+            make_update_sensor_batches,
+            transaction_signer=transaction_signer,
+            batch_signer=self._batch_signer,
+            readings=readings)
+
+        errors = {}
+        submitted = []
+        for start in range(0, len(batches), BULK_SUBMIT_SIZE):
+            chunk = batches[start:start + BULK_SUBMIT_SIZE]
+            try:
+                await self.submit_batches(chunk)
+                submitted.append(chunk)
+                continue
+            except ApiBadRequest:
+                pass
+            except (ApiInternalError, ApiServiceUnavailable) as err:
+                errors.update(
+                    (batch.header_signature, err) for batch in chunk)
+                continue
+            # The validator rejected the request as a whole, find which
+            # batches it rejected
+            accepted = []
+            for batch in chunk:
+                try:
+                    await self.submit_batches([batch])
+                    accepted.append(batch)
+                except (ApiBadRequest, ApiInternalError,
+                        ApiServiceUnavailable) as err:
+                    errors[batch.header_signature] = err
+            if accepted:
+                submitted.append(accepted)
 
-    async def _send_and_wait_for_commit(self, batch):
-        # Send transaction to validator
+        if wait:
+            for commit_errors in await asyncio.gather(*[
+                    self.wait_for_commits(
+                        [batch.header_signature for batch in chunk])
+                    for chunk in submitted]):
+                errors.update(commit_errors)
+        elif self._tracker is not None:
+            for chunk in submitted:
+                for batch in chunk:
+                    self._tracker.track(batch.header_signature)
+
+        return [(batch.header_signature, errors.get(batch.header_signature))
+                for batch in batches]
+
+    async def _make_batch(self, make_transaction, **kwargs):
+        """Builds and signs a batch with make_transaction in the executor's
+        signing threads, off the event loop
+        """
+        if self._executor is None:
+            return make_transaction(**kwargs)
+        return await self._executor.run_signing(
+            functools.partial(make_transaction, **kwargs))
+
+    def get_signer(self, private_key):
+        """Returns the CachedSigner of a hex encoded private key, as str or
+        as the bytes decrypted from the auth table, building it only the
+        first time the key is seen. Signers are cached by a hash of the key,
+        so decrypted keys are not kept as cache keys
+        """
+        key = hashlib.sha256(binascii.unhexlify(private_key)).digest()
+        signer = self._signers.get(key)
+        if signer is None:
+            signer = CachedSigner(self._crypto_factory.new_signer(
+                secp256k1.Secp256k1PrivateKey.from_hex(private_key)))
+            self._signers.put(key, signer)
+        return signer
+
+    async def _send(self, batch, wait, coalesce=False):
+        """Submits batch and returns its id. If wait is set, only returns
+        once the batch is committed. With coalesce, the batch may be
+        submitted together with the others sent in the coalescer's window
+        """
+        if coalesce and self._coalescer is not None:
+            batch_id = await self._coalescer.send(batch, wait)
+        else:
+            batch_id, = await self.submit_batches([batch])
+            if wait:
+                error = (await self.wait_for_commits([batch_id]))[batch_id]
+                if error is not None:
+                    raise error
+        if not wait and self._tracker is not None:
+            self._tracker.track(batch_id)
+        return batch_id
+
+    async def submit_batches(self, batches):
+        """Submits batches in one request, returning their ids
+        """
         submit_request = client_batch_submit_pb2.ClientBatchSubmitRequest(
-            batches=[batch])
-        await self._connection.send(
+            batches=batches)
+        validator_response = await self._connection.send(
             validator_pb2.Message.CLIENT_BATCH_SUBMIT_REQUEST,
             submit_request.SerializeToString())
 
+        response_class = client_batch_submit_pb2.ClientBatchSubmitResponse
+        submit_response = response_class()
+        submit_response.ParseFromString(validator_response.content)
+        status = submit_response.status
+        if status == response_class.INVALID_BATCH:
+            raise ApiBadRequest('Batch inválido.')
+        elif status == response_class.QUEUE_FULL:
+            raise ApiServiceUnavailable(
+                'a fila de batches do validador está cheia.')
+        elif status != response_class.OK:
+            raise ApiInternalError('Batch submission failed')
+        return [batch.header_signature for batch in batches]
+
+    async def wait_for_commits(self, batch_ids):
+        """Waits for batch_ids to be committed, in one status request
+
+        Returns:
+            dict: batch id to the error the batch failed with, or None
+        """
         # Send status request to validator
-        batch_id = batch.header_signature
         status_request = client_batch_submit_pb2.ClientBatchStatusRequest(
-            batch_ids=[batch_id], wait=True)
+            batch_ids=batch_ids, wait=True)
         validator_response = await self._connection.send(
             validator_pb2.Message.CLIENT_BATCH_STATUS_REQUEST,
             status_request.SerializeToString())
@@ -161,14 +330,64 @@ class Messenger(object):
         # Parse response
         status_response = client_batch_submit_pb2.ClientBatchStatusResponse()
         status_response.ParseFromString(validator_response.content)
-        status = status_response.batch_statuses[0].status
-        if status == client_batch_submit_pb2.ClientBatchStatus.INVALID:
-            error = status_response.batch_statuses[0].invalid_transactions[0]
-            raise ApiBadRequest(error.message)
-        elif status == client_batch_submit_pb2.ClientBatchStatus.PENDING:
-            raise ApiInternalError('Transaction submitted but timed out')
-        elif status == client_batch_submit_pb2.ClientBatchStatus.UNKNOWN:
-            print('ClientBatchStatus.UNKNOWN. Check later')
+        errors = {}
+        for batch_status in status_response.batch_statuses:
+            status = batch_status.status
+            error = None
+            if status == client_batch_submit_pb2.ClientBatchStatus.INVALID:
+                error = ApiBadRequest(
+                    batch_status.invalid_transactions[0].message)
+            elif status == client_batch_submit_pb2.ClientBatchStatus.PENDING:
+                error = ApiInternalError('Transaction submitted but timed out')
+            elif status == client_batch_submit_pb2.ClientBatchStatus.UNKNOWN:
+                print('ClientBatchStatus.UNKNOWN. Check later')
+            errors[batch_status.batch_id] = error
+        for batch_id in batch_ids:
+            errors.setdefault(batch_id, None)
+        return errors
+
+    async def fetch_batch_statuses(self, batch_ids):
+        """Fetches the current status of many batches in one request
+
+        Returns:
+            dict: batch id to {'batch_id', 'status', 'invalid_transactions'}
+        """
+        status_request = client_batch_submit_pb2.ClientBatchStatusRequest(
+            batch_ids=batch_ids)
+        validator_response = await self._connection.send(
+            validator_pb2.Message.CLIENT_BATCH_STATUS_REQUEST,
+            status_request.SerializeToString())
+
+        status_response = client_batch_submit_pb2.ClientBatchStatusResponse()
+        status_response.ParseFromString(validator_response.content)
+        if status_response.status == \
+                client_batch_submit_pb2.ClientBatchStatusResponse.INVALID_ID:
+            raise ApiBadRequest('ID de batch inválido.')
+        elif status_response.status != \
+                client_batch_submit_pb2.ClientBatchStatusResponse.OK:
+            raise ApiInternalError('Batch status request failed')
+
+        status_names = client_batch_submit_pb2.ClientBatchStatus.Status
+        return {
+            batch_status.batch_id: {
+                'batch_id': batch_status.batch_id,
+                'status': status_names.Name(batch_status.status),
+                'invalid_transactions': [
+                    {'id': invalid.transaction_id, 'message': invalid.message}
+                    for invalid in batch_status.invalid_transactions],
+            }
+            for batch_status in status_response.batch_statuses
+        }
+
+    def set_tracker(self, tracker):
+        """Tracks the batches submitted without waiting with tracker
+        """
+        self._tracker = tracker
+
+    def set_coalescer(self, coalescer):
+        """Submits sensor updates through coalescer, several per request
+        """
+        self._coalescer = coalescer
 
 
     # Transferência de sensores desativada.
@@ -186,4 +405,4 @@ class Messenger(object):
     #         receiving_user=receiving_user,
     #         sensor_id=sensor_id,
     #         timestamp=timestamp)
-    #     await self._send_and_wait_for_commit(batch)
\ No newline at end of file
+    #     await self._send_and_wait_for_commit(batch)
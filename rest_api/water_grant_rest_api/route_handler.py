@@ -12,30 +12,86 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ------------------------------------------------------------------------------
+import base64
+import binascii
 import datetime
+from email.utils import formatdate
+import functools
+import hashlib
+import json
 from json.decoder import JSONDecodeError
 import logging
+import re
 import time
 
-from aiohttp.web import json_response
+from aiohttp.web import ContentCoding
+from aiohttp.web import Response
+from aiohttp.web import StreamResponse
 import bcrypt
 from Crypto.Cipher import AES
+from google.protobuf.message import DecodeError
 from itsdangerous import BadSignature
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 
+from water_grant_rest_api.compression import encoded_etag
+from water_grant_rest_api.compression import negotiate_encoding
+from water_grant_rest_api.compression import strip_encoding
+from water_grant_rest_api.database import MEASUREMENT_BUCKETS
+from water_grant_rest_api.database import SENSOR_LIST_FIELDS
+from water_grant_rest_api.database import USER_LIST_FIELDS
 from water_grant_rest_api.errors import ApiBadRequest
 from water_grant_rest_api.errors import ApiNotFound
+from water_grant_rest_api.errors import ApiServiceUnavailable
 from water_grant_rest_api.errors import ApiUnauthorized
+from water_grant_rest_api.serialization import dumps
+from water_grant_protobuf import readings_pb2
 
 
+MAX_PAGE_LIMIT = 1000
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+PROTOBUF_CONTENT_TYPE = 'application/x-protobuf'
+MAX_STATUS_WAIT = 30
+MAX_BULK_READINGS = 10000
+BATCH_ID_PATTERN = re.compile('^[0-9a-f]{128}$')
 LOGGER = logging.getLogger(__name__)
 
 
 class RouteHandler(object):
-    def __init__(self, loop, messenger, database):
+    def __init__(self, loop, messenger, database, cache=None,
+                 auth_cache=None, executor=None, tracker=None,
+                 coalescer=None, events=None):
         self._loop = loop
         self._messenger = messenger
         self._database = database
+        self._cache = cache
+        self._auth_cache = auth_cache
+        self._executor = executor
+        self._tracker = tracker
+        self._coalescer = coalescer
+        self._events = events
+        self._ready = False
+        self.startup = {}
+
+    def set_ready(self, ready):
+        """Marks whether the API takes traffic, answered by /readyz
+        """
+        self._ready = ready
+
+    async def healthz(self, _request):
+        return json_response({'status': 'ok', 'startup': self.startup})
+
+    async def readyz(self, _request):
+        database_ready = await self._database.is_ready()
+        validators_ready = self._messenger.validators_ready()
+        ready = self._ready and database_ready and validators_ready
+        return json_response(
+            {
+                'ready': ready,
+                'database': database_ready,
+                'validators': validators_ready,
+            },
+            status=200 if ready else 503)
 
 
     async def authenticate(self, request):
@@ -46,12 +102,13 @@ class RouteHandler(object):
         username = body.get('username')
         password = bytes(body.get('password'), 'utf-8')
 
-        auth_info = await self._database.fetch_auth_resource(username)
+        auth_info = await self._database.fetch_auth_by_username(username)
         if auth_info is None:
             raise ApiUnauthorized("Username não encontrado.")
 
         hashed_password = auth_info.get('hashed_password')
-        if not bcrypt.checkpw(password, bytes.fromhex(hashed_password)):
+        if not await self._run_crypto(
+                bcrypt.checkpw, password, bytes.fromhex(hashed_password)):
             raise ApiUnauthorized('Senha ou username incorreto.')
 
         token = generate_auth_token(
@@ -77,15 +134,17 @@ class RouteHandler(object):
         public_key, private_key = self._messenger.get_new_key_pair()
 
         username = body.get('username')
-        auth_info = await self._database.fetch_auth_resource(username)
+        auth_info = await self._database.fetch_auth_by_username(username)
         if auth_info is not None:
             raise ApiUnauthorized(
                 'Já existe um admin com esse username.'
                 'Por favor, insira outro.')
         
-        encrypted_private_key = encrypt_private_key(
-            request.app['aes_key'], public_key, private_key)
-        hashed_password = hash_password(body.get('password'))
+        encrypted_private_key = await self._run_crypto(
+            encrypt_private_key, request.app['aes_key'], public_key,
+            private_key)
+        hashed_password = await self._run_crypto(
+            hash_password, body.get('password'))
 
         await self._database.create_auth_entry(
             public_key,
@@ -102,7 +161,7 @@ class RouteHandler(object):
         except:
             # Caso a transação não seja valida, a conta é removida da
             # tabela auth
-            await self._database.delete_auth_entry(public_key)
+            await self._delete_auth_entry(public_key)
             raise ApiUnauthorized(
                 'Transação invalida')
 
@@ -112,9 +171,9 @@ class RouteHandler(object):
         return json_response({'authorization': token})
 
     async def create_user(self, request):
-        await self._authorize(request)
-
         body = await decode_request(request)
+        await self._authorize(request, body)
+
         required_fields = ['username', 'name', 'password', 'created_by_admin_public_key']
         validate_fields(required_fields, body)
 
@@ -123,7 +182,7 @@ class RouteHandler(object):
         await self._validate_admin(admin_public_key)
 
         username = body.get('username')
-        user_auth_info = await self._database.fetch_auth_resource(username)
+        user_auth_info = await self._database.fetch_auth_by_username(username)
         if user_auth_info is not None:
             raise ApiUnauthorized(
                 'Já existe um usuário com esse username.'
@@ -131,9 +190,11 @@ class RouteHandler(object):
         
         public_key, private_key = self._messenger.get_new_key_pair()        
         
-        encrypted_private_key = encrypt_private_key(
-            request.app['aes_key'], public_key, private_key)
-        hashed_password = hash_password(body.get('password'))
+        encrypted_private_key = await self._run_crypto(
+            encrypt_private_key, request.app['aes_key'], public_key,
+            private_key)
+        hashed_password = await self._run_crypto(
+            hash_password, body.get('password'))
     
         await self._database.create_auth_entry(
             public_key,
@@ -151,7 +212,7 @@ class RouteHandler(object):
         except:
             # Caso a transação não seja valida, a conta é removida da
             # tabela auth
-            await self._database.delete_auth_entry(public_key)
+            await self._delete_auth_entry(public_key)
             raise ApiUnauthorized(
                 'Transação invalida')
 
@@ -161,30 +222,59 @@ class RouteHandler(object):
         return json_response({'authorization': token})
     
 
-    async def list_users(self, _request):
-        user_list = await self._database.fetch_all_user_resources()
-        return json_response(user_list)
+    async def list_users(self, request):
+        await self._wait_for_block(request)
+        limit, after = parse_page(request)
+        fields = parse_fields(request, USER_LIST_FIELDS)
+        if limit is None and after is None:
+            return await stream_response(
+                request,
+                self._database.stream_all_user_resources(fields=fields))
+        user_list = await self._database.fetch_all_user_resources(
+            limit=_fetch_limit(limit),
+            after=after,
+            fields=fields)
+        return page_response(user_list, limit, 'public_key')
     
 
     async def fetch_user(self, request):
+        min_block_num = await self._wait_for_block(request)
         public_key = request.match_info.get('user_public_key', '')
-        user = await self._database.fetch_user_resource(public_key)
-        if user is None:
+        response = await self._cached_response(
+            request,
+            'user:' + public_key,
+            min_block_num,
+            functools.partial(
+                self._database.fetch_user_resource, public_key))
+        if response is None:
             raise ApiNotFound(
                 'usuário com a chave pública {} não foi encontrado.'
                 .format(public_key))
-        return json_response(user)
+        return response
     
 
     async def fetch_user_quota_usage(self, request):
+        min_block_num = await self._wait_for_block(request)
         public_key = request.match_info.get('user_public_key', '')
-        user_quota_usage = await self._database.fetch_user_quota_usage_resource(
-            public_key)
-        if user_quota_usage is None:
+        response = await self._cached_response(
+            request,
+            'usage:' + public_key,
+            min_block_num,
+            functools.partial(
+                self._database.fetch_user_quota_usage_resource, public_key))
+        if response is None:
             raise ApiNotFound(
                 'usuário com a chave pública {} não foi encontrado.'
                 .format(public_key))
-        return json_response(user_quota_usage)
+        return response
+
+
+    async def fetch_user_usage_history(self, request):
+        await self._wait_for_block(request)
+        public_key = request.match_info.get('user_public_key', '')
+        usage_history = await self._database.fetch_user_usage_history_resource(
+            public_key)
+        return json_response(usage_history)
     
     
     async def update_user(self, request):
@@ -198,38 +288,42 @@ class RouteHandler(object):
         admin_public_key = body.get('updated_by_admin_public_key')
         await self._validate_admin(admin_public_key)
 
-        private_key = await self._authorize(request)
+        private_key = await self._authorize(request, body)
 
         user_public_key = request.match_info.get('user_public_key', '')
 
-        await self._messenger.send_update_user_transaction(
+        respond_async = prefers_async(request)
+        batch_id = await self._messenger.send_update_user_transaction(
             private_key=private_key,
             quota=body['quota'],
             user_public_key=user_public_key,
             timestamp=get_time(),
-            admin_public_key=body['updated_by_admin_public_key'])
+            admin_public_key=body['updated_by_admin_public_key'],
+            wait=not respond_async)
 
-        return json_response(
-            {'data': 'Update user transaction submitted'})
+        return submitted_response(
+            'Update user transaction submitted', batch_id, respond_async)
     
 
     async def create_sensor(self, request):
-        private_key = await self._authorize(request)
-
         body = await decode_request(request)
+        private_key = await self._authorize(request, body)
+
         required_fields = ['latitude', 'longitude', 'sensor_id']
         validate_fields(required_fields, body)
 
 
         public_key = await self._public_key_from_token(request)
 
-        user_quota = await self._database.fetch_user_quota_resource(public_key)
-        user_quota_value = user_quota.get('quota')
-
-        user_quota_usage = await self._database.fetch_user_quota_usage_resource(
+        registration = await self._database.fetch_user_registration_resource(
             public_key)
-        user_quota_usage_value = user_quota_usage.get('sum')
-        
+        if registration is None:
+            raise ApiNotFound(
+                'usuário com a chave pública {} não foi encontrado.'
+                .format(public_key))
+        user_quota_value = registration.get('quota')
+        user_quota_usage_value = registration.get('usage')
+
         if user_quota_usage_value > user_quota_value:
             raise ApiBadRequest(
                 'Consumo atual excede cota concedida. Limite: {} m³.'
@@ -237,57 +331,374 @@ class RouteHandler(object):
                 + ' Consumo atual: {} m³. Regularize e tente novamente.'
                 .format(user_quota_usage_value))
 
-        await self._messenger.send_create_sensor_transaction(
+        respond_async = prefers_async(request)
+        batch_id = await self._messenger.send_create_sensor_transaction(
             private_key=private_key,
             user_quota_usage_value=user_quota_usage_value,
             latitude=body.get('latitude'),
             longitude=body.get('longitude'),
             sensor_id=body.get('sensor_id'),
-            timestamp=get_time())
+            timestamp=get_time(),
+            wait=not respond_async)
 
-        return json_response({'data': 'Create sensor transaction submitted'})
+        return submitted_response(
+            'Create sensor transaction submitted', batch_id, respond_async)
     
 
-    async def list_sensors(self, _request):
-        sensor_list = await self._database.fetch_all_sensor_resources()
-        return json_response(sensor_list)
+    async def list_sensors(self, request):
+        await self._wait_for_block(request)
+        limit, after = parse_page(request)
+        fields = parse_fields(request, SENSOR_LIST_FIELDS)
+        since, measurements_limit = parse_measurement_filters(request)
+
+        streamed = limit is None and after is None
+
+        # Any block may change the list, so its version is the latest one
+        headers = None
+        version = await self._database.fetch_latest_block()
+        if version is not None:
+            etag, _ = version_validators(version)
+            if streamed and \
+                    NDJSON_CONTENT_TYPE in request.headers.get('Accept', ''):
+                etag = etag[:-1] + '-ndjson"'
+            response = not_modified_response(request, etag)
+            if response is not None:
+                return response
+            headers = validator_headers(etag)
+
+        if streamed:
+            return await stream_response(
+                request,
+                self._database.stream_all_sensor_resources(
+                    fields=fields,
+                    measurements_since=since,
+                    measurements_limit=measurements_limit),
+                headers=headers)
+        sensor_list = await self._database.fetch_all_sensor_resources(
+            limit=_fetch_limit(limit),
+            after=after,
+            fields=fields,
+            measurements_since=since,
+            measurements_limit=measurements_limit)
+        return page_response(sensor_list, limit, 'sensor_id', headers=headers)
     
 
     async def list_sensors_by_owner(self, request):
+        await self._wait_for_block(request)
         public_key = request.match_info.get('user_public_key', '')
-        sensor_list = await self._database.fetch_sensors_by_owner(public_key)
-        return json_response(sensor_list)
+        limit, after = parse_page(request)
+        sensor_list = await self._database.fetch_sensors_by_owner(
+            public_key, limit=_fetch_limit(limit), after=after)
+        return page_response(sensor_list, limit, 'sensor_id')
     
 
     async def fetch_sensor(self, request):
+        min_block_num = await self._wait_for_block(request)
         sensor_id = request.match_info.get('sensor_id', '')
-        sensor = await self._database.fetch_sensor_resource(sensor_id)
-        if sensor is None:
+        since, measurements_limit = parse_measurement_filters(request)
+        fetch = functools.partial(
+            self._database.fetch_sensor_resource,
+            sensor_id,
+            measurements_since=since,
+            measurements_limit=measurements_limit)
+        fetch_version = functools.partial(
+            self._database.fetch_sensor_version, sensor_id)
+        # Only the complete sensor is cached
+        if since is None and measurements_limit is None:
+            response = await self._cached_response(
+                request, 'sensor:' + sensor_id, min_block_num, fetch,
+                fetch_version)
+        else:
+            response = await self._uncached_response(
+                request, fetch, fetch_version)
+        if response is None:
             raise ApiNotFound(
                 'sensor com o ID '
                 '{} não foi encontrado.'.format(sensor_id))
-        return json_response(sensor)
+        return response
     
     
-    async def update_sensor(self, request):
-        private_key = await self._authorize(request)
+    async def fetch_sensor_measurements(self, request):
+        await self._wait_for_block(request)
+        sensor_id = request.match_info.get('sensor_id', '')
+        start = parse_int(request, 'from')
+        end = parse_int(request, 'to')
+        bucket = request.query.get('bucket')
+        if bucket is not None and bucket not in MEASUREMENT_BUCKETS:
+            raise ApiBadRequest(
+                "O parâmetro 'bucket' deve ser um de: {}.".format(
+                    ', '.join(sorted(MEASUREMENT_BUCKETS))))
+
+        response = await self._uncached_response(
+            request,
+            functools.partial(
+                self._database.fetch_sensor_measurements_resource,
+                sensor_id, start=start, end=end, bucket=bucket),
+            functools.partial(
+                self._database.fetch_sensor_version, sensor_id))
+        if response is None:
+            raise ApiNotFound(
+                'sensor com o ID '
+                '{} não foi encontrado.'.format(sensor_id))
+        return response
 
-        body = await decode_request(request)
+
+    async def update_sensor(self, request):
+        if request.content_type == PROTOBUF_CONTENT_TYPE:
+            body = _reading_from_protobuf(await decode_protobuf(
+                request, readings_pb2.SensorReading))
+        else:
+            body = await decode_request(request)
         required_fields = ['measurement']
         validate_fields(required_fields, body)
+        measurement = body['measurement']
+        private_key = await self._authorize(request, body)
 
         sensor_id = request.match_info.get('sensor_id', '')
 
-        await self._messenger.send_update_sensor_transaction(
+        respond_async = prefers_async(request)
+        batch_id = await self._messenger.send_update_sensor_transaction(
             private_key=private_key,
-            measurement=body['measurement'],
+            measurement=measurement,
             sensor_id=sensor_id,
-            timestamp=get_time())
-
+            timestamp=get_time(),
+            wait=not respond_async)
+
+        return submitted_response(
+            'Update sensor transaction submitted', batch_id, respond_async)
+
+    async def update_sensors_bulk(self, request):
+        readings = await decode_readings(request)
+        private_key = await self._authorize(request, readings)
+
+        # Like single updates, readings take the time they are received.
+        # Client timestamps could backdate usage into closed quota months
+        timestamp = get_time()
+        results = []
+        accepted = []
+        for index, reading in enumerate(readings):
+            error = validate_reading(reading)
+            if error is not None:
+                sensor_id = None
+                if isinstance(reading, dict):
+                    sensor_id = reading.get('sensor_id')
+                results.append({
+                    'index': index,
+                    'sensor_id': sensor_id,
+                    'status': 'INVALID',
+                    'error': error,
+                })
+                continue
+            accepted.append({
+                'index': index,
+                'sensor_id': reading['sensor_id'],
+                'measurement': reading['measurement'],
+                'timestamp': timestamp,
+            })
+
+        respond_async = prefers_async(request)
+        if accepted:
+            outcomes = await self._messenger.send_update_sensor_transactions(
+                private_key=private_key,
+                readings=accepted,
+                wait=not respond_async)
+            for reading, (batch_id, error) in zip(accepted, outcomes):
+                result = {
+                    'index': reading['index'],
+                    'sensor_id': reading['sensor_id'],
+                    'batch_id': batch_id,
+                }
+                if error is None:
+                    result['status'] = \
+                        'SUBMITTED' if respond_async else 'COMMITTED'
+                else:
+                    result['status'] = \
+                        'INVALID' if isinstance(error, ApiBadRequest) \
+                        else 'FAILED'
+                    result['error'] = error.message
+                results.append(result)
+        results.sort(key=lambda result: result['index'])
+
+        failed = sum(1 for result in results if 'error' in result)
         return json_response(
-            {'data': 'Update sensor transaction submitted'})
+            {
+                'data': results,
+                'accepted': len(results) - failed,
+                'failed': failed,
+            },
+            status=202 if respond_async else 200)
+
+    async def stream_sensor_events(self, request):
+        sensor_id = request.match_info.get('sensor_id', '')
+        if await self._database.fetch_sensor_version(sensor_id) is None:
+            raise ApiNotFound(
+                'sensor com o ID '
+                '{} não foi encontrado.'.format(sensor_id))
+        return await self._event_response(request, 'sensor:' + sensor_id)
+
+    async def stream_owner_events(self, request):
+        public_key = request.match_info.get('user_public_key', '')
+        return await self._event_response(request, 'owner:' + public_key)
+
+    async def _event_response(self, request, topic):
+        """Streams the new measurements of topic as server-sent events
+        until the client leaves, or falls too far behind and has to
+        reconnect. A client reconnecting with Last-Event-ID first gets the
+        measurements it missed.
+        """
+        if self._events is None:
+            raise ApiServiceUnavailable('eventos desativados.')
+        last_event_id = request.headers.get('Last-Event-ID')
+        if last_event_id is not None:
+            try:
+                last_event_id = int(last_event_id)
+            except ValueError:
+                raise ApiBadRequest('Last-Event-ID deve ser um inteiro.')
+
+        stream = self._events.subscribe(topic)
+        try:
+            response = StreamResponse(headers={
+                'Content-Type': 'text/event-stream',
+                'Cache-Control': 'no-cache',
+                # Keeps nginx from buffering the events
+                'X-Accel-Buffering': 'no',
+            })
+            await response.prepare(request)
+            await response.write(b'retry: 5000\n\n')
+            if last_event_id is not None:
+                await self._events.replay(stream, last_event_id)
+            # The events queued before an overflow are still written, so
+            # the client resumes after them
+            while True:
+                events = await stream.next_events()
+                if events:
+                    await response.write(b''.join(events))
+                if stream.closed:
+                    return response
+        finally:
+            self._events.unsubscribe(stream)
+
+
+    async def fetch_batch_status(self, request):
+        batch_id = request.match_info.get('batch_id', '')
+        if not BATCH_ID_PATTERN.match(batch_id):
+            raise ApiBadRequest('ID de batch inválido.')
+        wait = parse_wait(request)
+
+        status = None
+        if self._tracker is not None:
+            status = await self._tracker.status(batch_id, wait)
+        if status is None:
+            # Submitted by another process, or forgotten by the tracker
+            statuses = await self._messenger.fetch_batch_statuses([batch_id])
+            status = statuses.get(batch_id)
+        if status is None:
+            raise ApiNotFound(
+                'Batch com o ID {} não encontrado.'.format(batch_id))
+        return json_response(status)
     
 
+    async def fetch_metrics(self, _request):
+        metrics = {
+            'startup': self.startup,
+            'validators': self._messenger.validators_snapshot(),
+        }
+        if self._cache is not None:
+            metrics['cache'] = self._cache.snapshot()
+        if self._auth_cache is not None:
+            metrics['auth_cache'] = self._auth_cache.snapshot()
+        if self._executor is not None:
+            metrics['crypto_pool'] = self._executor.snapshot()
+        if self._tracker is not None:
+            metrics['batches'] = self._tracker.snapshot()
+        if self._coalescer is not None:
+            metrics['coalescer'] = self._coalescer.snapshot()
+        if self._events is not None:
+            metrics['events'] = self._events.snapshot()
+        return json_response(metrics)
+
+
+    async def _cached_response(self, request, key, min_block_num, fetch,
+                               fetch_version=None):
+        """Responds with the resource stored under key in the cache, calling
+        fetch to get and store it on a miss. Entries from before
+        min_block_num are not served. Returns None if fetch finds nothing.
+
+        If given, fetch_version returns the version of the resource, which
+        its ETag and Last-Modified are derived from, so a client holding
+        it gets 304 Not Modified without the resource being fetched.
+        """
+        cache = self._cache
+        if cache is None or (min_block_num is not None and (
+                cache.block_num is None or cache.block_num < min_block_num)):
+            return await self._uncached_response(
+                request, fetch, fetch_version)
+
+        entry = cache.get(key)
+        if entry is not None:
+            return etag_response(
+                request, entry.body, entry.etag, entry.last_modified)
+
+        generation = cache.generation
+        version = None
+        if fetch_version is not None:
+            version = await fetch_version()
+            if version is None:
+                return None
+            response = not_modified_response(
+                request, *version_validators(version))
+            if response is not None:
+                return response
+
+        resource = await fetch()
+        if resource is None:
+            return None
+        body, etag, last_modified = serialize_with_etag(resource, version)
+        cache.put(key, body, etag, generation, last_modified)
+        return etag_response(request, body, etag, last_modified)
+
+
+    async def _uncached_response(self, request, fetch, fetch_version=None):
+        version = None
+        if fetch_version is not None:
+            version = await fetch_version()
+            if version is None:
+                return None
+            response = not_modified_response(
+                request, *version_validators(version))
+            if response is not None:
+                return response
+
+        resource = await fetch()
+        if resource is None:
+            return None
+        body, etag, last_modified = serialize_with_etag(resource, version)
+        return etag_response(request, body, etag, last_modified)
+
+
+    async def _wait_for_block(self, request):
+        """Holds a read until the database it is served from has ingested
+        the block given in the optional min_block_num query parameter, and
+        returns that block number, or None if the parameter is not given
+        """
+        min_block_num = request.query.get('min_block_num')
+        if min_block_num is None:
+            return None
+        try:
+            min_block_num = int(min_block_num)
+        except ValueError:
+            raise ApiBadRequest(
+                "O parâmetro 'min_block_num' deve ser um inteiro.")
+
+        reached = await self._database.wait_for_block(
+            min_block_num, request.app['consistency_timeout'])
+        if not reached:
+            raise ApiServiceUnavailable(
+                'o bloco {} ainda não foi sincronizado.'.format(
+                    min_block_num))
+        return min_block_num
+
+
     async def _public_key_from_token(self, request):
         token = request.headers.get('AUTHORIZATION')
         if token is None:
@@ -305,39 +716,152 @@ class RouteHandler(object):
         return token_dict.get('public_key')
     
 
-    async def _authorize(self, request):        
+    async def _authorize(self, request, body):
+        """Returns the private key of the token's account, or of the
+        user_public_key account if body, the request body already decoded by
+        the handler, is a JSON object naming one
+        """
         public_key = await self._public_key_from_token(request)
-        body = await decode_request(request)
 
         # Verifica se é há um chave de admin válida
-        admin_auth = await self._database.fetch_auth_resource(public_key)
-        if admin_auth is None:
+        auth_entry = await self._fetch_auth_entry(public_key)
+        if auth_entry is None:
             raise ApiUnauthorized('Token não está associado com uma conta.')
 
         # Verifica se trata da operação de atualização de usuário
-        if body.get('user_public_key'):
-            public_key = body.get('user_public_key')  
-
-        auth_resource = await self._database.fetch_auth_resource(public_key)
-        if auth_resource is None:
-            raise ApiUnauthorized('Token não está associado com um usuário.')
-        return decrypt_private_key(request.app['aes_key'],
-                                   public_key,
-                                   auth_resource['encrypted_private_key'])
+        if isinstance(body, dict) and body.get('user_public_key'):
+            public_key = body.get('user_public_key')
+            auth_entry = await self._fetch_auth_entry(public_key)
+            if auth_entry is None:
+                raise ApiUnauthorized(
+                    'Token não está associado com um usuário.')
+
+        if 'private_key' not in auth_entry:
+            auth_entry['private_key'] = await self._run_crypto(
+                decrypt_private_key,
+                request.app['aes_key'],
+                public_key,
+                auth_entry['auth']['encrypted_private_key'])
+        return auth_entry['private_key']
     
 
     async def _validate_admin(self, admin_public_key):
-            auth_resource = await self._database.fetch_auth_resource(admin_public_key)
-            if auth_resource is not None and auth_resource['is_admin'] is False:
-                raise ApiBadRequest("Você não tem permissão para realizar esta ação!")
+        auth_entry = await self._fetch_auth_entry(admin_public_key)
+        if auth_entry is not None and \
+                auth_entry['auth']['is_admin'] is False:
+            raise ApiBadRequest(
+                "Você não tem permissão para realizar esta ação!")
+
+
+    async def _run_crypto(self, func, *args):
+        """Runs CPU-bound crypto in the executor, off the event loop
+        """
+        if self._executor is None:
+            return func(*args)
+        return await self._executor.run(func, *args)
+
+
+    async def _fetch_auth_entry(self, public_key):
+        """Returns the auth row of public_key as {'auth': row}, along with
+        its decrypted 'private_key' once _authorize has needed it. Entries
+        are kept in the auth cache, so repeated requests of an account
+        skip the database and the decryption. Unknown keys are not cached.
+        """
+        if self._auth_cache is not None:
+            auth_entry = self._auth_cache.get(public_key)
+            if auth_entry is not None:
+                return auth_entry
+
+        auth = await self._database.fetch_auth_by_public_key(public_key)
+        if auth is None:
+            return None
+        auth_entry = {'auth': auth}
+        if self._auth_cache is not None:
+            self._auth_cache.put(public_key, auth_entry)
+        return auth_entry
+
+
+    async def _delete_auth_entry(self, public_key):
+        await self._database.delete_auth_entry(public_key)
+        if self._auth_cache is not None:
+            self._auth_cache.pop(public_key)
         
 
 async def decode_request(request):
     try:
         return await request.json()
-    except JSONDecodeError:
+    except (JSONDecodeError, UnicodeDecodeError):
+        raise ApiBadRequest('Formato JSON imprópio.')
+
+
+async def decode_readings(request):
+    """Decodes a JSON array of readings, one reading per line when the
+    body is application/x-ndjson, or a SensorReadingList when it is
+    application/x-protobuf. gzip bodies are inflated by aiohttp
+    """
+    try:
+        if request.content_type == PROTOBUF_CONTENT_TYPE:
+            reading_list = await decode_protobuf(
+                request, readings_pb2.SensorReadingList)
+            readings = [
+                _reading_from_protobuf(reading)
+                for reading in reading_list.readings]
+        elif request.content_type == NDJSON_CONTENT_TYPE:
+            readings = [
+                json.loads(line)
+                for line in (await request.text()).splitlines()
+                if line.strip()]
+        else:
+            readings = await request.json()
+    except (JSONDecodeError, UnicodeDecodeError):
         raise ApiBadRequest('Formato JSON imprópio.')
 
+    if not isinstance(readings, list):
+        raise ApiBadRequest('O corpo deve ser uma lista de leituras.')
+    if not readings:
+        raise ApiBadRequest('Nenhuma leitura enviada.')
+    if len(readings) > MAX_BULK_READINGS:
+        raise ApiBadRequest(
+            'No máximo {} leituras por requisição.'.format(MAX_BULK_READINGS))
+    return readings
+
+
+async def decode_protobuf(request, message_class):
+    message = message_class()
+    try:
+        message.ParseFromString(await request.read())
+    except DecodeError:
+        raise ApiBadRequest('Formato protobuf impróprio.')
+    return message
+
+
+def _reading_from_protobuf(reading):
+    """The reading as decoded from JSON, without a measurement if none was
+    set, e.g. in an empty or truncated body
+    """
+    measurement = None
+    if reading.HasField('measurement'):
+        measurement = reading.measurement
+    return {
+        'sensor_id': reading.sensor_id,
+        'measurement': measurement,
+    }
+
+
+def validate_reading(reading):
+    """Returns why reading can not be submitted, or None if it can
+    """
+    if not isinstance(reading, dict):
+        return 'A leitura deve ser um objeto.'
+    sensor_id = reading.get('sensor_id')
+    if not isinstance(sensor_id, str) or not sensor_id:
+        return "O parâmetro 'sensor_id' é requerido."
+    measurement = reading.get('measurement')
+    if isinstance(measurement, bool) or \
+            not isinstance(measurement, (int, float)):
+        return "O parâmetro 'measurement' deve ser numérico."
+    return None
+
 
 def validate_fields(required_fields, body):
     for field in required_fields:
@@ -346,6 +870,256 @@ def validate_fields(required_fields, body):
                 "O parâmetro '{}' é requerido.".format(field))
         
 
+def parse_int(request, name):
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ApiBadRequest(
+            "O parâmetro '{}' deve ser um inteiro.".format(name))
+
+
+def parse_positive_int(request, name):
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value <= 0:
+        raise ApiBadRequest(
+            "O parâmetro '{}' deve ser um inteiro positivo.".format(name))
+    return value
+
+
+def parse_wait(request):
+    value = request.query.get('wait')
+    if value is None:
+        return 0
+    try:
+        wait = float(value)
+    except ValueError:
+        wait = -1
+    if wait < 0:
+        raise ApiBadRequest(
+            "O parâmetro 'wait' deve ser um número não negativo.")
+    return min(wait, MAX_STATUS_WAIT)
+
+
+def prefers_async(request):
+    """Whether the client asked, with Prefer: respond-async, not to wait
+    for the transaction to be committed
+    """
+    preferences = request.headers.get('Prefer', '')
+    return 'respond-async' in [
+        preference.split('=')[0].strip().lower()
+        for preference in re.split('[,;]', preferences)]
+
+
+def submitted_response(message, batch_id, respond_async):
+    if not respond_async:
+        return json_response({'data': message, 'batch_id': batch_id})
+    link = '/batches/{}/status'.format(batch_id)
+    return json_response(
+        {'data': message, 'batch_id': batch_id, 'link': link},
+        status=202,
+        headers={'Location': link})
+
+
+def parse_page(request):
+    """Returns the page size and the key to continue after from the optional
+    limit and cursor query parameters. Without a limit every row is returned.
+    """
+    limit = parse_positive_int(request, 'limit')
+    if limit is not None:
+        limit = min(limit, MAX_PAGE_LIMIT)
+
+    cursor = request.query.get('cursor')
+    if cursor is None:
+        return limit, None
+    try:
+        after = json.loads(
+            base64.urlsafe_b64decode(cursor.encode()).decode())['after']
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError,
+            KeyError):
+        raise ApiBadRequest("O parâmetro 'cursor' é inválido.")
+    if not isinstance(after, str):
+        raise ApiBadRequest("O parâmetro 'cursor' é inválido.")
+    return limit, after
+
+
+def encode_cursor(after):
+    return base64.urlsafe_b64encode(
+        json.dumps({'after': after}).encode()).decode()
+
+
+def _fetch_limit(limit):
+    # One extra row tells whether there is a next page
+    return limit + 1 if limit is not None else None
+
+
+def page_response(rows, limit, key, headers=None):
+    """Responds with a page of rows, setting the cursor of the next page in
+    the X-Next-Cursor header when more rows follow it
+    """
+    headers = dict(headers or {})
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1][key])
+    return json_response(rows, headers=headers)
+
+
+async def stream_response(request, batches, headers=None):
+    """Streams the rows of an async iterator of row lists as a chunked JSON
+    array, or as newline delimited JSON if the client accepts it, so a large
+    list is never held in memory as a whole. The first batch is read before
+    the response starts, so a failing query still gets an error response.
+    The stream is gzipped if compression is enabled and the client accepts
+    it.
+    """
+    ndjson = NDJSON_CONTENT_TYPE in request.headers.get('Accept', '')
+    try:
+        try:
+            batch = await batches.__anext__()
+        except StopAsyncIteration:
+            batch = None
+
+        response = StreamResponse(headers=headers)
+        response.content_type = (
+            NDJSON_CONTENT_TYPE if ndjson else 'application/json')
+        response.enable_chunked_encoding()
+        response.headers['Vary'] = 'Accept'
+        if request.app.get('compress_min_size', 0) > 0:
+            response.headers['Vary'] = 'Accept, Accept-Encoding'
+            if negotiate_encoding(
+                    request.headers.get('Accept-Encoding', ''),
+                    ['gzip']) is not None:
+                response.enable_compression(ContentCoding.gzip)
+                if 'ETag' in response.headers:
+                    response.headers['ETag'] = encoded_etag(
+                        response.headers['ETag'], 'gzip')
+        await response.prepare(request)
+
+        if not ndjson:
+            await response.write(b'[')
+        separator = b''
+        while batch is not None:
+            if ndjson:
+                chunk = b''.join(dumps(row) + b'\n' for row in batch)
+            else:
+                chunk = separator + b','.join(dumps(row) for row in batch)
+                separator = b','
+            await response.write(chunk)
+            try:
+                batch = await batches.__anext__()
+            except StopAsyncIteration:
+                batch = None
+        if not ndjson:
+            await response.write(b']')
+        await response.write_eof()
+        return response
+    finally:
+        await batches.aclose()
+
+
+def json_response(data, status=200, headers=None):
+    return Response(
+        body=dumps(data),
+        status=status,
+        headers=headers,
+        content_type='application/json')
+
+
+def serialize_with_etag(resource, version=None):
+    """Returns the JSON body of resource with its ETag and Last-Modified
+    time, taken from the version of the resource if given, or else the
+    ETag hashed from the body and no Last-Modified
+    """
+    body = dumps(resource)
+    if version is not None:
+        etag, last_modified = version_validators(version)
+        return body, etag, last_modified
+    return body, '"{}"'.format(hashlib.sha1(body).hexdigest()), None
+
+
+def version_validators(version):
+    """Returns the strong ETag of a resource version, a block number and
+    id, and its Last-Modified time, never later than now
+    """
+    etag = '"{}-{}"'.format(version['block_num'], version['block_id'][:16])
+    last_modified = version['timestamp']
+    if last_modified is not None:
+        last_modified = min(last_modified, int(time.time()))
+    return etag, last_modified
+
+
+def validator_headers(etag, last_modified=None):
+    # no-cache lets clients store the response but revalidate it each time
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if last_modified is not None:
+        headers['Last-Modified'] = formatdate(last_modified, usegmt=True)
+    return headers
+
+
+def not_modified_response(request, etag, last_modified=None):
+    """Responds with 304 Not Modified if the client already holds the
+    representation with etag, or one at least as recent as last_modified
+    when it sends no If-None-Match. None otherwise
+    """
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag == '*' or strip_encoding(tag) == etag:
+                headers = validator_headers(etag, last_modified)
+                if tag != '*':
+                    # The client holds the encoded variant it was sent
+                    headers['ETag'] = tag
+                return Response(status=304, headers=headers)
+        return None
+
+    if_modified_since = request.if_modified_since
+    if last_modified is not None and if_modified_since is not None \
+            and last_modified <= if_modified_since.timestamp():
+        return Response(
+            status=304, headers=validator_headers(etag, last_modified))
+    return None
+
+
+def etag_response(request, body, etag, last_modified=None):
+    """Responds with body and its ETag, or with 304 Not Modified if the
+    client already holds it
+    """
+    response = not_modified_response(request, etag, last_modified)
+    if response is not None:
+        return response
+    return Response(
+        body=body,
+        content_type='application/json',
+        headers=validator_headers(etag, last_modified))
+
+
+def parse_fields(request, allowed_fields):
+    fields = request.query.get('fields')
+    if fields is None:
+        return None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    for field in fields:
+        if field not in allowed_fields:
+            raise ApiBadRequest(
+                "Campo '{}' inválido. Campos disponíveis: {}.".format(
+                    field, ', '.join(allowed_fields)))
+    return fields
+
+
+def parse_measurement_filters(request):
+    return (parse_int(request, 'measurements_since'),
+            parse_positive_int(request, 'measurements_limit'))
+
+
 def encrypt_private_key(aes_key, public_key, private_key):
     init_vector = bytes.fromhex(public_key[:32])
     cipher = AES.new(bytes.fromhex(aes_key), AES.MODE_CBC, init_vector)
@@ -0,0 +1,67 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Encodes the JSON bodies of the API responses, with orjson if it is
+installed and selected, or else with the standard library json module.
+Both write compact JSON without whitespace.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+SERIALIZERS = ('auto', 'json', 'orjson')
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode()
+
+
+_dumps = _json_dumps
+
+
+def available_serializers():
+    return ['json'] + (['orjson'] if orjson is not None else [])
+
+
+def set_serializer(name='auto'):
+    """Selects the serializer dumps uses, one of SERIALIZERS, auto being
+    orjson if it is installed. Returns the name of the one selected
+
+    Raises:
+        ValueError: If the serializer is unknown or not installed
+    """
+    global _dumps  # pylint: disable=global-statement
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('orjson is not installed')
+        _dumps = orjson.dumps
+    elif name == 'json':
+        _dumps = _json_dumps
+    else:
+        raise ValueError('Unknown JSON serializer {}'.format(name))
+    return name
+
+
+def dumps(obj):
+    """Returns obj encoded as JSON bytes
+    """
+    return _dumps(obj)
@@ -0,0 +1,87 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Measures how many update sensor batches per second one core can build and
+sign, rebuilding the transaction signer for every batch as the Messenger
+used to, and reusing a CachedSigner as it does now. Every process runs on
+its own core, so the total shows the throughput of the whole machine.
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from sawtooth_signing import create_context
+from sawtooth_signing import CryptoFactory
+from sawtooth_signing import secp256k1
+
+from water_grant_rest_api.messaging import CachedSigner
+from water_grant_rest_api.transaction_creation import \
+    make_update_sensor_transaction
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks transaction signing throughput per core')
+    parser.add_argument(
+        '-d', '--duration',
+        help='Seconds each variant runs',
+        type=float,
+        default=5)
+    parser.add_argument(
+        '-p', '--processes',
+        help='Processes signing in parallel, one per core by default',
+        type=int,
+        default=os.cpu_count())
+    return parser.parse_args(args)
+
+
+def _sign_batches(args):
+    cached, duration = args
+    context = create_context('secp256k1')
+    crypto_factory = CryptoFactory(context)
+    private_key = context.new_random_private_key().as_hex()
+    batch_signer = CachedSigner(
+        crypto_factory.new_signer(context.new_random_private_key()))
+    signer = CachedSigner(crypto_factory.new_signer(
+        secp256k1.Secp256k1PrivateKey.from_hex(private_key)))
+
+    batches = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        if not cached:
+            signer = crypto_factory.new_signer(
+                secp256k1.Secp256k1PrivateKey.from_hex(private_key))
+        make_update_sensor_transaction(
+            transaction_signer=signer,
+            batch_signer=batch_signer,
+            measurement=1.5,
+            sensor_id='benchmark-sensor',
+            timestamp=batches)
+        batches += 1
+    return batches / duration
+
+
+def main():
+    opts = parse_args(sys.argv[1:])
+    print('{:<12} {:>10} {:>14}'.format('signer', 'per core', 'all processes'))
+    with multiprocessing.Pool(opts.processes) as pool:
+        for label, cached in (('per-request', False), ('cached', True)):
+            rates = pool.map(
+                _sign_batches, [(cached, opts.duration)] * opts.processes)
+            print('{:<12} {:>8.1f}/s {:>12.1f}/s'.format(
+                label, sum(rates) / len(rates), sum(rates)))
@@ -40,7 +40,7 @@ def make_create_admin_transaction(transaction_signer,
     """
 
     admin_address = addresser.get_admin_address(
-        transaction_signer.get_public_key().as_hex())
+        _public_key_hex(transaction_signer))
 
     inputs = [admin_address]
 
@@ -83,7 +83,7 @@ def make_create_user_transaction(transaction_signer,
     """
 
     user_address = addresser.get_user_address(
-        transaction_signer.get_public_key().as_hex())
+        _public_key_hex(transaction_signer))
     
     admin_address = addresser.get_admin_address(admin_public_key)
 
@@ -129,7 +129,7 @@ def make_update_user_transaction(transaction_signer,
         batch_pb2.Batch: The transaction wrapped in a batch
     """
     user_address = addresser.get_user_address(
-        transaction_signer.get_public_key().as_hex())
+        _public_key_hex(transaction_signer))
 
     admin_address = addresser.get_admin_address(admin_public_key)
 
@@ -182,7 +182,7 @@ def make_create_sensor_transaction(transaction_signer,
 
     inputs = [
         addresser.get_user_address(
-            transaction_signer.get_public_key().as_hex()),
+            _public_key_hex(transaction_signer)),
         addresser.get_sensor_address(sensor_id)
     ]
 
@@ -227,7 +227,7 @@ def make_update_sensor_transaction(transaction_signer,
         batch_pb2.Batch: The transaction wrapped in a batch
     """
     user_address = addresser.get_user_address(
-        transaction_signer.get_public_key().as_hex())
+        _public_key_hex(transaction_signer))
     sensor_address = addresser.get_sensor_address(sensor_id)
 
     inputs = [user_address, sensor_address]
@@ -252,6 +252,38 @@ def make_update_sensor_transaction(transaction_signer,
         batch_signer=batch_signer)
 
 
+def make_update_sensor_batches(transaction_signer,
+                               batch_signer,
+                               readings):
+    """Make an UpdateSensorAction batch for each of many readings
+
+    Args:
+        transaction_signer (sawtooth_signing.Signer): The transaction key pair
+        batch_signer (sawtooth_signing.Signer): The batch key pair
+        readings (list): dicts with the sensor_id, measurement and
+            timestamp of each reading
+
+    Returns:
+        list of batch_pb2.Batch: One batch per reading, in order
+    """
+    return [
+        make_update_sensor_transaction(
+            transaction_signer=transaction_signer,
+            batch_signer=batch_signer,
+            measurement=reading['measurement'],
+            sensor_id=reading['sensor_id'],
+            timestamp=reading['timestamp'])
+        for reading in readings]
+
+
+def _public_key_hex(signer):
+    # Signers cached by the Messenger carry their public key hex already
+    public_key_hex = getattr(signer, 'public_key_hex', None)
+    if public_key_hex is None:
+        public_key_hex = signer.get_public_key().as_hex()
+    return public_key_hex
+
+
 def _make_batch(payload_bytes,
                 inputs,
                 outputs,
@@ -263,8 +295,8 @@ def _make_batch(payload_bytes,
         family_version=addresser.FAMILY_VERSION,
         inputs=inputs,
         outputs=outputs,
-        signer_public_key=transaction_signer.get_public_key().as_hex(),
-        batcher_public_key=batch_signer.get_public_key().as_hex(),
+        signer_public_key=_public_key_hex(transaction_signer),
+        batcher_public_key=_public_key_hex(batch_signer),
         dependencies=[],
         payload_sha512=hashlib.sha512(payload_bytes).hexdigest())
     transaction_header_bytes = transaction_header.SerializeToString()
@@ -275,7 +307,7 @@ def _make_batch(payload_bytes,
         payload=payload_bytes)
 
     batch_header = batch_pb2.BatchHeader(
-        signer_public_key=batch_signer.get_public_key().as_hex(),
+        signer_public_key=_public_key_hex(batch_signer),
         transaction_ids=[transaction.header_signature])
     batch_header_bytes = batch_header.SerializeToString()
 
@@ -306,7 +338,7 @@ def _make_batch(payload_bytes,
 #         batch_pb2.Batch: The transaction wrapped in a batch
 #     """
 #     sending_user_address = addresser.get_user_address(
-#         transaction_signer.get_public_key().as_hex())
+#         _public_key_hex(transaction_signer))
 #     receiving_user_address = addresser.get_user_address(receiving_user)
 #     sensor_address = addresser.get_sensor_address(sensor_id)
 
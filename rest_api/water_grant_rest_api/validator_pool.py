@@ -0,0 +1,172 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+import asyncio
+import logging
+import time
+
+from sawtooth_rest_api.messaging import Connection
+from sawtooth_rest_api.messaging import DisconnectError
+from sawtooth_rest_api.messaging import SendBackoffTimeoutError
+from sawtooth_rest_api.protobuf import client_block_pb2
+from sawtooth_rest_api.protobuf import client_list_control_pb2
+from sawtooth_rest_api.protobuf import validator_pb2
+
+from water_grant_rest_api.errors import ApiServiceUnavailable
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ValidatorEndpoint(object):
+    def __init__(self, url):
+        self.url = url
+        self.connection = Connection(url)
+        self.healthy = True
+        self.pending = 0
+        self.sent = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_check = None
+
+    def snapshot(self):
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'pending': self.pending,
+            'sent': self.sent,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_check': self.last_check,
+        }
+
+
+class ValidatorPool(object):
+    """Connections to several validators, used like a single
+    sawtooth_rest_api.messaging.Connection.
+
+    Every message goes to one healthy validator, picked in turn or as the
+    one with the fewest replies pending. A validator that drops or does
+    not answer is marked unhealthy and the message is sent to the next
+    one, and a periodic health check brings it back once it answers again.
+    All validators share the chain, so batches submitted to any of them
+    reach the others by gossip.
+    """
+    def __init__(self, urls, policy='round-robin'):
+        if not urls:
+            raise ValueError('At least one validator url is required')
+        self._endpoints = [ValidatorEndpoint(url) for url in urls]
+        self._policy = policy
+        self._next = 0
+
+    def open(self):
+        for endpoint in self._endpoints:
+            endpoint.connection.open()
+
+    def close(self):
+        for endpoint in self._endpoints:
+            endpoint.connection.close()
+
+    async def send(self, message_type, message_content, timeout=None):
+        """Sends the message to the validators in dispatch order until one
+        answers
+        """
+        for endpoint in self._dispatch_order():
+            endpoint.pending += 1
+            try:
+                response = await endpoint.connection.send(
+                    message_type, message_content, timeout=timeout)
+            except (DisconnectError, SendBackoffTimeoutError,
+                    asyncio.TimeoutError) as err:
+                self._failed(endpoint, err)
+                continue
+            finally:
+                endpoint.pending -= 1
+            endpoint.sent += 1
+            endpoint.healthy = True
+            return response
+        raise ApiServiceUnavailable('nenhum validador disponível.')
+
+    def _dispatch_order(self):
+        if self._policy == 'least-pending':
+            endpoints = sorted(
+                self._endpoints, key=lambda endpoint: endpoint.pending)
+        else:
+            start = self._next
+            self._next = (start + 1) % len(self._endpoints)
+            endpoints = self._endpoints[start:] + self._endpoints[:start]
+        # Unhealthy validators are the last resort, not excluded
+        return [endpoint for endpoint in endpoints if endpoint.healthy] + \
+            [endpoint for endpoint in endpoints if not endpoint.healthy]
+
+    def _failed(self, endpoint, err):
+        if endpoint.healthy:
+            LOGGER.warning('Validator %s failed: %r', endpoint.url, err)
+        endpoint.healthy = False
+        endpoint.failures += 1
+        endpoint.last_error = repr(err)
+
+    def is_ready(self):
+        return any(endpoint.healthy for endpoint in self._endpoints)
+
+    async def wait_ready(self, timeout, interval=1):
+        """Checks the validators until one answers, for up to timeout
+        seconds. Returns whether one did
+        """
+        deadline = time.time() + timeout
+        while True:
+            if await self._check_all(min(interval, timeout)):
+                return True
+            if time.time() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+
+    async def check_health(self, interval=5, timeout=2):
+        """Asks every validator for its latest block every interval seconds,
+        marking those that do not answer within timeout as unhealthy
+        """
+        while True:
+            await self._check_all(timeout)
+            await asyncio.sleep(interval)
+
+    async def _check_all(self, timeout):
+        request = client_block_pb2.ClientBlockListRequest(
+            paging=client_list_control_pb2.ClientPagingControls(limit=1))
+        request_bytes = request.SerializeToString()
+        answered = False
+        for endpoint in self._endpoints:
+            endpoint.last_check = time.time()
+            try:
+                await asyncio.wait_for(
+                    endpoint.connection.send(
+                        validator_pb2.Message.CLIENT_BLOCK_LIST_REQUEST,
+                        request_bytes),
+                    timeout)
+            except (DisconnectError, SendBackoffTimeoutError,
+                    asyncio.TimeoutError) as err:
+                self._failed(endpoint, err)
+                continue
+            if not endpoint.healthy:
+                LOGGER.info('Validator %s is back', endpoint.url)
+            endpoint.healthy = True
+            answered = True
+        return answered
+
+    def snapshot(self):
+        return {
+            'policy': self._policy,
+            'validators': [
+                endpoint.snapshot() for endpoint in self._endpoints],
+        }
@@ -0,0 +1,126 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+"""Starts water-grant-rest-api with an increasing number of --workers and
+load tests each, reporting how requests/s scale with the processes. Any
+arguments after -- are passed on to water-grant-rest-api, e.g. the database
+and validator to use.
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+
+from water_grant_rest_api.load_test import report
+from water_grant_rest_api.load_test import run_level
+
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+REST_API_BIN = os.path.join(TOP_DIR, 'bin', 'water-grant-rest-api')
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Measures REST API throughput per number of workers')
+    parser.add_argument(
+        '-w', '--workers',
+        help='Comma separated numbers of workers to run',
+        default='1,2,4,{}'.format(os.cpu_count()))
+    parser.add_argument(
+        '-B', '--bind',
+        help='host:port the REST API is started on',
+        default='127.0.0.1:8000')
+    parser.add_argument(
+        '-p', '--path',
+        help='Path to request, may be given several times',
+        action='append')
+    parser.add_argument(
+        '-c', '--concurrency',
+        help='Clients requesting at once',
+        type=int,
+        default=64)
+    parser.add_argument(
+        '-d', '--duration',
+        help='Seconds to load each number of workers',
+        type=float,
+        default=10)
+    parser.add_argument(
+        '--startup-timeout',
+        help='Seconds to wait for the REST API to answer /healthz',
+        type=float,
+        default=60)
+
+    if '--' in args:
+        split = args.index('--')
+        opts = parser.parse_args(args[:split])
+        opts.rest_api_args = args[split + 1:]
+    else:
+        opts = parser.parse_args(args)
+        opts.rest_api_args = []
+    return opts
+
+
+async def wait_for_workers(url, workers, timeout):
+    """Polls /healthz on new connections until as many processes as
+    workers answered
+    """
+    deadline = time.time() + timeout
+    answered = set()
+    connector = aiohttp.TCPConnector(force_close=True)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        while time.time() < deadline:
+            try:
+                async with session.get(url + '/healthz') as response:
+                    if response.status == 200:
+                        body = await response.json()
+                        answered.add(body['startup'].get('pid'))
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+            if len(answered) >= workers:
+                return True
+    return False
+
+
+def main():
+    opts = parse_args(sys.argv[1:])
+    paths = opts.path or ['/sensors?limit=100']
+    url = 'http://' + opts.bind
+    loop = asyncio.get_event_loop()
+
+    print('{:>6} {:>10} {:>9} {:>9} {:>9} {:>7}'.format(
+        'procs', 'req/s', 'p50 ms', 'p99 ms', 'max ms', 'errors'))
+    for workers in [int(w) for w in opts.workers.split(',')]:
+        process = subprocess.Popen(
+            [sys.executable, REST_API_BIN, '-B', opts.bind,
+             '--workers', str(workers)] + opts.rest_api_args,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        try:
+            if not loop.run_until_complete(
+                    wait_for_workers(url, workers, opts.startup_timeout)):
+                print('{:>6} did not start'.format(workers))
+                continue
+            throughput, latencies, errors = loop.run_until_complete(
+                run_level(url, paths, opts.concurrency, opts.duration))
+            report(workers, throughput, latencies, errors)
+        finally:
+            process.terminate()
+            process.wait()
@@ -120,6 +120,12 @@ const get = _.partial(request, 'GET')
 const post = _.partial(request, 'POST')
 const put = _.partial(request, 'PUT')
 
+/**
+ * Opens a server-sent events stream of an api endpoint. EventSource can not
+ * send headers, so only public streams can be followed
+ */
+const events = endpoint => new window.EventSource(API_PATH + endpoint)
+
 /**
  * Sends the user an alert with the error message and reloads the page.
  * Appropriate for requests triggered by user action.
@@ -142,5 +148,6 @@ module.exports = {
   post,
   get,
   put,
+  events,
   alertError
 }
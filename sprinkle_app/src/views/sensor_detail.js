@@ -62,6 +62,20 @@ const SensorDetailPage = {
 
       // Inicializa o estado da página para 1
       vnode.state.page = 1
+
+    // Acrescenta as novas leituras sem buscar o sensor novamente
+    vnode.state.events = api.events(`sensors/${vnode.attrs.sensorId}/events`)
+    vnode.state.events.addEventListener('measurement', e => {
+      const measurements = _.get(vnode.state, 'sensor.measurements')
+      if (measurements) {
+        measurements.push(_.pick(JSON.parse(e.data), ['measurement', 'timestamp']))
+        m.redraw()
+      }
+    })
+  },
+
+  onremove (vnode) {
+    vnode.state.events.close()
   },
 
   view (vnode) {
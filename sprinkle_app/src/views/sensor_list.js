@@ -26,7 +26,7 @@ const SensorList = {
   oninit (vnode) {
     vnode.state.sensors = []
     if (api.getIsAdmin()) {
-      api.get('sensors').then((sensors) => {
+      api.get('sensors?fields=sensor_id').then((sensors) => {
         vnode.state.sensors = sortBy(sensors, 'sensor_id')
       })
     } else {
@@ -44,7 +44,7 @@ const SensorList = {
           placeholder: 'Procurar por ID',
           oninput: (e) => {
             const searchId = e.target.value
-            api.get('sensors').then((sensors) => {
+            api.get('sensors?fields=sensor_id').then((sensors) => {
               vnode.state.sensors = sortBy(
                 sensors.filter(
                   sensor => sensor.sensor_id.includes(searchId)),
@@ -0,0 +1,143 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+"""Measures measurement rows/s written by the subscriber, comparing the
+str.format statements it used to build against the prepared statements of
+Database. Everything runs in one transaction that is rolled back at the end,
+so the benchmark can be pointed at a live database.
+
+Closing the previous measurement gets slower with every row of the sensor,
+so each run writes to a sensor of its own and is rolled back to a savepoint
+after it, and the variants alternate which runs first. The best and median
+of the runs are reported.
+"""
+
+import argparse
+import functools
+import statistics
+import sys
+import time
+
+from water_grant_subscriber.database import Database
+from water_grant_subscriber.database import MAX_BLOCK_NUMBER
+
+
+BENCH_SENSOR_ID = 'benchmark-sensor-{}-{}'
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks subscriber measurement inserts')
+    parser.add_argument('--db-name', default='water-grant')
+    parser.add_argument('--db-host', default='postgres')
+    parser.add_argument('--db-port', default='5432')
+    parser.add_argument('--db-user', default='sawtooth')
+    parser.add_argument('--db-password', default='sawtooth')
+    parser.add_argument(
+        '-n', '--rows',
+        help='Number of measurements written by each variant',
+        type=int,
+        default=10000)
+    parser.add_argument(
+        '-r', '--repeat',
+        help='Number of runs of each variant',
+        type=int,
+        default=5)
+    return parser.parse_args(args)
+
+
+def _formatted_inserts(cursor, sensor_id, rows):
+    for block_num in range(1, rows + 1):
+        cursor.execute("""
+        UPDATE measurements SET end_block_num = {}
+        WHERE end_block_num = {} AND sensor_id = '{}'
+        """.format(block_num, MAX_BLOCK_NUMBER, sensor_id))
+        cursor.execute("""
+        INSERT INTO measurements (
+        sensor_id,
+        measurement,
+        timestamp,
+        start_block_num,
+        end_block_num)
+        VALUES ('{}', '{}', '{}', '{}', '{}');
+        """.format(
+            sensor_id, 1.5, block_num, block_num, MAX_BLOCK_NUMBER))
+
+
+def _prepared_inserts(database, cursor, sensor_id, rows):
+    # pylint: disable=protected-access
+    for block_num in range(1, rows + 1):
+        database._execute(
+            cursor, 'close_measurements',
+            block_num, MAX_BLOCK_NUMBER, sensor_id)
+        database._execute(
+            cursor, 'insert_measurement',
+            sensor_id, 1.5, block_num, block_num, MAX_BLOCK_NUMBER)
+
+
+def _timed_run(cursor, func, sensor_id, rows):
+    cursor.execute('SAVEPOINT bench_run')
+    cursor.execute(
+        'INSERT INTO sensors (sensor_id, created_at, '
+        'start_block_num, end_block_num) VALUES (%s, 0, 0, %s)',
+        (sensor_id, MAX_BLOCK_NUMBER))
+    start = time.perf_counter()
+    func(cursor, sensor_id, rows)
+    elapsed = time.perf_counter() - start
+    cursor.execute('ROLLBACK TO SAVEPOINT bench_run')
+    return elapsed
+
+
+def _report(label, rows, elapsed):
+    best = min(elapsed)
+    median = statistics.median(elapsed)
+    print('{:<10} {:>8} rows  best {:>7.3f}s {:>10.1f} rows/s  '
+          'median {:>7.3f}s {:>10.1f} rows/s'.format(
+              label, rows, best, rows / best, median, rows / median))
+
+
+def main():
+    opts = parse_args(sys.argv[1:])
+    dsn = 'dbname={} user={} password={} host={} port={}'.format(
+        opts.db_name,
+        opts.db_user,
+        opts.db_password,
+        opts.db_host,
+        opts.db_port)
+
+    database = Database(dsn)
+    database.connect()
+    database.create_tables()
+
+    # pylint: disable=protected-access
+    try:
+        with database._conn.cursor() as cursor:
+            variants = (
+                ('formatted', _formatted_inserts),
+                ('prepared', functools.partial(_prepared_inserts, database)),
+            )
+            elapsed = {label: [] for label, _ in variants}
+            for run in range(opts.repeat):
+                ordered = variants if run % 2 == 0 else variants[::-1]
+                for label, func in ordered:
+                    elapsed[label].append(_timed_run(
+                        cursor, func, BENCH_SENSOR_ID.format(label, run),
+                        opts.rows))
+
+            for label, _ in variants:
+                _report(label, opts.rows, elapsed[label])
+    finally:
+        database.rollback()
+        database.disconnect()
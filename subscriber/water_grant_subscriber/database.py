@@ -13,7 +13,10 @@
 # limitations under the License.
 # -----------------------------------------------------------------------------
 
+from collections import Counter
+import json
 import logging
+import math
 import time
 
 import psycopg2
@@ -21,6 +24,10 @@ from psycopg2.extras import RealDictCursor
 
 
 LOGGER = logging.getLogger(__name__)
+MAX_BLOCK_NUMBER = int(math.pow(2, 63)) - 1
+CHANGES_CHANNEL = 'water_grant_changes'
+# NOTIFY payloads must stay under 8000 bytes
+MAX_NOTIFY_PAYLOAD = 7900
 
 
 CREATE_BLOCK_STMTS = """
@@ -66,6 +73,46 @@ CREATE TABLE IF NOT EXISTS users (
 );
 """
 
+# users keeps one row per public key, which sensor_owners references, and
+# is overwritten by every update. Its versions are kept here, append-only,
+# so a fork can put back the version a user had before it.
+CREATE_USER_VERSION_STMTS = """
+CREATE TABLE IF NOT EXISTS user_versions (
+    id                           bigserial PRIMARY KEY,
+    public_key                   varchar,
+    name                         varchar,
+    created_at                   bigint,
+    quota                        float,
+    created_by_admin_public_key  varchar,
+    updated_by_admin_public_key  varchar,
+    updated_at                   bigint,
+    start_block_num              bigint,
+    end_block_num                bigint
+);
+CREATE INDEX IF NOT EXISTS user_versions_public_key_idx
+    ON user_versions (public_key, end_block_num);
+"""
+
+# Databases created before user_versions existed start it from the current
+# users, the versions before them are not known
+BACKFILL_USER_VERSIONS = """
+INSERT INTO user_versions (
+    public_key,
+    name,
+    created_at,
+    quota,
+    created_by_admin_public_key,
+    updated_by_admin_public_key,
+    updated_at,
+    start_block_num,
+    end_block_num)
+SELECT public_key, name, created_at, quota, created_by_admin_public_key,
+       updated_by_admin_public_key, updated_at, start_block_num,
+       end_block_num
+FROM users
+WHERE NOT EXISTS (SELECT 1 FROM user_versions)
+"""
+
 CREATE_SENSOR_STMTS = """
 CREATE TABLE IF NOT EXISTS sensors (
     id               bigserial PRIMARY KEY,
@@ -85,6 +132,9 @@ CREATE TABLE IF NOT EXISTS measurements (
     start_block_num  bigint,
     end_block_num    bigint
 );
+
+CREATE INDEX IF NOT EXISTS measurements_sensor_id_timestamp_idx
+ON measurements (sensor_id, timestamp);
 """
 
 CREATE_SENSOR_LOCATION_STMTS = """
@@ -110,11 +160,269 @@ CREATE TABLE IF NOT EXISTS sensor_owners (
 );
 """
 
+# Single row holding the last block whose rows were committed. It is written
+# in the same transaction as the block's rows, so anything in the tables
+# above it was left by an interrupted write and is dropped on resume.
+CREATE_CHECKPOINT_STMTS = """
+CREATE TABLE IF NOT EXISTS subscriber_checkpoint (
+    id          smallint PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    block_num   bigint,
+    block_id    varchar,
+    updated_at  timestamp with time zone
+);
+"""
+
+CREATE_USAGE_MONTHLY_STMTS = """
+CREATE TABLE IF NOT EXISTS usage_monthly (
+    user_public_key      varchar,
+    sensor_id            varchar references sensors(sensor_id),
+    month                date,
+    total                float,
+    last_measurement_ts  bigint,
+    PRIMARY KEY (user_public_key, sensor_id, month)
+);
+"""
+
+# Usage of each user as served by the REST API: the sum, over the user's
+# sensors, of the total of the latest month with readings. Kept up to date
+# with every measurement, so it is read without aggregating usage_monthly.
+CREATE_USER_USAGE_STMTS = """
+CREATE TABLE IF NOT EXISTS user_usage (
+    user_public_key  varchar PRIMARY KEY,
+    total            float
+);
+"""
+
+REBUILD_USER_USAGE = """
+INSERT INTO user_usage (user_public_key, total)
+SELECT latest.user_public_key, SUM(latest.total)
+FROM (
+    SELECT DISTINCT ON (user_public_key, sensor_id) user_public_key, total
+    FROM usage_monthly
+    ORDER BY user_public_key, sensor_id, month DESC
+) AS latest
+GROUP BY latest.user_public_key
+"""
+
+# Rebuilds the monthly aggregate from the measurements history. Only runs
+# when the aggregate is empty, so databases created before usage_monthly
+# existed are backfilled once on startup.
+BACKFILL_USAGE_MONTHLY = """
+INSERT INTO usage_monthly
+(user_public_key, sensor_id, month, total, last_measurement_ts)
+SELECT owners.user_public_key,
+       measurements.sensor_id,
+       DATE_TRUNC('month', to_timestamp(measurements.timestamp))::date,
+       SUM(measurements.measurement),
+       MAX(measurements.timestamp)
+FROM measurements
+JOIN (
+    SELECT DISTINCT ON (sensor_id) sensor_id, user_public_key
+    FROM sensor_owners
+    ORDER BY sensor_id, timestamp DESC
+) AS owners ON owners.sensor_id = measurements.sensor_id
+WHERE NOT EXISTS (SELECT 1 FROM usage_monthly)
+GROUP BY 1, 2, 3
+"""
+
+# Statements executed for every block, prepared once per connection by
+# Database._execute. Each entry maps a name to its parameter types and body.
+PREPARED_STATEMENTS = {
+    'fetch_block': ('bigint', """
+        SELECT block_num, block_id FROM blocks WHERE block_num = $1
+    """),
+    'insert_block': ('bigint, varchar', """
+        INSERT INTO blocks (block_num, block_id) VALUES ($1, $2)
+    """),
+    'save_checkpoint': ('bigint, varchar', """
+        INSERT INTO subscriber_checkpoint (id, block_num, block_id, updated_at)
+        VALUES (1, $1, $2, now())
+        ON CONFLICT (id) DO UPDATE
+        SET
+            block_num = EXCLUDED.block_num,
+            block_id = EXCLUDED.block_id,
+            updated_at = EXCLUDED.updated_at
+    """),
+    'close_admin': ('bigint, bigint, varchar', """
+        UPDATE admins SET end_block_num = $1
+        WHERE end_block_num = $2 AND public_key = $3
+    """),
+    'insert_admin': ('varchar, varchar, bigint, bigint, bigint', """
+        INSERT INTO admins (
+            public_key,
+            name,
+            created_at,
+            start_block_num,
+            end_block_num)
+        VALUES ($1, $2, $3, $4, $5)
+    """),
+    'close_user_version': ('bigint, bigint, varchar', """
+        UPDATE user_versions SET end_block_num = $1
+        WHERE end_block_num = $2 AND public_key = $3
+    """),
+    'insert_user_version': (
+        'varchar, varchar, bigint, float, varchar, varchar, bigint, '
+        'bigint, bigint', """
+        INSERT INTO user_versions (
+            public_key,
+            name,
+            created_at,
+            quota,
+            created_by_admin_public_key,
+            updated_by_admin_public_key,
+            updated_at,
+            start_block_num,
+            end_block_num)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+    """),
+    'insert_user': (
+        'varchar, varchar, bigint, float, varchar, varchar, bigint, '
+        'bigint, bigint', """
+        INSERT INTO users (
+            public_key,
+            name,
+            created_at,
+            quota,
+            created_by_admin_public_key,
+            updated_by_admin_public_key,
+            updated_at,
+            start_block_num,
+            end_block_num)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+        ON CONFLICT (public_key) DO UPDATE
+        SET
+            name = EXCLUDED.name,
+            created_at = EXCLUDED.created_at,
+            quota = EXCLUDED.quota,
+            created_by_admin_public_key = EXCLUDED.created_by_admin_public_key,
+            updated_by_admin_public_key = EXCLUDED.updated_by_admin_public_key,
+            updated_at = EXCLUDED.updated_at,
+            start_block_num = EXCLUDED.start_block_num,
+            end_block_num = EXCLUDED.end_block_num
+    """),
+    'close_sensor': ('bigint, bigint, varchar', """
+        UPDATE sensors SET end_block_num = $1
+        WHERE end_block_num = $2 AND sensor_id = $3
+    """),
+    'insert_sensor': ('varchar, bigint, bigint, bigint', """
+        INSERT INTO sensors (
+            sensor_id,
+            created_at,
+            start_block_num,
+            end_block_num)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (sensor_id) DO UPDATE
+        SET
+            start_block_num = EXCLUDED.start_block_num,
+            end_block_num = EXCLUDED.end_block_num
+    """),
+    'close_sensor_locations': ('bigint, bigint, varchar', """
+        UPDATE sensor_locations SET end_block_num = $1
+        WHERE end_block_num = $2 AND sensor_id = $3
+    """),
+    'insert_sensor_location': (
+        'varchar, bigint, bigint, bigint, bigint, bigint', """
+        INSERT INTO sensor_locations (
+            sensor_id,
+            latitude,
+            longitude,
+            timestamp,
+            start_block_num,
+            end_block_num)
+        VALUES ($1, $2, $3, $4, $5, $6)
+    """),
+    'close_measurements': ('bigint, bigint, varchar', """
+        UPDATE measurements SET end_block_num = $1
+        WHERE end_block_num = $2 AND sensor_id = $3
+    """),
+    'insert_measurement': ('varchar, float, bigint, bigint, bigint', """
+        INSERT INTO measurements (
+            sensor_id,
+            measurement,
+            timestamp,
+            start_block_num,
+            end_block_num)
+        VALUES ($1, $2, $3, $4, $5)
+    """),
+    # Runs before upsert_usage. A reading of the sensor's latest month adds
+    # to the user's usage, one of a newer month replaces that month's total
+    # and one of an older month leaves it unchanged.
+    'credit_user_usage': ('varchar, varchar, float, bigint', """
+        INSERT INTO user_usage AS usage (user_public_key, total)
+        SELECT $1, CASE
+            WHEN latest.month IS NULL
+                OR latest.month = DATE_TRUNC('month', to_timestamp($4))::date
+                THEN $3
+            WHEN latest.month < DATE_TRUNC('month', to_timestamp($4))::date
+                THEN $3 - latest.total
+            ELSE 0
+        END
+        FROM (SELECT 1) AS reading
+        LEFT JOIN (
+            SELECT month, total FROM usage_monthly
+            WHERE user_public_key = $1 AND sensor_id = $2
+            ORDER BY month DESC
+            LIMIT 1
+        ) AS latest ON true
+        ON CONFLICT (user_public_key) DO UPDATE
+        SET total = usage.total + EXCLUDED.total
+    """),
+    'upsert_usage': ('varchar, varchar, float, bigint', """
+        INSERT INTO usage_monthly (
+            user_public_key,
+            sensor_id,
+            month,
+            total,
+            last_measurement_ts)
+        VALUES ($1, $2, DATE_TRUNC('month', to_timestamp($4))::date, $3, $4)
+        ON CONFLICT (user_public_key, sensor_id, month) DO UPDATE
+        SET
+            total = usage_monthly.total + EXCLUDED.total,
+            last_measurement_ts = GREATEST(
+                usage_monthly.last_measurement_ts,
+                EXCLUDED.last_measurement_ts)
+    """),
+    'close_sensor_owners': ('bigint, bigint, varchar', """
+        UPDATE sensor_owners SET end_block_num = $1
+        WHERE end_block_num = $2 AND sensor_id = $3
+    """),
+    'insert_sensor_owner': ('varchar, varchar, bigint, bigint, bigint', """
+        INSERT INTO sensor_owners (
+            sensor_id,
+            user_public_key,
+            timestamp,
+            start_block_num,
+            end_block_num)
+        VALUES ($1, $2, $3, $4, $5)
+    """),
+    'delete_usage': ('varchar, date', """
+        DELETE FROM usage_monthly WHERE sensor_id = $1 AND month = $2
+    """),
+    'rebuild_usage': ('varchar, date', """
+        INSERT INTO usage_monthly
+        (user_public_key, sensor_id, month, total, last_measurement_ts)
+        SELECT owners.user_public_key, measurements.sensor_id, $2,
+               SUM(measurements.measurement), MAX(measurements.timestamp)
+        FROM measurements
+        JOIN (
+            SELECT DISTINCT ON (sensor_id) sensor_id, user_public_key
+            FROM sensor_owners
+            WHERE sensor_id = $1
+            ORDER BY sensor_id, timestamp DESC
+        ) AS owners ON owners.sensor_id = measurements.sensor_id
+        WHERE measurements.sensor_id = $1
+        AND DATE_TRUNC('month', to_timestamp(measurements.timestamp))::date
+            = $2
+        GROUP BY owners.user_public_key, measurements.sensor_id
+    """),
+}
+
 # REMOVER INSERT_INITIAL_ADMIN
 INSERT_INITIAL_ADMIN = """
 INSERT INTO auth
 (public_key, username, hashed_password, encrypted_private_key, is_admin)
-VALUES('038713b42df2e514aa654495ecda8a8f9a6cd75760e99df2ff6f02dccb46446c81', 'admin', '243262243132246a395a4b744676364a7045516770493668514d43322e546761376e73477442754c61354f5a6a6174586b41684964354568596c7061', 'e47570d73c1334498f14e9bab8de4d5e8d6408a646e29cb13a9455bc9b393157d0825ca4c783654f01d98870216f743b33036ef4b710e78bfd136e9465a23e3d', true);
+VALUES('038713b42df2e514aa654495ecda8a8f9a6cd75760e99df2ff6f02dccb46446c81', 'admin', '243262243132246a395a4b744676364a7045516770493668514d43322e546761376e73477442754c61354f5a6a6174586b41684964354568596c7061', 'e47570d73c1334498f14e9bab8de4d5e8d6408a646e29cb13a9455bc9b393157d0825ca4c783654f01d98870216f743b33036ef4b710e78bfd136e9465a23e3d', true)
+ON CONFLICT (public_key) DO NOTHING;
 """
 
 class Database(object):
@@ -123,6 +431,9 @@ class Database(object):
     def __init__(self, dsn):
         self._dsn = dsn
         self._conn = None
+        self._rows_written = Counter()
+        # Names of the PREPARED_STATEMENTS prepared in the current connection
+        self._prepared = set()
 
     def connect(self, retries=5, initial_delay=1, backoff=2):
         """Initializes a connection to the database
@@ -132,17 +443,18 @@ class Database(object):
             initial_delay (int): Number of seconds wait between reconnects
             backoff (int): Multiplies the delay after each retry
         """
-        print('Connecting to database')
+        LOGGER.info('Connecting to database')
 
         delay = initial_delay
         for attempt in range(retries):
             try:
                 self._conn = psycopg2.connect(self._dsn)
-                print('Successfully connected to database')
+                self._prepared = set()
+                LOGGER.info('Successfully connected to database')
                 return
 
             except psycopg2.OperationalError:
-                print(
+                LOGGER.warning(
                     'Connection failed.'
                     ' Retrying connection (%s retries remaining)',
                     retries - attempt)
@@ -150,37 +462,55 @@ class Database(object):
                 delay *= backoff
 
         self._conn = psycopg2.connect(self._dsn)
-        print('Successfully connected to database')
+        self._prepared = set()
+        LOGGER.info('Successfully connected to database')
 
     def create_tables(self):
         """Creates the Water Grant tables
         """
         with self._conn.cursor() as cursor:
-            print('Creating table: blocks')
+            LOGGER.debug('Creating table: blocks')
             cursor.execute(CREATE_BLOCK_STMTS)
 
-            print('Creating table: auth')
+            LOGGER.debug('Creating table: subscriber_checkpoint')
+            cursor.execute(CREATE_CHECKPOINT_STMTS)
+
+            LOGGER.debug('Creating table: auth')
             cursor.execute(CREATE_AUTH_STMTS)
 
-            print('Creating table: admins')
+            LOGGER.debug('Creating table: admins')
             cursor.execute(CREATE_ADMIN_STMTS)
 
-            print('Creating table: users')
+            LOGGER.debug('Creating table: users')
             cursor.execute(CREATE_USER_STMTS)
 
-            print('Creating table: sensors')
+            LOGGER.debug('Creating table: user_versions')
+            cursor.execute(CREATE_USER_VERSION_STMTS)
+            cursor.execute(BACKFILL_USER_VERSIONS)
+
+            LOGGER.debug('Creating table: sensors')
             cursor.execute(CREATE_SENSOR_STMTS)
 
-            print('Creating table: measurements')
+            LOGGER.debug('Creating table: measurements')
             cursor.execute(CREATE_MEASUREMENT_STMTS)
 
-            print('Creating table: sensor_locations')
+            LOGGER.debug('Creating table: sensor_locations')
             cursor.execute(CREATE_SENSOR_LOCATION_STMTS)
 
-            print('Creating table: sensor_owners')
+            LOGGER.debug('Creating table: sensor_owners')
             cursor.execute(CREATE_SENSOR_OWNER_STMTS)
 
-            print('Inserting initial admin')
+            LOGGER.debug('Creating table: usage_monthly')
+            cursor.execute(CREATE_USAGE_MONTHLY_STMTS)
+            cursor.execute(BACKFILL_USAGE_MONTHLY)
+
+            LOGGER.debug('Creating table: user_usage')
+            cursor.execute(CREATE_USER_USAGE_STMTS)
+            cursor.execute('SELECT 1 FROM user_usage LIMIT 1')
+            if cursor.fetchone() is None:
+                cursor.execute(REBUILD_USER_USAGE)
+
+            LOGGER.debug('Inserting initial admin')
             cursor.execute(INSERT_INITIAL_ADMIN)
 
         self._conn.commit()
@@ -188,7 +518,7 @@ class Database(object):
     def disconnect(self):
         """Closes the connection to the database
         """
-        print('Disconnecting from database')
+        LOGGER.info('Disconnecting from database')
         if self._conn is not None:
             self._conn.close()
 
@@ -198,309 +528,356 @@ class Database(object):
     def rollback(self):
         self._conn.rollback()
 
-    def drop_fork(self, block_num):
-        """Deletes all resources from a particular block_num
+    def begin_block(self):
+        """Opens a savepoint for the rows of one block, so a failing block
+        can be undone without losing the others of an uncommitted batch
         """
-        delete_users = """
-        DELETE FROM users WHERE start_block_num >= {}
-        """.format(block_num)
-        
-        update_users = """
-        UPDATE users SET end_block_num = null
-        WHERE end_block_num >= {}
-        """.format(block_num)
-
-        delete_admins = """
-        DELETE FROM admins WHERE start_block_num >= {}
-        """.format(block_num)
-        
-        update_admins = """
-        UPDATE admins SET end_block_num = null
-        WHERE end_block_num >= {}
-        """.format(block_num)
-
-        delete_measurements = """
-        DELETE FROM measurements WHERE sensor_id =
-        (SELECT sensor_id FROM sensors WHERE start_block_num >= {})
-        """.format(block_num)
-   
-        delete_sensor_locations = """
-        DELETE FROM sensor_locations WHERE sensor_id =
-        (SELECT sensor_id FROM sensors WHERE start_block_num >= {})
-        """.format(block_num)
-        
-        delete_sensor_owners = """
-        DELETE FROM sensor_owners WHERE sensor_id =
-        (SELECT sensor_id FROM sensors WHERE start_block_num >= {})
-        """.format(block_num)
-   
-        delete_sensors = """
-        DELETE FROM sensors WHERE start_block_num >= {}
-        """.format(block_num)
-
-        update_sensors = """
-        UPDATE sensors SET end_block_num = null
-        WHERE end_block_num >= {}
-        """.format(block_num)
-
-        delete_blocks = """
-        DELETE FROM blocks WHERE block_num >= {}
-        """.format(block_num)
+        with self._conn.cursor() as cursor:
+            cursor.execute('SAVEPOINT block')
 
+    def release_block(self):
         with self._conn.cursor() as cursor:
-            cursor.execute(delete_users)
-            cursor.execute(update_users)
-            cursor.execute(delete_admins)
-            cursor.execute(update_admins)
-            cursor.execute(delete_measurements)
-            cursor.execute(delete_sensor_locations)
-            cursor.execute(delete_sensor_owners)
-            cursor.execute(delete_sensors)
-            cursor.execute(update_sensors)
-            cursor.execute(delete_blocks)
+            cursor.execute('RELEASE SAVEPOINT block')
+
+    def rollback_block(self):
+        with self._conn.cursor() as cursor:
+            cursor.execute('ROLLBACK TO SAVEPOINT block')
+            cursor.execute('RELEASE SAVEPOINT block')
+
+    def pop_rows_written(self):
+        """Returns the rows inserted per table since the last call, and
+        resets the counts
+        """
+        rows_written, self._rows_written = self._rows_written, Counter()
+        return rows_written
+
+    def drop_fork(self, block_num):
+        """Deletes all resources from a particular block_num, and reopens
+        the rows the dropped blocks had closed
+        """
+        params = {'block_num': block_num, 'max_block_num': MAX_BLOCK_NUMBER}
+        with self._conn.cursor() as cursor:
+            # Child rows are dropped by their own block range, a fork keeps
+            # the history written before it. The monthly usage of every
+            # (sensor, month) the dropped measurements touched is recomputed
+            # once the measurements and owners of the fork are gone.
+            cursor.execute("""
+                DELETE FROM measurements
+                WHERE start_block_num >= %(block_num)s
+                RETURNING sensor_id,
+                    DATE_TRUNC('month', to_timestamp(timestamp))::date
+                """, params)
+            touched_months = set(cursor.fetchall())
+            for table in ('sensor_locations', 'sensor_owners'):
+                cursor.execute(
+                    'DELETE FROM {} WHERE start_block_num >= %(block_num)s'
+                    .format(table), params)
+            for table in ('measurements', 'sensor_locations', 'sensor_owners'):
+                self._reopen_rows(cursor, table, params)
+            self._rebuild_usage_monthly(cursor, touched_months)
+
+            # sensors is upserted, so the row of a sensor updated by the fork
+            # carries the fork's block. It returns to the block of its
+            # latest remaining measurement, as every version of a sensor
+            # writes one, and is deleted if the fork created it.
+            cursor.execute("""
+                UPDATE sensors SET start_block_num = previous.block_num
+                FROM (
+                    SELECT sensor_id, MAX(start_block_num) AS block_num
+                    FROM measurements
+                    WHERE sensor_id IN (
+                        SELECT sensor_id FROM sensors
+                        WHERE start_block_num >= %(block_num)s)
+                    GROUP BY sensor_id
+                ) AS previous
+                WHERE sensors.start_block_num >= %(block_num)s
+                AND previous.sensor_id = sensors.sensor_id
+                """, params)
+            cursor.execute(
+                'DELETE FROM sensors WHERE start_block_num >= %(block_num)s',
+                params)
+            self._reopen_rows(cursor, 'sensors', params)
+
+            # users is upserted too. A user updated by the fork gets back
+            # its version from before it, and is deleted if the fork
+            # created it. Users reference their admins, which admins
+            # created by the fork no longer have.
+            cursor.execute(
+                'DELETE FROM user_versions '
+                'WHERE start_block_num >= %(block_num)s', params)
+            self._reopen_rows(cursor, 'user_versions', params)
+            cursor.execute("""
+                UPDATE users SET
+                    name = previous.name,
+                    created_at = previous.created_at,
+                    quota = previous.quota,
+                    created_by_admin_public_key =
+                        previous.created_by_admin_public_key,
+                    updated_by_admin_public_key =
+                        previous.updated_by_admin_public_key,
+                    updated_at = previous.updated_at,
+                    start_block_num = previous.start_block_num,
+                    end_block_num = previous.end_block_num
+                FROM user_versions AS previous
+                WHERE users.start_block_num >= %(block_num)s
+                AND previous.public_key = users.public_key
+                AND previous.end_block_num = %(max_block_num)s
+                """, params)
+            cursor.execute(
+                'DELETE FROM users WHERE start_block_num >= %(block_num)s',
+                params)
+            cursor.execute(
+                'DELETE FROM admins WHERE start_block_num >= %(block_num)s',
+                params)
+            self._reopen_rows(cursor, 'admins', params)
+
+            cursor.execute(
+                'DELETE FROM blocks WHERE block_num >= %(block_num)s', params)
+            cursor.execute("""
+                UPDATE subscriber_checkpoint SET (block_num, block_id) = (
+                    SELECT block_num, block_id FROM blocks
+                    ORDER BY block_num DESC LIMIT 1)
+                WHERE block_num >= %(block_num)s
+                """, params)
+
+    @staticmethod
+    def _reopen_rows(cursor, table, params):
+        """Marks the rows of table closed by the dropped blocks as current
+        again, with the end_block_num the REST API queries compare against
+        """
+        cursor.execute(
+            'UPDATE {} SET end_block_num = %(max_block_num)s '
+            'WHERE end_block_num >= %(block_num)s '
+            'AND end_block_num < %(max_block_num)s'.format(table), params)
+
+    def _rebuild_usage_monthly(self, cursor, touched_months):
+        """Recomputes the usage_monthly rows of the given (sensor_id, month)
+        pairs from the measurements that survived a fork
+        """
+        for sensor_id, month in touched_months:
+            self._execute(cursor, 'delete_usage', sensor_id, month)
+            self._execute(cursor, 'rebuild_usage', sensor_id, month)
+        if touched_months:
+            # Forks are rare, recompute every user's usage from scratch
+            cursor.execute('DELETE FROM user_usage')
+            cursor.execute(REBUILD_USER_USAGE)
+
+    def _execute(self, cursor, name, *params):
+        """Executes one of the PREPARED_STATEMENTS with bound parameters,
+        preparing it on first use in the current connection
+        """
+        if name not in self._prepared:
+            types, statement = PREPARED_STATEMENTS[name]
+            cursor.execute('PREPARE {} ({}) AS {}'.format(
+                name, types, statement))
+            self._prepared.add(name)
+
+        cursor.execute(
+            'EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(params))),
+            params)
 
     def fetch_last_known_blocks(self, count):
         """Fetches the specified number of most recent blocks
         """
         fetch = """
         SELECT block_num, block_id FROM blocks
-        ORDER BY block_num DESC LIMIT {}
-        """.format(count)
+        ORDER BY block_num DESC LIMIT %s
+        """
 
         with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute(fetch)
+            cursor.execute(fetch, (count,))
             blocks = cursor.fetchall()
 
         return blocks
 
-    def fetch_block(self, block_num):
+    def fetch_checkpoint(self):
+        """Fetches the last block committed by the subscriber, or None if
+        nothing has been committed yet
+        """
         fetch = """
-        SELECT block_num, block_id FROM blocks WHERE block_num = {}
-        """.format(block_num)
+        SELECT block_num, block_id FROM subscriber_checkpoint
+        WHERE id = 1 AND block_num IS NOT NULL
+        """
 
         with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(fetch)
+            return cursor.fetchone()
+
+    def save_checkpoint(self, block_num, block_id):
+        """Records block_num as fully written. Must run in the same
+        transaction as the block's rows
+        """
+        with self._conn.cursor() as cursor:
+            self._execute(cursor, 'save_checkpoint', block_num, block_id)
+
+    def notify_changes(self, block_num, keys, fork=False):
+        """Notifies CHANGES_CHANNEL listeners of the resources changed by
+        block_num once the transaction commits. keys is sent as null when
+        unknown or too large for a payload, so listeners drop everything.
+        """
+        payload = json.dumps({
+            'block_num': block_num,
+            'keys': sorted(keys) if keys is not None else None,
+            'fork': fork,
+        })
+        if len(payload) > MAX_NOTIFY_PAYLOAD:
+            payload = json.dumps(
+                {'block_num': block_num, 'keys': None, 'fork': fork})
+
+        with self._conn.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_notify(%s, %s)', (CHANGES_CHANNEL, payload))
+
+    def fetch_block(self, block_num):
+        with self._conn.cursor(cursor_factory=RealDictCursor) as cursor:
+            self._execute(cursor, 'fetch_block', block_num)
             block = cursor.fetchone()
 
         return block
 
     def insert_block(self, block_dict):
-        insert = """
-        INSERT INTO blocks (
-        block_num,
-        block_id)
-        VALUES ('{}', '{}');
-        """.format(
-            block_dict['block_num'],
-            block_dict['block_id'])
-
         with self._conn.cursor() as cursor:
-            cursor.execute(insert)
+            self._execute(
+                cursor,
+                'insert_block',
+                block_dict['block_num'],
+                block_dict['block_id'])
+            self._rows_written['blocks'] += cursor.rowcount
 
     def insert_user(self, user_dict):
-        update_user = """
-        UPDATE users SET end_block_num = {}
-        WHERE end_block_num = {} AND public_key = '{}'
-        """.format(
-            user_dict['start_block_num'],
-            user_dict['end_block_num'],
-            user_dict['public_key'])
-
-        insert_user = """
-        INSERT INTO users (
-            public_key,
-            name,
-            created_at,
-            quota,
-            created_by_admin_public_key,
-            updated_by_admin_public_key,
-            updated_at,
-            start_block_num,
-            end_block_num
-        )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (public_key) DO UPDATE
-        SET 
-            name = EXCLUDED.name,
-            created_at = EXCLUDED.created_at,
-            quota = EXCLUDED.quota,
-            created_by_admin_public_key = EXCLUDED.created_by_admin_public_key,
-            updated_by_admin_public_key = EXCLUDED.updated_by_admin_public_key,
-            updated_at = EXCLUDED.updated_at,
-            start_block_num = EXCLUDED.start_block_num,
-            end_block_num = EXCLUDED.end_block_num;
+        """Appends a version of the user, closing the previous one, and
+        makes it the user's row in users
         """
-
+        values = (
+            user_dict['public_key'],
+            user_dict['name'],
+            user_dict['created_at'],
+            user_dict['quota'],
+            user_dict['created_by_admin_public_key'],
+            user_dict['updated_by_admin_public_key'],
+            user_dict['updated_at'],
+            user_dict['start_block_num'],
+            user_dict['end_block_num'])
         with self._conn.cursor() as cursor:
-            cursor.execute(update_user)
-            cursor.execute(insert_user, (
-                user_dict['public_key'],
-                user_dict['name'],
-                user_dict['created_at'],
-                user_dict['quota'],
-                user_dict['created_by_admin_public_key'],
-                user_dict['updated_by_admin_public_key'],
-                user_dict['updated_at'],
+            self._execute(
+                cursor,
+                'close_user_version',
                 user_dict['start_block_num'],
-                user_dict['end_block_num']
-            ))
-    
+                user_dict['end_block_num'],
+                user_dict['public_key'])
+            self._execute(cursor, 'insert_user_version', *values)
+            self._execute(cursor, 'insert_user', *values)
+            self._rows_written['users'] += cursor.rowcount
 
     def insert_admin(self, admin_dict):
-        update_admin = """
-        UPDATE admins SET end_block_num = {}
-        WHERE end_block_num = {} AND public_key = '{}'
-        """.format(
-            admin_dict['start_block_num'],
-            admin_dict['end_block_num'],
-            admin_dict['public_key'])
-
-        insert_admin = """
-        INSERT INTO admins (
-        public_key,
-        name,
-        created_at,
-        start_block_num,
-        end_block_num)
-        VALUES ('{}', '{}', '{}', '{}', '{}');
-        """.format(
-            admin_dict['public_key'],
-            admin_dict['name'],
-            admin_dict['created_at'],
-            admin_dict['start_block_num'],
-            admin_dict['end_block_num'])
-
         with self._conn.cursor() as cursor:
-            cursor.execute(update_admin)
-            cursor.execute(insert_admin)
-
+            self._execute(
+                cursor,
+                'close_admin',
+                admin_dict['start_block_num'],
+                admin_dict['end_block_num'],
+                admin_dict['public_key'])
+            self._execute(
+                cursor,
+                'insert_admin',
+                admin_dict['public_key'],
+                admin_dict['name'],
+                admin_dict['created_at'],
+                admin_dict['start_block_num'],
+                admin_dict['end_block_num'])
+            self._rows_written['admins'] += cursor.rowcount
 
     def insert_sensor(self, sensor_dict):
-        update_sensor = """
-        UPDATE sensors SET end_block_num = {}
-        WHERE end_block_num = {} AND sensor_id = '{}'
-        """.format(
-            sensor_dict['start_block_num'],
-            sensor_dict['end_block_num'],
-            sensor_dict['sensor_id'])
-        
-        insert_sensor = """
-        INSERT INTO sensors (
-        sensor_id,
-        created_at,
-        start_block_num,
-        end_block_num)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (sensor_id) DO UPDATE
-        SET 
-            start_block_num = EXCLUDED.start_block_num,
-            end_block_num = EXCLUDED.end_block_num;
-        """
-
         with self._conn.cursor() as cursor:
-            cursor.execute(update_sensor)
-            cursor.execute(insert_sensor, (
+            self._execute(
+                cursor,
+                'close_sensor',
+                sensor_dict['start_block_num'],
+                sensor_dict['end_block_num'],
+                sensor_dict['sensor_id'])
+            self._execute(
+                cursor,
+                'insert_sensor',
                 sensor_dict['sensor_id'],
                 sensor_dict['created_at'],
                 sensor_dict['start_block_num'],
-                sensor_dict['end_block_num'],
-            ))
-            
-        self._insert_sensor_locations(sensor_dict)
-        self._insert_measurements(sensor_dict)
-        self._insert_sensor_owners(sensor_dict)
-        
-
-    def _insert_sensor_locations(self, sensor_dict):
-        update_sensor_locations = """
-        UPDATE sensor_locations SET end_block_num = {}
-        WHERE end_block_num = {} AND sensor_id = '{}'
-        """.format(
+                sensor_dict['end_block_num'])
+            self._rows_written['sensors'] += cursor.rowcount
+
+            self._insert_sensor_locations(cursor, sensor_dict)
+            self._insert_measurements(cursor, sensor_dict)
+            self._insert_sensor_owners(cursor, sensor_dict)
+
+    def _insert_sensor_locations(self, cursor, sensor_dict):
+        self._execute(
+            cursor,
+            'close_sensor_locations',
             sensor_dict['start_block_num'],
             sensor_dict['end_block_num'],
             sensor_dict['sensor_id'])
-
-        insert_sensor_locations = [
-            """
-            INSERT INTO sensor_locations (
-            sensor_id,
-            latitude,
-            longitude,
-            timestamp,
-            start_block_num,
-            end_block_num)
-            VALUES ('{}', '{}', '{}', '{}', '{}', '{}');
-            """.format(
+        for location in sensor_dict['locations']:
+            self._execute(
+                cursor,
+                'insert_sensor_location',
                 sensor_dict['sensor_id'],
                 location['latitude'],
                 location['longitude'],
                 location['timestamp'],
                 sensor_dict['start_block_num'],
                 sensor_dict['end_block_num'])
-            for location in sensor_dict['locations']
-        ]
-        with self._conn.cursor() as cursor:
-            cursor.execute(update_sensor_locations)
-            for insert in insert_sensor_locations:
-                cursor.execute(insert)
-
-    def _insert_measurements(self, sensor_dict):
-        update_measurements = """
-        UPDATE measurements SET end_block_num = {}
-        WHERE end_block_num = {} AND sensor_id = '{}'
-        """.format(
+            self._rows_written['sensor_locations'] += cursor.rowcount
+
+    def _insert_measurements(self, cursor, sensor_dict):
+        measurement = sensor_dict['measurements'][-1]
+        # Usage is credited to whoever currently owns the sensor
+        owner = sensor_dict['owners'][-1]['user_public_key']
+
+        self._execute(
+            cursor,
+            'close_measurements',
             sensor_dict['start_block_num'],
             sensor_dict['end_block_num'],
             sensor_dict['sensor_id'])
-
-        measurement = sensor_dict['measurements'][-1]
-        
-        insert_measurement =  """
-        INSERT INTO measurements (
-        sensor_id,
-        measurement,
-        timestamp,
-        start_block_num,
-        end_block_num)
-        VALUES ('{}', '{}', '{}', '{}', '{}');
-        """.format(
+        self._execute(
+            cursor,
+            'insert_measurement',
             sensor_dict['sensor_id'],
             measurement['measurement'],
             measurement['timestamp'],
             sensor_dict['start_block_num'],
             sensor_dict['end_block_num'])
+        self._rows_written['measurements'] += cursor.rowcount
+        self._execute(
+            cursor,
+            'credit_user_usage',
+            owner,
+            sensor_dict['sensor_id'],
+            measurement['measurement'],
+            measurement['timestamp'])
+        self._rows_written['user_usage'] += cursor.rowcount
+        self._execute(
+            cursor,
+            'upsert_usage',
+            owner,
+            sensor_dict['sensor_id'],
+            measurement['measurement'],
+            measurement['timestamp'])
+        self._rows_written['usage_monthly'] += cursor.rowcount
 
-        with self._conn.cursor() as cursor:
-            cursor.execute(update_measurements)
-            cursor.execute(insert_measurement) 
-                
-    def _insert_sensor_owners(self, sensor_dict):
-            update_sensor_owners = """
-            UPDATE sensor_owners SET end_block_num = {}
-            WHERE end_block_num = {} AND sensor_id = '{}'
-            """.format(
+    def _insert_sensor_owners(self, cursor, sensor_dict):
+        self._execute(
+            cursor,
+            'close_sensor_owners',
+            sensor_dict['start_block_num'],
+            sensor_dict['end_block_num'],
+            sensor_dict['sensor_id'])
+        for owner in sensor_dict['owners']:
+            self._execute(
+                cursor,
+                'insert_sensor_owner',
+                sensor_dict['sensor_id'],
+                owner['user_public_key'],
+                owner['timestamp'],
                 sensor_dict['start_block_num'],
-                sensor_dict['end_block_num'],
-                sensor_dict['sensor_id'])
-
-            insert_sensor_owners = [
-                """
-                INSERT INTO sensor_owners (
-                sensor_id,
-                user_public_key,
-                timestamp,
-                start_block_num,
-                end_block_num)
-                VALUES ('{}', '{}', '{}', '{}', '{}');
-                """.format(
-                    sensor_dict['sensor_id'],
-                    owner['user_public_key'],
-                    owner['timestamp'],
-                    sensor_dict['start_block_num'],
-                    sensor_dict['end_block_num'])
-                for owner in sensor_dict['owners']
-            ]
-            with self._conn.cursor() as cursor:
-                cursor.execute(update_sensor_owners)
-                for insert in insert_sensor_owners:
-                    cursor.execute(insert)
+                sensor_dict['end_block_num'])
+            self._rows_written['sensor_owners'] += cursor.rowcount
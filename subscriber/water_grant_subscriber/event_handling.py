@@ -15,39 +15,199 @@
 
 import re
 import logging
-import math
+import threading
+import time
 
 import psycopg2
 from sawtooth_sdk.protobuf.transaction_receipt_pb2 import StateChangeList
 
 from water_grant_addressing.addresser import AddressSpace
 from water_grant_addressing.addresser import NAMESPACE
+from water_grant_subscriber.database import MAX_BLOCK_NUMBER
 from water_grant_subscriber.decoding import deserialize_data
+from water_grant_subscriber.metrics import SubscriberMetrics
 
 
-MAX_BLOCK_NUMBER = int(math.pow(2, 63)) - 1
 NAMESPACE_REGEX = re.compile('^{}'.format(NAMESPACE))
 LOGGER = logging.getLogger(__name__)
 
 
-def get_events_handler(database):
+def get_events_handler(database, metrics=None, commit_interval=0):
     """Returns a events handler with a reference to a specific Database object.
     The handler takes a list of events and updates the Database appropriately.
+
+    With a commit_interval (in seconds) the blocks received within the
+    interval are committed together in one transaction, each inside its own
+    savepoint, instead of one commit per block.
+    """
+    if metrics is None:
+        metrics = SubscriberMetrics()
+    batch = _BlockBatch(database, metrics, commit_interval)
+    return lambda events: _handle_events(database, metrics, batch, events)
+
+
+class _BlockBatch(object):
+    """Blocks written to the database but not yet committed. Handling a
+    block and flushing the batch both hold the lock, so the flush thread
+    never commits half of a block.
     """
-    return lambda events: _handle_events(database, events)
+    def __init__(self, database, metrics, commit_interval):
+        self.lock = threading.Lock()
+        self._database = database
+        self._metrics = metrics
+        self._commit_interval = commit_interval
+        self._pending = []
+        self._error = None
+
+        if commit_interval > 0:
+            thread = threading.Thread(
+                target=self._flush_periodically,
+                name='block-batch',
+                daemon=True)
+            thread.start()
+
+    def __bool__(self):
+        return bool(self._pending)
+
+    def raise_if_failed(self):
+        """Stops ingestion after a failed batch commit. Committing later
+        blocks would move the checkpoint past the lost ones, so the
+        subscriber has to restart and replay them from the checkpoint.
+        """
+        if self._error is not None:
+            raise RuntimeError(
+                'Unable to commit blocks: {}'.format(self._error))
+
+    def add(self, block_num, block_id, state_changes, rows_written,
+            received_at):
+        self._pending.append(
+            (block_num, block_id, state_changes, rows_written, received_at))
+        if self._commit_interval <= 0:
+            self.flush()
+
+    def flush(self):
+        """Commits the pending blocks. Must be called holding the lock
+        """
+        if not self._pending:
+            return
+
+        self._database.commit()
+        committed_at = time.time()
+        for block_num, block_id, state_changes, rows_written, received_at \
+                in self._pending:
+            latency = committed_at - received_at
+            self._metrics.block_committed(
+                block_num, state_changes, rows_written, latency)
+            LOGGER.info(
+                'block_committed block_num=%s block_id=%s '
+                'state_changes=%s rows=%s latency_ms=%.1f batch=%s lag=%s',
+                block_num,
+                block_id[:8],
+                state_changes,
+                sum(rows_written.values()),
+                latency * 1000,
+                len(self._pending),
+                self._metrics.lag())
+        self._pending = []
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self._commit_interval)
+            with self.lock:
+                try:
+                    self.flush()
+                except psycopg2.DatabaseError as err:
+                    LOGGER.exception('Unable to commit blocks: %s', err)
+                    self._database.rollback()
+                    self._pending = []
+                    self._error = err
+                    return
 
 
-def _handle_events(database, events):
+def _handle_events(database, metrics, batch, events):
+    received_at = time.time()
     block_num, block_id = _parse_new_block(events)
-    if block_num is not None:
+    if block_num is None:
+        return
+
+    metrics.block_seen(block_num)
+    with batch.lock:
+        batch.raise_if_failed()
         try:
-            is_duplicate = _resolve_if_forked(database, block_num, block_id)
-            if not is_duplicate:
-                _apply_state_changes(database, events, block_num, block_id)
-            database.commit()
+            database.begin_block()
+            is_duplicate, is_fork = _resolve_if_forked(
+                database, metrics, block_num, block_id)
+            if is_duplicate:
+                database.release_block()
+                if not batch:
+                    database.rollback()
+                LOGGER.debug('Skipping duplicate block %s', block_num)
+                return
+
+            state_changes, changed_keys = _apply_state_changes(
+                database, events, block_num)
+            database.insert_block(
+                {'block_num': block_num, 'block_id': block_id})
+            database.save_checkpoint(block_num, block_id)
+            database.notify_changes(block_num, changed_keys, fork=is_fork)
+            database.release_block()
         except psycopg2.DatabaseError as err:
-            print('Unable to handle event: %s', err)
-            database.rollback()
+            LOGGER.exception('Unable to handle block %s: %s', block_num, err)
+            # Commit the blocks already waiting in the batch, then stop:
+            # handling later blocks would move the checkpoint past this
+            # one, which the subscriber replays from the checkpoint on
+            # restart instead
+            if batch:
+                database.rollback_block()
+                batch.flush()
+            else:
+                database.rollback()
+            database.pop_rows_written()
+            raise
+
+        batch.add(
+            block_num,
+            block_id,
+            state_changes,
+            database.pop_rows_written(),
+            received_at)
+
+
+def get_resume_block_ids(database, count):
+    """Validates the subscriber checkpoint against the blocks table and
+    returns the ids of the most recent committed blocks, newest first, to
+    resume the subscription from.
+
+    Rows above the checkpoint can only come from a write that never
+    committed its checkpoint, so they are dropped and that block replayed.
+    If the checkpointed block is no longer on the chain the validator picks
+    the newest known id it still has and fork resolution replaces the rest.
+    """
+    checkpoint = database.fetch_checkpoint()
+    if checkpoint is not None:
+        stored = database.fetch_block(checkpoint['block_num'])
+        if stored is None or stored['block_id'] != checkpoint['block_id']:
+            LOGGER.warning(
+                'Checkpoint %s (%s) does not match stored blocks, '
+                'replaying from it',
+                checkpoint['block_id'][:8],
+                checkpoint['block_num'])
+            database.drop_fork(checkpoint['block_num'])
+        else:
+            latest = database.fetch_last_known_blocks(1)
+            if latest and latest[0]['block_num'] > checkpoint['block_num']:
+                LOGGER.warning(
+                    'Dropping uncommitted rows above checkpoint %s (%s)',
+                    checkpoint['block_id'][:8],
+                    checkpoint['block_num'])
+                database.drop_fork(checkpoint['block_num'] + 1)
+        database.commit()
+
+    known_blocks = database.fetch_last_known_blocks(count)
+    LOGGER.info(
+        'Resuming subscription after block %s',
+        known_blocks[0]['block_num'] if known_blocks else None)
+    return [block['block_id'] for block in known_blocks]
 
 
 def _parse_new_block(events):
@@ -59,38 +219,54 @@ def _parse_new_block(events):
 
     block_num = int(next(a.value for a in block_attr if a.key == 'block_num'))
     block_id = next(a.value for a in block_attr if a.key == 'block_id')
-    print('Handling deltas for block: %s', block_id)
+    LOGGER.debug('Handling deltas for block: %s', block_id)
     return block_num, block_id
 
 
-def _resolve_if_forked(database, block_num, block_id):
+def _resolve_if_forked(database, metrics, block_num, block_id):
+    """Drops the stored blocks from block_num on if block_id replaces them.
+    Returns whether the block is a duplicate and whether it was a fork
+    """
     existing_block = database.fetch_block(block_num)
     if existing_block is not None:
         if existing_block['block_id'] == block_id:
-            return True  # this block is a duplicate
-        print(
+            return True, False  # this block is a duplicate
+        LOGGER.warning(
             'Fork detected: replacing %s (%s) with %s (%s)',
             existing_block['block_id'][:8],
             existing_block['block_num'],
             block_id[:8],
             block_num)
+        metrics.fork_detected()
         database.drop_fork(block_num)
-    return False
+        return False, True
+    return False, False
 
 
-def _apply_state_changes(database, events, block_num, block_id):
+def _apply_state_changes(database, events, block_num):
+    """Writes the state changes of a block. Returns how many there were and
+    the keys of the REST API resources they changed
+    """
     changes = _parse_state_changes(events)
+    changed_keys = set()
     for change in changes:
         data_type, resources = deserialize_data(change.address, change.value)
-        database.insert_block({'block_num': block_num, 'block_id': block_id})
         if data_type == AddressSpace.ADMIN:
             _apply_admin_change(database, block_num, resources)
         elif data_type == AddressSpace.USER:
             _apply_user_change(database, block_num, resources)
+            changed_keys.update(
+                'user:' + user['public_key'] for user in resources)
         elif data_type == AddressSpace.SENSOR:
             _apply_sensor_change(database, block_num, resources)
+            for sensor in resources:
+                changed_keys.add('sensor:' + sensor['sensor_id'])
+                changed_keys.update(
+                    'usage:' + owner['user_public_key']
+                    for owner in sensor['owners'])
         else:
-            print('Unsupported data type: %s', data_type)
+            LOGGER.warning('Unsupported data type: %s', data_type)
+    return len(changes), changed_keys
 
 
 def _parse_state_changes(events):
@@ -20,6 +20,9 @@ import logging
 from water_grant_subscriber.database import Database
 from water_grant_subscriber.subscriber import Subscriber
 from water_grant_subscriber.event_handling import get_events_handler
+from water_grant_subscriber.event_handling import get_resume_block_ids
+from water_grant_subscriber.metrics import SubscriberMetrics
+from water_grant_subscriber.metrics import serve_metrics
 
 
 KNOWN_COUNT = 15
@@ -70,6 +73,16 @@ def parse_args(args):
         '-C', '--connect',
         help='The url of the validator to subscribe to',
         default='tcp://validator:4004')
+    subscribe_parser.add_argument(
+        '--commit-interval',
+        help='Seconds of blocks to commit in one transaction '
+             '(0 commits every block)',
+        type=float,
+        default=0)
+    subscribe_parser.add_argument(
+        '--metrics-bind',
+        help='host:port to serve ingestion metrics on (disabled if unset)',
+        default=None)
 
     return parser.parse_args(args)
 
@@ -98,10 +111,16 @@ def do_subscribe(opts):
         database = Database(dsn)
         database.connect()
         database.create_tables()
+
+        metrics = SubscriberMetrics()
+        if opts.metrics_bind:
+            metrics_host, metrics_port = opts.metrics_bind.split(':')
+            serve_metrics(metrics, metrics_host, int(metrics_port))
+
         subscriber = Subscriber(opts.connect)
-        subscriber.add_handler(get_events_handler(database))
-        known_blocks = database.fetch_last_known_blocks(KNOWN_COUNT)
-        known_ids = [block['block_id'] for block in known_blocks]
+        subscriber.add_handler(
+            get_events_handler(database, metrics, opts.commit_interval))
+        known_ids = get_resume_block_ids(database, KNOWN_COUNT)
         subscriber.start(known_ids=known_ids)
 
     except KeyboardInterrupt:
@@ -0,0 +1,149 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ------------------------------------------------------------------------------
+
+from collections import Counter
+from collections import deque
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+import json
+import logging
+import threading
+import time
+
+
+LOGGER = logging.getLogger(__name__)
+RATE_WINDOW = 60
+
+
+class SubscriberMetrics(object):
+    """Tracks how far the read database trails the chain and how fast the
+    subscriber is ingesting. Updated from the event loop and read from the
+    metrics endpoint thread, so every access goes through a lock.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._head_block_num = None
+        self._committed_block_num = None
+        self._blocks_committed = 0
+        self._state_changes = 0
+        self._forks = 0
+        self._rows_written = Counter()
+        self._last_latency = None
+        self._total_latency = 0.0
+        # (commit time, state changes) of the blocks in the rate window
+        self._recent = deque()
+
+    def block_seen(self, block_num):
+        with self._lock:
+            if self._head_block_num is None or \
+                    block_num > self._head_block_num:
+                self._head_block_num = block_num
+
+    def fork_detected(self):
+        with self._lock:
+            self._forks += 1
+
+    def block_committed(self, block_num, state_changes, rows_written,
+                        latency):
+        """Records a block whose rows were committed to the database
+
+        Args:
+            block_num (int): Number of the committed block
+            state_changes (int): State changes applied for the block
+            rows_written (dict): Rows written for the block, by table
+            latency (float): Seconds from receiving to committing the block
+        """
+        now = time.time()
+        with self._lock:
+            self._committed_block_num = block_num
+            self._blocks_committed += 1
+            self._state_changes += state_changes
+            self._rows_written.update(rows_written)
+            self._last_latency = latency
+            self._total_latency += latency
+
+            self._recent.append((now, state_changes))
+            while self._recent and self._recent[0][0] < now - RATE_WINDOW:
+                self._recent.popleft()
+
+    def lag(self):
+        with self._lock:
+            return self._lag()
+
+    def _lag(self):
+        if self._head_block_num is None or self._committed_block_num is None:
+            return None
+        return self._head_block_num - self._committed_block_num
+
+    def snapshot(self):
+        """Returns the current metrics as a JSON serializable dict
+        """
+        now = time.time()
+        with self._lock:
+            recent = [changes for committed_at, changes in self._recent
+                      if committed_at >= now - RATE_WINDOW]
+            window = min(RATE_WINDOW, now - self._started_at) or 1
+            average_latency = (
+                self._total_latency / self._blocks_committed
+                if self._blocks_committed else None)
+
+            return {
+                'head_block_num': self._head_block_num,
+                'committed_block_num': self._committed_block_num,
+                'lag_blocks': self._lag(),
+                'blocks_committed': self._blocks_committed,
+                'state_changes': self._state_changes,
+                'blocks_per_second': len(recent) / window,
+                'state_changes_per_second': sum(recent) / window,
+                'rows_written': dict(self._rows_written),
+                'last_block_latency_seconds': self._last_latency,
+                'average_block_latency_seconds': average_latency,
+                'forks': self._forks,
+                'uptime_seconds': now - self._started_at
+            }
+
+
+def serve_metrics(metrics, host, port):
+    """Serves the metrics snapshot as JSON on GET /metrics from a daemon
+    thread, so it never blocks ingestion
+
+    Args:
+        metrics (SubscriberMetrics): The metrics to expose
+        host (str): Interface to bind the endpoint to
+        port (int): Port to bind the endpoint to
+    """
+    class _MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            body = json.dumps(metrics.snapshot(), sort_keys=True).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # pylint: disable=redefined-builtin
+        def log_message(self, format, *args):
+            LOGGER.debug(format, *args)
+
+    server = HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(
+        target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    LOGGER.info('Serving subscriber metrics on %s:%s/metrics', host, port)
+    return server
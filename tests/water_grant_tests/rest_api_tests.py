@@ -0,0 +1,708 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+import asyncio
+from email.utils import formatdate
+import gzip
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import AioHTTPTestCase
+from aiohttp.test_utils import unittest_run_loop
+from psycopg2.extensions import parse_dsn
+
+from water_grant_rest_api.cache import LRUCache
+from water_grant_rest_api.cache import ResponseCache
+from water_grant_rest_api.compression import compression_middleware
+from water_grant_rest_api.compression import encoded_etag
+from water_grant_rest_api.compression import negotiate_encoding
+from water_grant_rest_api.compression import strip_encoding
+from water_grant_rest_api.database import Database
+from water_grant_rest_api.events import EventStream
+from water_grant_rest_api.events import MAX_PENDING_EVENTS
+from water_grant_rest_api.events import SensorEventHub
+from water_grant_rest_api.messaging import Messenger
+from water_grant_rest_api.route_handler import encrypt_private_key
+from water_grant_rest_api.route_handler import etag_response
+from water_grant_rest_api.route_handler import generate_auth_token
+from water_grant_rest_api.route_handler import get_time
+from water_grant_rest_api.route_handler import RouteHandler
+from water_grant_protobuf import readings_pb2
+
+from subscriber_tests import ALICE_KEY
+from subscriber_tests import BOB_KEY
+from subscriber_tests import DatabaseTestCase
+from subscriber_tests import TEST_DSN
+from subscriber_tests import TEST_SCHEMA
+
+
+AES_KEY = 'ffffffffffffffffffffffffffffffff'
+SECRET_KEY = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890'
+PUBLIC_KEY = '02' + 'ab' * 32
+PRIVATE_KEY = 'cd' * 32
+
+
+class StreamListTest(DatabaseTestCase):
+    """Streams lists from a pool of a single connection, which the other
+    queries of the API must still get while a client reads the stream
+    """
+    def setUp(self):
+        super().setUp()
+        for block_num, sensor_id in enumerate(
+                ('sensor-1', 'sensor-2', 'sensor-3', 'sensor-4', 'sensor-5'),
+                start=2):
+            self.add_reading(block_num, sensor_id, 1)
+
+        self.pgoptions = os.environ.get('PGOPTIONS')
+        os.environ['PGOPTIONS'] = '-c search_path={}'.format(TEST_SCHEMA)
+        self.loop = asyncio.new_event_loop()
+        dsn = parse_dsn(TEST_DSN)
+        self.rest_database = Database(
+            dsn.get('host'),
+            dsn.get('port', 5432),
+            dsn.get('dbname'),
+            dsn.get('user'),
+            dsn.get('password'),
+            self.loop,
+            pool_min_size=1,
+            pool_max_size=1,
+            acquire_timeout=1)
+        self.loop.run_until_complete(self.rest_database.connect())
+
+    def tearDown(self):
+        self.rest_database.disconnect()
+        self.loop.close()
+        if self.pgoptions is None:
+            del os.environ['PGOPTIONS']
+        else:
+            os.environ['PGOPTIONS'] = self.pgoptions
+        super().tearDown()
+
+    def test_stream_releases_the_connection_between_batches(self):
+        async def read_slowly():
+            stream = self.rest_database.stream_all_sensor_resources(
+                batch_size=2)
+            batches = [await stream.__anext__()]
+            # A slow client: the API answers other requests meanwhile
+            self.assertEqual(
+                await self.rest_database.fetch_latest_block_num(), 6)
+            async for batch in stream:
+                batches.append(batch)
+            return batches
+
+        batches = self.loop.run_until_complete(read_slowly())
+        self.assertEqual(
+            [[sensor['sensor_id'] for sensor in batch] for batch in batches],
+            [['sensor-1', 'sensor-2'], ['sensor-3', 'sensor-4'],
+             ['sensor-5']])
+        self.assertEqual(
+            batches[0][0]['measurements'][0]['measurement'], 1)
+
+    def test_stream_users(self):
+        async def read_all():
+            return [
+                batch async for batch in
+                self.rest_database.stream_all_user_resources(batch_size=1)]
+
+        batches = self.loop.run_until_complete(read_all())
+        self.assertEqual(
+            [[user['public_key'] for user in batch] for batch in batches],
+            [['alice-key'], ['bob-key']])
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_the_least_recently_used(self):
+        cache = LRUCache(2, 60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_entries_expire(self):
+        cache = LRUCache(2, -1)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache()
+        self.cache.block_advanced(1)
+        self.cache.put('sensor:sensor-1', b'1', '"1"', self.cache.generation)
+        self.cache.put('sensor:sensor-2', b'2', '"2"', self.cache.generation)
+
+    def cached(self):
+        return sorted(
+            key for key in ('sensor:sensor-1', 'sensor:sensor-2')
+            if self.cache.get(key) is not None)
+
+    def test_drops_only_the_keys_notified_as_changed(self):
+        self.cache.changes_notified(2, ['sensor:sensor-1'])
+        self.cache.changes_notified(3, [])
+        self.cache.block_advanced(3)
+        self.assertEqual(self.cached(), ['sensor:sensor-2'])
+
+    def test_drops_everything_after_a_block_not_notified(self):
+        self.cache.changes_notified(3, ['sensor:sensor-1'])
+        self.cache.block_advanced(3)
+        self.assertEqual(self.cached(), [])
+
+    def test_drops_everything_on_a_fork(self):
+        self.cache.changes_notified(1, ['sensor:sensor-1'], fork=True)
+        self.assertEqual(self.cached(), [])
+
+    def test_does_not_store_a_response_fetched_before_a_change(self):
+        generation = self.cache.generation
+        self.cache.changes_notified(2, ['sensor:sensor-1'])
+        self.cache.block_advanced(2)
+        self.cache.put('sensor:sensor-1', b'stale', '"1"', generation)
+        self.assertIsNone(self.cache.get('sensor:sensor-1'))
+
+
+class NegotiateEncodingTest(unittest.TestCase):
+
+    def test_picks_the_first_encoding_accepted(self):
+        self.assertEqual(
+            negotiate_encoding('gzip, br', ['br', 'gzip']), 'br')
+        self.assertEqual(
+            negotiate_encoding('br;q=0, *', ['br', 'gzip']), 'gzip')
+        self.assertIsNone(negotiate_encoding('gzip;q=0', ['gzip']))
+        self.assertIsNone(negotiate_encoding('', ['gzip']))
+
+    def test_etags_of_encoded_bodies(self):
+        self.assertEqual(encoded_etag('"4-abc"', 'gzip'), '"4-abc-gzip"')
+        self.assertEqual(strip_encoding('"4-abc-gzip"'), '"4-abc"')
+        self.assertEqual(strip_encoding('W/"4-abc-br"'), '"4-abc"')
+        self.assertEqual(strip_encoding('"4-abc"'), '"4-abc"')
+
+
+class ConditionalCompressedTest(AioHTTPTestCase):
+    """A resource of version ETAG, compressed from MIN_SIZE bytes
+    """
+    ETAG = '"4-abc"'
+    LAST_MODIFIED = 1500000000
+    MIN_SIZE = 64
+
+    async def get_application(self):
+        self.cache = LRUCache(10, 60)
+        app = web.Application(middlewares=[
+            compression_middleware(self.MIN_SIZE, self.cache)])
+        app.router.add_get('/sensors/sensor-1', self.get_sensor)
+        app.router.add_get('/small', self.get_small)
+        return app
+
+    async def get_sensor(self, request):
+        body = json.dumps({'measurements': list(range(100))}).encode()
+        return etag_response(request, body, self.ETAG, self.LAST_MODIFIED)
+
+    async def get_small(self, request):
+        return etag_response(request, b'{}', self.ETAG)
+
+    async def get(self, path, headers):
+        all_headers = {'Accept-Encoding': 'gzip'}
+        all_headers.update(headers)
+        return await self.client.get(path, headers=all_headers)
+
+    @unittest_run_loop
+    async def test_compresses_with_the_etag_of_the_encoding(self):
+        response = await self.get('/sensors/sensor-1', {})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['ETag'], '"4-abc-gzip"')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(
+            await response.json(), {'measurements': list(range(100))})
+        self.assertEqual(len(self.cache), 1)
+
+    @unittest_run_loop
+    async def test_small_bodies_are_not_compressed(self):
+        response = await self.get('/small', {})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['ETag'], self.ETAG)
+
+    @unittest_run_loop
+    async def test_not_modified_for_the_encoded_etag(self):
+        response = await self.get(
+            '/sensors/sensor-1', {'If-None-Match': '"4-abc-gzip"'})
+        self.assertEqual(response.status, 304)
+        self.assertEqual(response.headers['ETag'], '"4-abc-gzip"')
+
+    @unittest_run_loop
+    async def test_modified_for_another_etag(self):
+        response = await self.get(
+            '/sensors/sensor-1', {
+                'If-None-Match': '"3-def-gzip"',
+                'If-Modified-Since': formatdate(
+                    self.LAST_MODIFIED, usegmt=True),
+            })
+        self.assertEqual(response.status, 200)
+
+    @unittest_run_loop
+    async def test_not_modified_since(self):
+        response = await self.get(
+            '/sensors/sensor-1', {
+                'If-Modified-Since': formatdate(
+                    self.LAST_MODIFIED, usegmt=True),
+            })
+        self.assertEqual(response.status, 304)
+        response = await self.get(
+            '/sensors/sensor-1', {
+                'If-Modified-Since': formatdate(
+                    self.LAST_MODIFIED - 1, usegmt=True),
+            })
+        self.assertEqual(response.status, 200)
+
+
+class FakeEventDatabase(object):
+    """Holds measurement rows, each written by block id + 10
+    """
+    def __init__(self, rows):
+        self.rows = rows
+
+    def row(self, row_id):
+        return next(row for row in self.rows if row['id'] == row_id)
+
+    async def fetch_sensor_version(self, sensor_id):
+        rows = [row for row in self.rows if row['sensor_id'] == sensor_id]
+        if not rows:
+            return None
+        return {'block_num': rows[-1]['block_num'], 'block_id': 'block',
+                'timestamp': rows[-1]['timestamp']}
+
+    async def fetch_latest_block_num(self):
+        return max(row['block_num'] for row in self.rows)
+
+    async def fetch_measurements_after(self, after_id, sensor_id=None,
+                                       user_public_key=None, limit=None):
+        return [
+            row for row in self.rows if row['id'] > after_id
+            and sensor_id in (None, row['sensor_id'])
+            and user_public_key in (None, row['user_public_key'])][:limit]
+
+    async def fetch_owned_sensor_ids(self, user_public_keys):
+        return list({
+            row['sensor_id'] for row in self.rows
+            if row['user_public_key'] in user_public_keys})
+
+    async def fetch_new_measurements(self, sensor_ids, after_block_num,
+                                     block_num):
+        return [
+            row for row in self.rows if row['sensor_id'] in sensor_ids
+            and after_block_num < row['block_num'] <= block_num]
+
+
+def measurement_row(row_id, sensor_id='sensor-1', owner=ALICE_KEY):
+    return {
+        'id': row_id,
+        'sensor_id': sensor_id,
+        'user_public_key': owner,
+        'measurement': row_id,
+        'timestamp': 1500000000 + row_id,
+        'block_num': row_id + 10,
+    }
+
+
+def event_ids(events):
+    return [int(event.split(b'\n')[0][len(b'id: '):]) for event in events]
+
+
+class EventStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def next_events(self, stream):
+        return self.loop.run_until_complete(stream.next_events())
+
+    def test_skips_events_already_queued(self):
+        stream = EventStream('sensor:sensor-1')
+        for event_id in (1, 2, 2, 1, 3):
+            stream.push(str(event_id).encode(), event_id)
+        self.assertEqual(self.next_events(stream), [b'1', b'2', b'3'])
+
+    def test_live_events_wait_for_the_replay(self):
+        stream = EventStream('sensor:sensor-1')
+        stream.hold()
+        # Published while the replay was read
+        stream.push(b'3', 3)
+        stream.push(b'4', 4)
+        stream.release([(b'1', 1), (b'2', 2), (b'3', 3)])
+        stream.push(b'4', 4)
+        self.assertEqual(
+            self.next_events(stream), [b'1', b'2', b'3', b'4'])
+
+    def test_closed_stream_returns_the_events_queued(self):
+        stream = EventStream('sensor:sensor-1', max_pending=2)
+        stream.push(b'1', 1)
+        stream.push(b'2', 2)
+        stream.push(b'3', 3)
+        self.assertEqual(self.next_events(stream), [b'1', b'2'])
+
+    def test_closes_a_stream_falling_behind(self):
+        stream = EventStream('sensor:sensor-1', max_pending=2)
+        self.assertTrue(stream.push(b'1', 1))
+        self.assertTrue(stream.push(b'2', 2))
+        self.assertFalse(stream.push(b'3', 3))
+        self.assertTrue(stream.closed)
+
+
+class SensorEventHubTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.database = FakeEventDatabase([
+            measurement_row(1),
+            measurement_row(2, 'sensor-2', BOB_KEY),
+            measurement_row(3),
+        ])
+        self.hub = SensorEventHub(self.database)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_hub(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_replays_after_the_last_event_id(self):
+        stream = self.hub.subscribe('sensor:sensor-1')
+        self.run_hub(self.hub.replay(stream, 1))
+        self.assertEqual(
+            event_ids(self.run_hub(stream.next_events())), [3])
+
+    def test_replay_keeps_events_published_while_it_reads(self):
+        stream = self.hub.subscribe('sensor:sensor-1')
+        fetch_measurements_after = self.database.fetch_measurements_after
+
+        async def fetch_while_publishing(*args, **kwargs):
+            self.database.rows.append(measurement_row(4))
+            self.hub._block_num = 13
+            self.hub._notified(
+                '{"block_num": 14, "keys": ["sensor:sensor-1"]}')
+            await self.hub.publish()
+            return await fetch_measurements_after(*args, **kwargs)
+
+        self.database.fetch_measurements_after = fetch_while_publishing
+        self.run_hub(self.hub.replay(stream, 0))
+        self.assertEqual(
+            event_ids(self.run_hub(stream.next_events())), [1, 3, 4])
+
+    def test_replay_then_live_events_without_duplicates(self):
+        # Block 12 is where the hub stood when the client reconnected
+        self.hub._block_num = 12
+        self.database.rows.append(measurement_row(4))
+        stream = self.hub.subscribe('owner:' + ALICE_KEY)
+        self.run_hub(self.hub.replay(stream, 0))
+        self.hub._notified('{"block_num": 14, "keys": ["sensor:sensor-1"]}')
+        self.assertTrue(self.run_hub(self.hub.publish()))
+        self.assertEqual(
+            event_ids(self.run_hub(stream.next_events())), [1, 3, 4])
+        self.assertEqual(self.hub.published, 2)
+
+    def test_publishes_to_sensor_and_owner_topics(self):
+        self.hub._block_num = 10
+        sensor_stream = self.hub.subscribe('sensor:sensor-2')
+        owner_stream = self.hub.subscribe('owner:' + BOB_KEY)
+        other_stream = self.hub.subscribe('sensor:sensor-3')
+        self.hub._notified('{"block_num": 13, "keys": null}')
+        self.run_hub(self.hub.publish())
+        self.assertEqual(
+            event_ids(self.run_hub(sensor_stream.next_events())), [2])
+        self.assertEqual(
+            event_ids(self.run_hub(owner_stream.next_events())), [2])
+        self.assertEqual(other_stream._pending, [])
+
+    def test_unsubscribes_streams_falling_behind(self):
+        self.hub._block_num = 10
+        stream = self.hub.subscribe('sensor:sensor-1')
+        stream._max_pending = 1
+        self.hub._notified('{"block_num": 13, "keys": null}')
+        self.run_hub(self.hub.publish())
+        self.assertTrue(stream.closed)
+        self.assertEqual((self.hub.streams, self.hub.overflowed), (0, 1))
+
+
+class SensorEventsResumeTest(AioHTTPTestCase):
+    """A client reconnecting further behind than a stream may queue
+    """
+
+    async def get_application(self):
+        self.database = FakeEventDatabase([
+            measurement_row(row_id) for row_id in range(1, 301)])
+        self.hub = SensorEventHub(self.database)
+        handler = RouteHandler(
+            self.loop, None, self.database, events=self.hub)
+        app = web.Application()
+        app.router.add_get(
+            '/sensors/{sensor_id}/events', handler.stream_sensor_events)
+        return app
+
+    @unittest_run_loop
+    async def test_gets_the_events_queued_before_reconnecting(self):
+        response = await self.client.get(
+            '/sensors/sensor-1/events', headers={'Last-Event-ID': '10'})
+        body = await response.read()
+        events = [event for event in body.split(b'\n\n')
+                  if event.startswith(b'id: ')]
+        self.assertEqual(
+            event_ids(events), list(range(11, 11 + MAX_PENDING_EVENTS)))
+        self.assertEqual(self.hub.streams, 0)
+
+
+class SignerCacheTest(unittest.TestCase):
+
+    def test_signers_are_reused_without_keeping_private_keys(self):
+        messenger = Messenger(['tcp://localhost:4004'])
+        public_key, private_key = messenger.get_new_key_pair()
+
+        signer = messenger.get_signer(private_key)
+        self.assertEqual(signer.public_key_hex, public_key)
+        self.assertIs(messenger.get_signer(private_key), signer)
+        # As decrypted by RouteHandler._authorize
+        self.assertIs(messenger.get_signer(private_key.encode()), signer)
+        self.assertNotIn(private_key, messenger._signers._entries)
+
+
+class FakeAuthDatabase(object):
+    """Knows the account of PUBLIC_KEY only
+    """
+    async def fetch_auth_by_public_key(self, public_key):
+        if public_key != PUBLIC_KEY:
+            return None
+        return {
+            'public_key': PUBLIC_KEY,
+            'is_admin': False,
+            'encrypted_private_key': encrypt_private_key(
+                AES_KEY, PUBLIC_KEY, PRIVATE_KEY.encode()).hex(),
+        }
+
+
+class FakeMessenger(object):
+    """Records the readings submitted, committing them all
+    """
+    def __init__(self):
+        self.submitted = []
+
+    async def send_update_sensor_transaction(self, private_key, measurement,
+                                             sensor_id, timestamp, wait=True):
+        self.submitted.append((private_key, {
+            'sensor_id': sensor_id,
+            'measurement': measurement,
+            'timestamp': timestamp,
+        }))
+        return 'batch-{}'.format(len(self.submitted))
+
+    async def send_update_sensor_transactions(self, private_key, readings,
+                                              wait=True):
+        outcomes = []
+        for reading in readings:
+            self.submitted.append((private_key, reading))
+            outcomes.append(('batch-{}'.format(len(self.submitted)), None))
+        return outcomes
+
+
+class SensorUpdateTest(AioHTTPTestCase):
+
+    async def get_application(self):
+        self.messenger = FakeMessenger()
+        app = web.Application()
+        app['aes_key'] = AES_KEY
+        app['secret_key'] = SECRET_KEY
+        handler = RouteHandler(self.loop, self.messenger, FakeAuthDatabase())
+        app.router.add_post(
+            '/sensors/{sensor_id}/update', handler.update_sensor)
+        app.router.add_post(
+            '/sensors/readings:bulk', handler.update_sensors_bulk)
+        return app
+
+    def auth_headers(self, content_type='application/json'):
+        return {
+            'Authorization': 'Bearer ' + generate_auth_token(
+                SECRET_KEY, PUBLIC_KEY),
+            'Content-Type': content_type,
+        }
+
+    async def post_bulk(self, body, content_type='application/json',
+                        headers=None):
+        all_headers = self.auth_headers(content_type)
+        all_headers.update(headers or {})
+        response = await self.client.post(
+            '/sensors/readings:bulk', data=body, headers=all_headers)
+        return response.status, await response.json()
+
+    def assert_submitted(self, readings):
+        self.assertEqual(
+            [private_key for private_key, _ in self.messenger.submitted],
+            [PRIVATE_KEY.encode()] * len(readings))
+        self.assertEqual(
+            [(reading['sensor_id'], reading['measurement'])
+             for _, reading in self.messenger.submitted],
+            readings)
+
+    @unittest_run_loop
+    async def test_bulk_json_array(self):
+        status, body = await self.post_bulk(json.dumps([
+            {'sensor_id': 'sensor-1', 'measurement': 1.5},
+            {'sensor_id': 'sensor-2', 'measurement': 2},
+            {'sensor_id': 'sensor-3'},
+        ]))
+        self.assertEqual(status, 200)
+        self.assertEqual((body['accepted'], body['failed']), (2, 1))
+        self.assertEqual(
+            [result['status'] for result in body['data']],
+            ['COMMITTED', 'COMMITTED', 'INVALID'])
+        self.assert_submitted([('sensor-1', 1.5), ('sensor-2', 2)])
+
+    @unittest_run_loop
+    async def test_bulk_ndjson(self):
+        status, body = await self.post_bulk(
+            '{"sensor_id": "sensor-1", "measurement": 1}\n'
+            '\n'
+            '{"sensor_id": "sensor-2", "measurement": 2}\n',
+            'application/x-ndjson')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['accepted'], 2)
+        self.assert_submitted([('sensor-1', 1), ('sensor-2', 2)])
+
+    @unittest_run_loop
+    async def test_bulk_gzip(self):
+        status, body = await self.post_bulk(
+            gzip.compress(json.dumps(
+                [{'sensor_id': 'sensor-1', 'measurement': 1}]).encode()),
+            headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(status, 200)
+        self.assertEqual(body['accepted'], 1)
+        self.assert_submitted([('sensor-1', 1)])
+
+    @unittest_run_loop
+    async def test_bulk_readings_take_the_server_time(self):
+        before = get_time()
+        status, _ = await self.post_bulk(json.dumps(
+            [{'sensor_id': 'sensor-1', 'measurement': 1, 'timestamp': 1}]))
+        self.assertEqual(status, 200)
+        self.assertGreaterEqual(
+            self.messenger.submitted[0][1]['timestamp'], before)
+
+    @unittest_run_loop
+    async def test_bulk_rejects_an_object_body(self):
+        status, body = await self.post_bulk(json.dumps(
+            {'sensor_id': 'sensor-1', 'measurement': 1}))
+        self.assertEqual(status, 400)
+        self.assertIn('lista de leituras', body['error'])
+        self.assertEqual(self.messenger.submitted, [])
+
+    @unittest_run_loop
+    async def test_bulk_protobuf(self):
+        readings = readings_pb2.SensorReadingList(readings=[
+            readings_pb2.SensorReading(sensor_id='sensor-1', measurement=1.5),
+            readings_pb2.SensorReading(sensor_id='sensor-2', measurement=2),
+        ])
+        status, body = await self.post_bulk(
+            readings.SerializeToString(), 'application/x-protobuf')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['accepted'], 2)
+        self.assert_submitted([('sensor-1', 1.5), ('sensor-2', 2)])
+
+    @unittest_run_loop
+    async def test_update_protobuf(self):
+        response = await self.client.post(
+            '/sensors/sensor-1/update',
+            data=readings_pb2.SensorReading(
+                measurement=2.5).SerializeToString(),
+            headers=self.auth_headers('application/x-protobuf'))
+        self.assertEqual(response.status, 200)
+        self.assert_submitted([('sensor-1', 2.5)])
+
+    @unittest_run_loop
+    async def test_update_protobuf_of_zero(self):
+        response = await self.client.post(
+            '/sensors/sensor-1/update',
+            data=readings_pb2.SensorReading(
+                measurement=0).SerializeToString(),
+            headers=self.auth_headers('application/x-protobuf'))
+        self.assertEqual(response.status, 200)
+        self.assert_submitted([('sensor-1', 0)])
+
+    @unittest_run_loop
+    async def test_update_rejects_an_empty_protobuf(self):
+        response = await self.client.post(
+            '/sensors/sensor-1/update',
+            data=b'',
+            headers=self.auth_headers('application/x-protobuf'))
+        self.assertEqual(response.status, 400)
+        self.assertIn('measurement', (await response.json())['error'])
+        self.assertEqual(self.messenger.submitted, [])
+
+    @unittest_run_loop
+    async def test_bulk_protobuf_rejects_readings_without_measurement(self):
+        readings = readings_pb2.SensorReadingList(readings=[
+            readings_pb2.SensorReading(sensor_id='sensor-1'),
+            readings_pb2.SensorReading(sensor_id='sensor-2', measurement=0),
+        ])
+        status, body = await self.post_bulk(
+            readings.SerializeToString(), 'application/x-protobuf')
+        self.assertEqual(status, 200)
+        self.assertEqual(
+            [result['status'] for result in body['data']],
+            ['INVALID', 'COMMITTED'])
+        self.assert_submitted([('sensor-2', 0)])
+
+    @unittest_run_loop
+    async def test_update_rejects_undecodable_json(self):
+        response = await self.client.post(
+            '/sensors/sensor-1/update',
+            data=b'\xff\xfe',
+            headers=self.auth_headers())
+        self.assertEqual(response.status, 400)
+        self.assertEqual(self.messenger.submitted, [])
+
+    @unittest_run_loop
+    async def test_bulk_requires_a_token(self):
+        response = await self.client.post(
+            '/sensors/readings:bulk',
+            data=json.dumps([{'sensor_id': 'sensor-1', 'measurement': 1}]),
+            headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status, 401)
+        self.assertEqual(self.messenger.submitted, [])
+
+
+class MainImportTest(unittest.TestCase):
+
+    def test_arguments_parse_without_the_validator_dependencies(self):
+        # In a fresh interpreter, as other tests import these modules
+        output = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys\n'
+            'from water_grant_rest_api.main import parse_args\n'
+            'parse_args(["--validator-dispatch", "least-pending"])\n'
+            'print(sorted(name for name in ("zmq", "sawtooth_rest_api")\n'
+            '             if name in sys.modules))'])
+        self.assertEqual(output.strip(), b'[]')
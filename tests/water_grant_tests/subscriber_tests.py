@@ -0,0 +1,299 @@
+# Copyright 2018 Intel Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# -----------------------------------------------------------------------------
+
+from collections import namedtuple
+import os
+import time
+import unittest
+
+import psycopg2
+
+from water_grant_subscriber.database import Database
+from water_grant_subscriber.database import MAX_BLOCK_NUMBER
+from water_grant_subscriber.event_handling import get_events_handler
+from water_grant_subscriber.event_handling import get_resume_block_ids
+
+
+# Postgres the subscriber tables are created in, inside a schema of their own
+# that is dropped before each test
+TEST_DSN = os.environ.get('WATER_GRANT_TEST_DSN')
+TEST_SCHEMA = 'water_grant_tests'
+ADMIN_KEY = 'admin-key'
+ALICE_KEY = 'alice-key'
+BOB_KEY = 'bob-key'
+
+Event = namedtuple('Event', ['event_type', 'attributes', 'data'])
+EventAttribute = namedtuple('EventAttribute', ['key', 'value'])
+
+
+@unittest.skipUnless(TEST_DSN, 'WATER_GRANT_TEST_DSN is not set')
+class DatabaseTestCase(unittest.TestCase):
+    """Creates the subscriber tables, with an admin and two users written
+    by block 1
+    """
+
+    def setUp(self):
+        # Retries while the postgres container starts
+        admin = Database(TEST_DSN)
+        admin.connect()
+        with admin._conn.cursor() as cursor:
+            cursor.execute(
+                'DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}'
+                .format(TEST_SCHEMA))
+        admin.commit()
+        admin.disconnect()
+
+        self.database = Database(
+            "{} options='-c search_path={}'".format(TEST_DSN, TEST_SCHEMA))
+        self.database.connect()
+        self.database.create_tables()
+        self.now = int(time.time())
+
+        self.add_block(1)
+        self.database.insert_admin({
+            'public_key': ADMIN_KEY,
+            'name': 'admin',
+            'created_at': self.now,
+            'start_block_num': 1,
+            'end_block_num': MAX_BLOCK_NUMBER,
+        })
+        for public_key in (ALICE_KEY, BOB_KEY):
+            self.database.insert_user({
+                'public_key': public_key,
+                'name': public_key,
+                'created_at': self.now,
+                'quota': 100,
+                'created_by_admin_public_key': ADMIN_KEY,
+                'updated_by_admin_public_key': ADMIN_KEY,
+                'updated_at': self.now,
+                'start_block_num': 1,
+                'end_block_num': MAX_BLOCK_NUMBER,
+            })
+        self.database.commit()
+
+    def tearDown(self):
+        self.database.disconnect()
+
+    def add_block(self, block_num):
+        self.database.insert_block(
+            {'block_num': block_num, 'block_id': 'block-{}'.format(block_num)})
+        self.database.save_checkpoint(
+            block_num, 'block-{}'.format(block_num))
+
+    def add_reading(self, block_num, sensor_id, measurement,
+                    owner=ALICE_KEY):
+        """Writes a block with a reading of sensor_id, as the subscriber
+        writes the sensor's state after each update
+        """
+        self.add_block(block_num)
+        self.database.insert_sensor({
+            'sensor_id': sensor_id,
+            'created_at': self.now,
+            'locations': [
+                {'latitude': 1, 'longitude': 2, 'timestamp': self.now}],
+            'measurements': [
+                {'measurement': measurement, 'timestamp': self.now}],
+            'owners': [
+                {'user_public_key': owner, 'timestamp': self.now + block_num}],
+            'start_block_num': block_num,
+            'end_block_num': MAX_BLOCK_NUMBER,
+        })
+        self.database.commit()
+
+    def fetch(self, query, *params):
+        with self.database._conn.cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+
+class SubscriberDatabaseTest(DatabaseTestCase):
+
+    def test_drop_fork_keeps_history_from_before_the_fork(self):
+        self.add_reading(2, 'sensor-1', 10)
+        self.add_reading(3, 'sensor-1', 5)
+        self.add_reading(4, 'sensor-1', 7)
+
+        self.database.drop_fork(4)
+        self.database.commit()
+
+        self.assertEqual(
+            self.fetch(
+                'SELECT measurement, end_block_num FROM measurements '
+                'ORDER BY start_block_num'),
+            [(10, 3), (5, MAX_BLOCK_NUMBER)])
+        self.assertEqual(
+            self.fetch('SELECT start_block_num, end_block_num FROM sensors'),
+            [(3, MAX_BLOCK_NUMBER)])
+        self.assertEqual(
+            self.fetch(
+                'SELECT COUNT(*) FROM sensor_owners '
+                'WHERE end_block_num = %s', MAX_BLOCK_NUMBER),
+            [(1,)])
+        self.assertEqual(
+            self.fetch(
+                'SELECT COUNT(*) FROM sensor_locations '
+                'WHERE end_block_num = %s', MAX_BLOCK_NUMBER),
+            [(1,)])
+        self.assertEqual(
+            self.fetch('SELECT total FROM usage_monthly'), [(15,)])
+        self.assertEqual(
+            self.fetch('SELECT user_public_key, total FROM user_usage'),
+            [(ALICE_KEY, 15)])
+        self.assertEqual(
+            self.fetch('SELECT block_num FROM subscriber_checkpoint'),
+            [(3,)])
+
+    def test_drop_fork_deletes_sensors_created_by_the_fork(self):
+        self.add_reading(2, 'sensor-1', 10)
+        self.add_reading(3, 'sensor-2', 5)
+
+        self.database.drop_fork(3)
+        self.database.commit()
+
+        self.assertEqual(
+            self.fetch('SELECT sensor_id FROM sensors'), [('sensor-1',)])
+        self.assertEqual(
+            self.fetch('SELECT DISTINCT sensor_id FROM sensor_owners'),
+            [('sensor-1',)])
+        self.assertEqual(
+            self.fetch('SELECT sensor_id, total FROM usage_monthly'),
+            [('sensor-1', 10)])
+
+    def test_drop_fork_credits_usage_to_the_owner_before_the_fork(self):
+        self.add_reading(2, 'sensor-1', 10)
+        self.add_reading(3, 'sensor-1', 5, owner=BOB_KEY)
+
+        self.database.drop_fork(3)
+        self.database.commit()
+
+        self.assertEqual(
+            self.fetch('SELECT user_public_key, total FROM user_usage'),
+            [(ALICE_KEY, 10)])
+        self.assertEqual(
+            self.fetch('SELECT user_public_key, total FROM usage_monthly'),
+            [(ALICE_KEY, 10)])
+
+
+    def update_quota(self, block_num, public_key, quota):
+        self.add_block(block_num)
+        self.database.insert_user({
+            'public_key': public_key,
+            'name': public_key,
+            'created_at': self.now,
+            'quota': quota,
+            'created_by_admin_public_key': ADMIN_KEY,
+            'updated_by_admin_public_key': ADMIN_KEY,
+            'updated_at': self.now + block_num,
+            'start_block_num': block_num,
+            'end_block_num': MAX_BLOCK_NUMBER,
+        })
+        self.database.commit()
+
+    def test_drop_fork_restores_users_updated_by_the_fork(self):
+        self.update_quota(3, ALICE_KEY, 200)
+        self.update_quota(5, ALICE_KEY, 300)
+
+        self.database.drop_fork(5)
+        self.database.commit()
+
+        self.assertEqual(
+            self.fetch(
+                'SELECT public_key, quota, updated_at, start_block_num, '
+                'end_block_num FROM users ORDER BY public_key'),
+            [(ALICE_KEY, 200, self.now + 3, 3, MAX_BLOCK_NUMBER),
+             (BOB_KEY, 100, self.now, 1, MAX_BLOCK_NUMBER)])
+        self.assertEqual(
+            self.fetch(
+                'SELECT quota, end_block_num FROM user_versions '
+                'WHERE public_key = %s ORDER BY start_block_num', ALICE_KEY),
+            [(100, 3), (200, MAX_BLOCK_NUMBER)])
+
+    def test_drop_fork_deletes_users_created_by_the_fork(self):
+        self.update_quota(3, 'carol-key', 50)
+        self.add_reading(4, 'sensor-1', 10, owner='carol-key')
+
+        self.database.drop_fork(3)
+        self.database.commit()
+
+        self.assertEqual(
+            self.fetch('SELECT public_key FROM users ORDER BY public_key'),
+            [(ALICE_KEY,), (BOB_KEY,)])
+        self.assertEqual(
+            self.fetch(
+                'SELECT COUNT(*) FROM user_versions WHERE public_key = %s',
+                'carol-key'),
+            [(0,)])
+
+
+class FailingDatabase(Database):
+    """Fails to insert the given block once, as a lost connection would
+    """
+    def __init__(self, dsn, failing_block_num):
+        super().__init__(dsn)
+        self.failing_block_num = failing_block_num
+
+    def insert_block(self, block_dict):
+        if block_dict['block_num'] == self.failing_block_num:
+            self.failing_block_num = None
+            raise psycopg2.OperationalError('connection lost')
+        super().insert_block(block_dict)
+
+
+class CheckpointResumeTest(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.database.disconnect()
+        self.database = FailingDatabase(self.database._dsn, 3)
+        self.database.connect()
+
+    def block_events(self, block_num):
+        return [Event(
+            event_type='sawtooth/block-commit',
+            attributes=[
+                EventAttribute('block_num', str(block_num)),
+                EventAttribute('block_id', 'block-{}'.format(block_num))],
+            data=b'')]
+
+    def assert_resumes_after(self, block_num):
+        self.assertEqual(
+            self.fetch('SELECT block_num FROM subscriber_checkpoint'),
+            [(block_num,)])
+        self.assertEqual(
+            get_resume_block_ids(self.database, 1),
+            ['block-{}'.format(block_num)])
+
+    def test_failed_block_stops_the_subscriber(self):
+        handle_events = get_events_handler(self.database)
+        handle_events(self.block_events(2))
+
+        with self.assertRaises(psycopg2.OperationalError):
+            handle_events(self.block_events(3))
+        self.assert_resumes_after(2)
+
+        # Restarted from the checkpoint, the failed block is replayed
+        handle_events = get_events_handler(self.database)
+        handle_events(self.block_events(3))
+        handle_events(self.block_events(4))
+        self.assert_resumes_after(4)
+
+    def test_failed_block_commits_the_blocks_batched_before_it(self):
+        handle_events = get_events_handler(
+            self.database, commit_interval=3600)
+        handle_events(self.block_events(2))
+
+        with self.assertRaises(psycopg2.OperationalError):
+            handle_events(self.block_events(3))
+        self.assert_resumes_after(2)